@@ -0,0 +1,249 @@
+'''
+asyncio build API: the build pipeline, with pdflatex, poppler, and image tools run
+as asyncio subprocesses, so that one event loop can drive many builds concurrently.
+
+A ToolRunner bounds the number of tool processes running at once; share one
+runner among all the builds driven by an event loop:
+
+    runner = ToolRunner(max_procs=8)
+    l2ds = await asyncio.gather(*[build_async(fn, runner=runner) for fn in texfns])
+
+The label images of a problem are extracted concurrently, too.  The build steps
+which block without running tools (reading the *.dnd and dependency files, label
+cache lookups, which may go over the network, the formula tests, and writing and
+moving the outputs) run in the event loop's default thread pool.
+'''
+
+import os
+import shutil
+import asyncio
+import functools
+from shlex import quote
+from collections import OrderedDict
+
+from .main import PageImage, LatexToDragDrop
+from .fileutil import temp_name_for
+
+async def in_thread(func, *args):
+    '''
+    Run func(*args), which blocks, in the event loop's default thread pool; return its result
+    '''
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *args))
+
+class ToolRunner(object):
+    '''
+    Run external tools as asyncio subprocesses, with at most max_procs running at once.
+    '''
+    def __init__(self, max_procs=4):
+        self.max_procs = max_procs
+        self.semaphore = asyncio.BoundedSemaphore(max_procs)
+        self.running = 0
+        self.max_running = 0		# most tool processes seen running at once
+        self.nrun = 0			# number of tool processes run
+
+    async def run(self, cmd, cwd=None, env=None, merge_stderr=False):
+        '''
+        Run cmd (shell command string, or list of arguments); return its stdout (str), with its
+        stderr interleaved if merge_stderr.
+        '''
+        stderr = asyncio.subprocess.STDOUT if merge_stderr else None
+        async with self.semaphore:
+            self.running += 1
+            self.nrun += 1
+            self.max_running = max(self.max_running, self.running)
+            try:
+                if isinstance(cmd, list):
+                    proc = await asyncio.create_subprocess_exec(*cmd, cwd=cwd, env=env,
+                                                                stdout=asyncio.subprocess.PIPE, stderr=stderr,
+                                                                stdin=asyncio.subprocess.DEVNULL)
+                else:
+                    proc = await asyncio.create_subprocess_shell(cmd, cwd=cwd, env=env,
+                                                                 stdout=asyncio.subprocess.PIPE, stderr=stderr,
+                                                                 stdin=asyncio.subprocess.DEVNULL)
+                (out, err) = await proc.communicate()
+            finally:
+                self.running -= 1
+        return out.decode('utf8', 'replace')
+
+class AsyncPageImage(PageImage):
+    '''
+    PageImage whose tool steps are coroutines, run by a ToolRunner.
+    Create with: pi = await AsyncPageImage.create(runner, fn, page=..., ...)
+    '''
+    @classmethod
+    async def create(cls, runner, fn, page=1, imfn=None, pdfimfn=None, dpi=300, verbose=False, timed=None):
+        pi = cls(fn, page=page, imfn=imfn, pdfimfn=pdfimfn, dpi=dpi, verbose=verbose, run=False, timed=timed)
+        pi.runner = runner
+        await pi.separate_and_crop()
+        await pi.render(dpi)
+        return pi
+
+    async def run_tool(self, cmd):
+        if self.verbose:
+            print(cmd)
+        return await self.runner.run(cmd)
+
+    async def separate_and_crop(self):
+        tmpfn = temp_name_for(self.pdfimfn) + ".pdf"
+        try:
+            with self.timed('crop'):
+                cmd = self.separate_cmd(tmpfn)
+                await self.run_tool(cmd)
+                self.check_output_file(tmpfn, cmd, "pdfseparate")
+                cmd = self.crop_cmd(tmpfn)
+                bbstr = await self.run_tool(cmd)
+        finally:
+            if os.path.exists(tmpfn):
+                os.unlink(tmpfn)
+        self.set_bounding_box(bbstr, cmd)
+
+    async def render(self, dpi):
+        with self.timed('rasterize'):
+            await self.run_tool(self.render_cmd(dpi))
+        self.dpi = dpi
+        self.set_size(await self.run_tool(self.size_cmd()))
+
+    async def NegateBox(self, box, outfn=None):
+        outfn = outfn or self.imfn
+        cmd = self.negate_cmd(box, outfn)
+        await self.run_tool(cmd)
+        self.check_output_file(outfn, cmd, "convert")
+
+    async def WhiteBox(self, boxes, outfn=None):
+        outfn = outfn or self.imfn
+        cmd = self.whitebox_cmd(boxes, outfn)
+        await self.run_tool(cmd)
+        self.check_output_file(outfn, cmd, "convert")
+
+    async def ExtractBox(self, box, outfn=None):
+        outfn = outfn or (self.imfn[:-4] + '_extract.png')
+        cmd = self.extract_cmd(box, outfn)
+        await self.run_tool(cmd)
+        self.check_output_file(outfn, cmd, "convert")
+
+class AsyncLatexToDragDrop(LatexToDragDrop):
+    '''
+    LatexToDragDrop whose build, and the stages which run external tools, are coroutines.
+    Nothing is done on construction; run the build with: await l2d.build()
+    '''
+    def __init__(self, texfn, runner=None, **options):
+        '''
+        texfn = *.tex filename
+        runner = ToolRunner to run tools with (default: a new ToolRunner, with max_procs=4)
+        options = LatexToDragDrop keyword arguments
+        '''
+        options['build'] = False
+        LatexToDragDrop.__init__(self, texfn, **options)
+        self.runner = runner or ToolRunner()
+
+    async def page_image(self, page, imfn, pdfimfn=None):
+        return await AsyncPageImage.create(self.runner, self.pdffn, page=page, imfn=imfn, pdfimfn=pdfimfn,
+                                           dpi=self.final_dpi, verbose=self.imverbose, timed=self.timed)
+
+    async def build(self):
+        if self.do_compile:
+            with self.timed('latex'):
+                await self.compile_latex()
+        if not os.path.isdir(self.outdir):
+            print("Error: output directory '%s' is not a directory" % self.outdir)
+            return
+        with self.timed('load'):
+            await in_thread(self.load_dependencies)
+            await in_thread(self.load_boxes)
+            await in_thread(self.load_dnd)
+        async with self.output_lock:		# waits without blocking the event loop
+            with self.timed('images'):
+                await self.generate_images()
+            await in_thread(self.generate_dnd_xml)
+            await in_thread(self.finish_build)
+        return self
+
+    async def compile_latex(self):
+        cmd = self.latex_cmd()
+        if self.verbose:
+            print("Running %s twice, with TEXINPUTS=%s" % (' '.join(quote(x) for x in cmd), self.env['TEXINPUTS']))
+        outs = []
+        aux = self.read_aux()
+        for k in range(2):
+            if k and not self.latex_rerun_needed(aux):
+                break
+            outs.append(await self.runner.run(cmd, cwd=self.workdir, env=self.env, merge_stderr=True))
+        with self.latex_output() as fp:
+            if fp is not None:
+                fp.write(''.join(outs).encode('utf8'))
+            elif self.verbose:
+                print(outs[-1])
+
+    async def generate_images(self):
+        self.prepare_images()
+        try:
+            await self.generate_dnd_image()
+            await self.generate_label_images(self.scratch)
+            if self.max_bytes:
+                await self.fit_images_to_byte_budget()
+            await in_thread(self.postprocess_images)
+        finally:
+            shutil.rmtree(self.scratch, ignore_errors=True)
+
+    async def generate_dnd_image(self):
+        self.choose_dpi()
+        if self.dpi=="max":
+            self.dndpi = await self.page_image(1, self.solimfn)
+            if self.reduce_dpi_to_fit_width():
+                await self.dndpi.render(self.final_dpi)
+                self.check_image_width()
+        else:
+            self.dndpi = await self.page_image(1, self.solimfn)
+        await self.dndpi.WhiteBox(self.answer_boxes(), outfn=self.dndimfn)
+
+    async def generate_label_images(self, outdir='.'):
+        self.labelimfn = self.outdir / self.fnpre + "_labels.png"
+        if await in_thread(self.load_cached_label_images, outdir):
+            return
+        if self.labelpi is None:
+            self.labelpi = await self.page_image(2, self.labelimfn, pdfimfn=self.label_pdf_filename())
+        elif self.labelpi.dpi != self.final_dpi:
+            await self.labelpi.render(self.final_dpi)
+        with self.timed('labels'):
+            await self.extract_label_images(outdir)
+        await in_thread(self.save_cached_label_images)
+
+    async def extract_label_images(self, outdir='.'):
+        boxes = self.label_boxes(outdir)
+        await asyncio.gather(*[self.labelpi.ExtractBox(box, outfn) for (box, outfn) in boxes.values()])
+        self.labels = OrderedDict((labelnum, outfn) for labelnum, (box, outfn) in boxes.items())
+        if self.verbose:
+            print("  %s labels" % len(self.labels))
+
+    async def render_images(self, dpi):
+        self.final_dpi = dpi
+        await self.dndpi.render(dpi)
+        await self.dndpi.WhiteBox(self.answer_boxes(), outfn=self.dndimfn)
+        await self.generate_label_images(self.scratch)
+
+    async def fit_images_to_byte_budget(self):
+        search = self.start_dpi_search()
+        if search is None:
+            return
+        self.cache_label_images = False
+        try:
+            dpi = search.next_dpi()
+            while dpi is not None:
+                await self.render_images(dpi)
+                self.record_dpi_trial(search, dpi)
+                dpi = search.next_dpi()
+            if search.fit_dpi is not None and search.fit_dpi != search.dpi:
+                await self.render_images(search.fit_dpi)
+        finally:
+            self.cache_label_images = True
+        await in_thread(self.save_cached_label_images)
+        self.report_dpi_search(search)
+
+async def build_async(texfn, runner=None, **options):
+    '''
+    Build drag-and-drop problem from texfn asynchronously; return the AsyncLatexToDragDrop instance.
+    options = LatexToDragDrop keyword arguments (e.g. workdir, dpi, outdir)
+    '''
+    l2d = AsyncLatexToDragDrop(texfn, runner=runner, **options)
+    await l2d.build()
+    return l2d
@@ -0,0 +1,132 @@
+'''
+In-memory library API: build a drag-and-drop problem from TeX or dndspec text,
+and get back the XML, the image bytes, and the formula test results.
+
+All the intermediate and output files (pdflatex output, tmp.pdf, images, XML)
+live in a private scratch directory, which is removed when the build is done;
+nothing is written to the current working directory.
+
+    from latex2dnd.api import build_dnd
+    result = build_dnd(open("quadratic.tex").read(), name="quadratic")
+    result.xml			# XML string
+    result.images		# dict of image filename -> PNG bytes
+    result.test_results		# formula unit test results
+'''
+
+import os
+import re
+import json
+import shutil
+import tempfile
+from io import StringIO
+from collections import OrderedDict
+
+from .fileutil import write_if_changed
+
+NAME_PATTERN = re.compile(r'^[A-Za-z0-9_-]+$')
+
+def check_name(name):
+    '''
+    Raise ValueError unless name is a safe problem name (letters, digits, _ and -), which
+    cannot lead outside the scratch directory when used in filenames
+    '''
+    if not isinstance(name, str) or not NAME_PATTERN.match(name):
+        raise ValueError("[latex2dnd] Bad problem name %r (use only letters, digits, _ and -)" % (name,))
+
+def check_filename(bn):
+    '''
+    Raise ValueError unless bn is a plain filename, in the scratch directory
+    '''
+    if not isinstance(bn, str) or not bn or '/' in bn or '\\' in bn or bn.startswith('.'):
+        raise ValueError("[latex2dnd] Bad filename %r" % (bn,))
+
+class DragDropResult(object):
+    '''
+    Outputs of one drag-and-drop problem build, held in memory.
+
+    name = problem name (filename stem)
+    xml = drag-and-drop problem XML (str)
+    images = OrderedDict with key = image filename, val = PNG bytes
+    dnd_image, solution_image = filenames (keys in images) of the problem and solution images
+    label_images = OrderedDict with key = label number, val = image filename
+    test_results = formula unit test results (dict), if the problem has a formula
+    imdir = URL directory prefix the XML expects images to be in
+    '''
+    def __init__(self, name, xml, images, dnd_image, solution_image, label_images, test_results, imdir):
+        self.name = name
+        self.xml = xml
+        self.images = images
+        self.dnd_image = dnd_image
+        self.solution_image = solution_image
+        self.label_images = label_images
+        self.test_results = test_results
+        self.imdir = imdir
+
+    def files(self):
+        '''
+        Return OrderedDict with key = output filename, val = bytes, for all the outputs,
+        named as a filesystem build would name them.
+        '''
+        files = OrderedDict()
+        files[self.name + '_dnd.xml'] = self.xml.encode('utf8')
+        files.update(self.images)
+        if self.test_results:
+            files[self.name + '_dnd_tests.json'] = json.dumps(self.test_results, indent=4).encode('utf8')
+        return files
+
+    def write(self, outdir):
+        '''
+        Write all outputs to directory outdir; return list of filenames written.
+        '''
+        fns = []
+        for bn, data in self.files().items():
+            fn = os.path.join(outdir, bn)
+            write_if_changed(fn, data)
+            fns.append(fn)
+        return fns
+
+def build_dnd(text, name="problem", fmt="tex", extra_files=None, **options):
+    '''
+    Build a drag-and-drop problem from source text, and return a DragDropResult.
+
+    text = TeX (fmt="tex") or dndspec (fmt="dndspec") source
+    name = problem name, used for the source and output filenames (letters, digits, _ and - only)
+    extra_files = dict with key = filename, val = bytes or str, for other files the source
+                  needs (e.g. figures, style files), which are put next to the source.
+                  Filenames may not contain directories, or start with "."
+    options = other LatexToDragDrop keyword arguments (e.g. dpi, can_reuse, reproducible, env)
+
+    The current directory and os.environ are left alone, so builds may run concurrently in threads.
+    '''
+    from .main import LatexToDragDrop, DNDspec2tex
+    if fmt not in ["tex", "dndspec"]:
+        raise Exception("[latex2dnd] Unknown source format %s (use tex or dndspec)" % fmt)
+    check_name(name)
+    for bn in (extra_files or {}):
+        check_filename(bn)
+    options.setdefault('verbose', False)
+    options['outdir'] = '.'
+    scratch = tempfile.mkdtemp(prefix='latex2dnd_')
+    options['workdir'] = scratch
+    try:
+        if fmt == "dndspec":
+            ofp = StringIO()
+            DNDspec2tex(name + '.dndspec', input_tex=text, output_fp=ofp, verbose=options['verbose'])
+            text = ofp.getvalue()
+        for bn, data in list((extra_files or {}).items()) + [(name + '.tex', text)]:
+            write_if_changed(os.path.join(scratch, bn), data)
+        l2d = LatexToDragDrop(name + '.tex', **options)
+
+        def read(fn):
+            with open(os.path.join(scratch, fn), 'rb') as fp:
+                return fp.read()
+
+        images = OrderedDict()
+        for fn in [l2d.dndimfn, l2d.solimfn] + list(l2d.labels.values()):
+            images[str(fn.basename())] = read(fn)
+        label_images = OrderedDict((labnum, str(fn.basename())) for labnum, fn in l2d.labels.items())
+        return DragDropResult(name, read(l2d.xmlfn).decode('utf8'), images,
+                              str(l2d.dndimfn.basename()), str(l2d.solimfn.basename()), label_images,
+                              l2d.test_results, l2d.imdir)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
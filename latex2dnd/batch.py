@@ -0,0 +1,387 @@
+'''
+Batch builds: build many drag-and-drop problems (.tex or .dndspec files) in one
+run, optionally in parallel, and record all the artifacts in a build manifest.
+
+Usage:
+
+    latex2dnd batch [options] [dir_or_file ...]
+
+All the single problem build options (e.g. -r, -c, --label-cache) apply to each problem.
+'''
+
+import os
+import sys
+import glob
+import time
+import traceback
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .manifest import BuildManifest
+from .olx import CourseArchive
+from .shard import select_shard, load_costs
+from .history import BuildHistory, longest_first, Progress
+from .journal import BuildJournal, input_hash
+from .fileutil import OutputSnapshot
+from .events import NullEvents, EventRecorder, open_event_stream
+from .metrics import BuildMetrics, peak_child_rss
+from .deps import git_changed_files, changed_problems, dependency_map, dependency_hashes
+
+def is_problem_tex(fn):
+    '''
+    Return True if fn looks like a latex2dnd problem source: a full latex document using DDlabel
+    '''
+    try:
+        with open(fn) as fp:
+            tex = fp.read()
+    except Exception:
+        return False
+    return ("\\begin{document}" in tex) and ("DDlabel" in tex)
+
+def find_problems(paths):
+    '''
+    Return sorted list of problem source files in paths (files or directories).
+    Directories are searched (non-recursively) for *.dndspec files, and *.tex files
+    which are latex2dnd problems; a .tex file generated from a .dndspec is skipped.
+    '''
+    problems = []
+    for path in paths:
+        if os.path.isdir(path):
+            specs = glob.glob(os.path.join(path, "*.dndspec"))
+            problems += specs
+            spec_stems = set(os.path.splitext(fn)[0] for fn in specs)
+            for fn in glob.glob(os.path.join(path, "*.tex")):
+                if os.path.splitext(fn)[0] in spec_stems:
+                    continue
+                if is_problem_tex(fn):
+                    problems.append(fn)
+        else:
+            problems.append(path)
+    return sorted(problems)
+
+def absolute_options(opts):
+    '''
+    Make the directory-valued options absolute, since each problem is built in its own working directory.
+    '''
+    for name in ['output_dir', 'label_cache', 'dedup_dir', 'manifest', 'olx_archive']:
+        val = getattr(opts, name, None)
+        if val:
+            setattr(opts, name, os.path.abspath(val))
+    return opts
+
+def recorded_dependency_map(manifest_fn):
+    '''
+    Return dict with key = problem, val = list of the dependencies recorded in build manifest manifest_fn
+    (if it exists)
+    '''
+    if not (manifest_fn and os.path.exists(manifest_fn)):
+        return {}
+    return dict((problem, list(info.get('dependencies', {}).keys()))
+                for problem, info in BuildManifest.load(manifest_fn).problems.items())
+
+def build_problem(problem, opts, events=None):
+    '''
+    Build one problem, with its directory as the working directory.  Return dict with name, status,
+    seconds, artifacts (list of absolute filenames), error (if failed), stages (seconds per stage),
+    dependencies (dict with key = filename, val = sha256, of the local files the build read), bytes
+    (total size of the artifacts), label_cache (label cache hits and misses, if a label cache is used),
+    and child_rss (peak RSS in bytes of the tools run so far by this process, if known).
+
+    A build which fails (or is interrupted) is rolled back: the problem's output files are left as
+    they were before the build, so there are no half-written outputs.
+
+    events = EventStream to send the job's progress events to
+    '''
+    from .main import LatexToDragDrop, DndToCatsoop, DNDspec2tex, build_options
+    problem = os.path.abspath(problem)
+    workdir = os.path.dirname(problem)
+    start = time.time()
+    name = os.path.splitext(os.path.basename(problem))[0]
+    events = (events or NullEvents()).bind(job=name)
+    events.emit('job_started', problem=problem)
+    ret = OrderedDict([('name', name), ('status', 'ok'), ('seconds', 0), ('artifacts', []), ('error', None),
+                       ('stages', OrderedDict()), ('dependencies', OrderedDict()), ('bytes', 0),
+                       ('label_cache', None), ('child_rss', None)])
+    try:
+        kwargs = build_options(opts)
+        kwargs['workdir'] = workdir
+        if opts.output_dir:
+            kwargs['outdir'] = os.path.join(opts.output_dir, name)
+            if not os.path.exists(kwargs['outdir']):
+                os.makedirs(kwargs['outdir'])
+        else:
+            kwargs['outdir'] = '.'
+        snapshot = OutputSnapshot([workdir, os.path.join(workdir, kwargs['outdir'])],
+                                  [name + '_dnd', name + '.md', '.' + name + '_dnd'])
+        try:
+            fn = os.path.basename(problem)
+            if fn.endswith(".dndspec"):
+                events.emit('stage_started', stage='dndspec')
+                s2t = DNDspec2tex(problem, verbose=opts.verbose)
+                fn = os.path.basename(s2t.tex_filename)
+                ret['stages']['dndspec'] = round(time.time() - start, 3)
+                events.emit('stage_finished', stage='dndspec', seconds=ret['stages']['dndspec'])
+            l2d = LatexToDragDrop(fn, events=events, **kwargs)
+            ret['stages'].update(l2d.stage_times)
+            # the .tex generated from a dndspec is an output; the dndspec is the source
+            deps = [dfn for dfn in l2d.dependencies if dfn != os.path.join(workdir, fn)]
+            ret['dependencies'] = dependency_hashes(sorted(set(deps + [problem])))
+            if opts.output_catsoop:
+                l2d.d2c = DndToCatsoop(l2d)
+                events.emit('artifact_written', path=str(l2d.d2c.ofn), bytes=os.path.getsize(l2d.d2c.ofn))
+            ret['name'] = l2d.fnpre.basename()
+            ret['artifacts'] = [os.path.abspath(afn) for afn in l2d.artifacts()]
+            ret['bytes'] = sum(os.path.getsize(afn) for afn in ret['artifacts'])
+            if l2d.label_cache is not None:
+                ret['label_cache'] = OrderedDict([('hits', l2d.label_cache.hits), ('misses', l2d.label_cache.misses)])
+        except BaseException:
+            snapshot.rollback()
+            raise
+        snapshot.discard()
+    except (Exception, SystemExit) as err:
+        ret['status'] = 'failed'
+        ret['error'] = "%s: %s" % (err.__class__.__name__, err)
+        events.emit('error', error=ret['error'])
+        if opts.verbose:
+            traceback.print_exc()
+    ret['seconds'] = round(time.time() - start, 3)
+    ret['child_rss'] = peak_child_rss()
+    events.emit('job_finished', status=ret['status'], seconds=ret['seconds'])
+    return ret
+
+def build_problem_recorded(problem, opts):
+    '''
+    Run build_problem in a pool process which cannot write to the events file descriptor (not
+    started by fork); return (result, event lines), for the parent to write the events.
+    '''
+    events = EventRecorder()
+    return (build_problem(problem, opts, events), events.lines)
+
+class BatchBuilder(object):
+    '''
+    Build a list of problems, with up to jobs builds running in parallel processes,
+    and write a manifest of all the artifacts produced.  If archive (a CourseArchive)
+    is given, each problem is added to it as soon as its build is done.  If history
+    (a BuildHistory) is given, the problems with the longest build times in the history
+    are started first, and each problem's build timings are added to the history.  If
+    journal (a BuildJournal) is given, each completed build is appended to it, and problems
+    the journal shows were already built from the same inputs are skipped.  If metrics (a
+    BuildMetrics) is given, it is updated and rewritten as each build finishes.  If
+    update_manifest, the problems are a subset of those in the existing manifest (e.g. those
+    changed since a git revision), and only their entries in it are replaced.
+    '''
+    def __init__(self, problems, opts, jobs=1, manifest_fn=None, verbose=False, archive=None, history=None,
+                 journal=None, events=None, metrics=None, update_manifest=False):
+        self.opts = absolute_options(opts)
+        self.jobs = jobs
+        if update_manifest and manifest_fn and os.path.exists(manifest_fn):
+            self.manifest = BuildManifest.load(manifest_fn)
+        else:
+            self.manifest = BuildManifest(manifest_fn)
+        self.verbose = verbose
+        self.archive = archive
+        self.history = history
+        self.journal = journal
+        self.events = events or NullEvents()
+        self.metrics = metrics
+        self.input_hashes = {}
+        self.results = OrderedDict()
+        costs = history.costs(problems) if history is not None else {}
+        self.problems = longest_first(problems, costs)
+        self.progress = Progress(self.problems, costs, jobs=jobs)
+
+    def record(self, problem, result, resumed=False):
+        self.results[problem] = result
+        self.manifest.remove_problem(problem)		# e.g. its entry from the build which update_manifest keeps
+        self.manifest.add_files(result['artifacts'], problem,
+                                status=result['status'],
+                                seconds=result['seconds'],
+                                error=result['error'],
+                                stages=result['stages'],
+                                dependencies=result.get('dependencies', {}),
+        )
+        if self.history is not None and not resumed:
+            self.history.record(problem, result['status'], result['seconds'], result['stages'])
+        if self.journal is not None and not resumed:
+            self.journal.append(problem, self.input_hashes.get(problem), result)
+        self.progress.finished(problem, result['seconds'])
+        if self.metrics is not None:
+            self.metrics.observe(result, resumed=resumed)
+            self.metrics.write()
+        if self.archive is not None and result['status'] == 'ok':
+            self.archive.add_problem(result['name'], result['artifacts'])
+        msg = "[latex2dnd] %s %s (%.1f sec)" % (result['status'], problem, result['seconds'])
+        if resumed:
+            msg = "[latex2dnd] %s %s (unchanged since the journaled build)" % (result['status'], problem)
+            self.events.emit('job_finished', job=result['name'], status=result['status'], seconds=0, resumed=True)
+        if result['error']:
+            msg += ": %s" % result['error']
+        print(msg)
+        print("[latex2dnd] %s" % self.progress.report())
+        sys.stdout.flush()
+
+    def resume(self):
+        '''
+        Record the problems already built (according to the journal) from unchanged inputs;
+        return list of the problems left to build.
+        '''
+        from .main import build_options
+        if self.journal is None:
+            return self.problems
+        options = build_options(self.opts)
+        todo = []
+        for problem in self.problems:
+            try:
+                self.input_hashes[problem] = input_hash(problem, options)
+            except EnvironmentError:
+                self.input_hashes[problem] = None
+            entry = self.journal.completed(problem, self.input_hashes[problem])
+            if entry is None:
+                todo.append(problem)
+            else:
+                self.record(problem, entry, resumed=True)
+        return todo
+
+    def run(self):
+        start = time.time()
+        if self.metrics is not None:
+            self.metrics.nproblems = len(self.problems)
+            self.metrics.write()
+        problems = self.resume()
+        for problem in problems:
+            self.events.emit('job_queued', job=os.path.splitext(os.path.basename(problem))[0], problem=problem)
+        if self.jobs > 1:
+            context = multiprocessing.get_context()
+            # only forked processes share the events file descriptor; others send their events back
+            forked = context.get_start_method() == 'fork' or isinstance(self.events, NullEvents)
+            with ProcessPoolExecutor(max_workers=self.jobs, mp_context=context) as pool:
+                if forked:
+                    futures = OrderedDict((pool.submit(build_problem, problem, self.opts, self.events), problem)
+                                          for problem in problems)
+                else:
+                    futures = OrderedDict((pool.submit(build_problem_recorded, problem, self.opts), problem)
+                                          for problem in problems)
+                for future in as_completed(futures):
+                    result = future.result()
+                    if not forked:
+                        (result, lines) = result
+                        self.events.write_lines(lines)
+                    self.record(futures[future], result)
+        else:
+            for problem in problems:
+                self.record(problem, build_problem(problem, self.opts, self.events))
+        if self.manifest.fn:
+            self.manifest.save()
+        if self.metrics is not None:
+            self.metrics.finish()
+        nfailed = len([x for x in self.results.values() if x['status'] != 'ok'])
+        print("[latex2dnd] Built %d problems (%d failed), %d artifacts, in %.1f sec" % (len(self.results),
+                                                                                       nfailed,
+                                                                                       sum(len(x['artifacts']) for x in self.results.values()),
+                                                                                       time.time() - start))
+        if self.manifest.fn:
+            print("[latex2dnd] Wrote build manifest to %s" % self.manifest.fn)
+        return nfailed
+
+def BatchCommandLine(arglist=None):
+    '''
+    latex2dnd batch [options] [dir_or_file ...]
+    '''
+    from .main import make_option_parser, check_image_url_for_archive
+    parser = make_option_parser(usage="usage: %prog batch [options] [dir_or_file ...]")
+    parser.add_option("-j", "--jobs",
+                      action="store",
+                      type="int",
+                      dest="jobs",
+                      default=1,
+                      help="Number of problems to build in parallel",)
+    parser.add_option("--shard",
+                      action="store",
+                      dest="shard",
+                      default=None,
+                      help="Build only shard i of N (given as i/N) of the problems, e.g. for parallel CI jobs",)
+    parser.add_option("--shard-costs",
+                      action="append",
+                      dest="shard_costs",
+                      default=[],
+                      help="Build manifest with problem build times, used to balance the shards (may be repeated)",)
+    parser.add_option("--history",
+                      action="store",
+                      dest="history",
+                      default="latex2dnd_history.db",
+                      help="SQLite database of build timings, used to start the slowest problems first (default latex2dnd_history.db, next to the --manifest)",)
+    parser.add_option("--no-history",
+                      action="store_const",
+                      const=None,
+                      dest="history",
+                      help="Do not use or record build timing history",)
+    parser.add_option("--journal",
+                      action="store",
+                      dest="journal",
+                      default="latex2dnd_journal.jsonl",
+                      help="Checkpoint journal of completed builds, for --resume (default latex2dnd_journal.jsonl, next to the --manifest)",)
+    parser.add_option("--resume",
+                      action="store_true",
+                      dest="resume",
+                      default=False,
+                      help="Skip problems which the journal shows were already built from unchanged inputs",)
+    parser.add_option("--changed-since",
+                      action="store",
+                      dest="changed_since",
+                      default=None,
+                      help="Build only the problems whose sources or dependencies (figures, .sty files) changed since this git revision",)
+    parser.add_option("--metrics",
+                      action="store",
+                      dest="metrics",
+                      default=None,
+                      help="Write build metrics (problems built, cache hits, stage durations, ...) to this Prometheus text format file, e.g. for the node exporter textfile collector",)
+    parser.set_defaults(manifest="latex2dnd_manifest.json", output_dir=None)
+    (opts, args) = parser.parse_args(arglist)
+    state_dir = os.path.dirname(opts.manifest or '')
+    for dest in ['history', 'journal']:		# build state is kept together, next to the manifest
+        if dest not in parser.given:
+            setattr(opts, dest, os.path.join(state_dir, parser.defaults[dest]))
+    if state_dir and not os.path.isdir(state_dir):
+        os.makedirs(state_dir)
+    problems = find_problems(args or ["."])
+    if not problems:
+        parser.error('no problems found')
+    if opts.changed_since:
+        try:
+            changed = git_changed_files(opts.changed_since)
+        except Exception as err:
+            parser.error(str(err))
+        nall = len(problems)
+        problems = changed_problems(problems, changed, dependency_map(problems, recorded_dependency_map(opts.manifest)))
+        print("[latex2dnd] %d of %d problems changed since %s" % (len(problems), nall, opts.changed_since))
+    try:
+        events = open_event_stream(opts.events, opts.events_fd)
+    except ValueError as err:
+        parser.error(str(err))
+    history = BuildHistory(opts.history) if opts.history else None
+    metrics = BuildMetrics(opts.metrics) if opts.metrics else None
+    journal = BuildJournal(opts.journal, resume=opts.resume)
+    if opts.shard:
+        try:
+            problems = select_shard(problems, opts.shard, load_costs(opts.shard_costs))
+        except ValueError as err:
+            parser.error(str(err))
+        print("[latex2dnd] Shard %s: %d problems" % (opts.shard, len(problems)))
+    check_image_url_for_archive(opts)
+    if opts.olx_archive:
+        with CourseArchive(opts.olx_archive, verbose=opts.verbose) as archive:
+            bb = BatchBuilder(problems, opts, jobs=opts.jobs, manifest_fn=opts.manifest, verbose=opts.verbose,
+                              archive=archive, history=history, journal=journal, events=events, metrics=metrics,
+                              update_manifest=bool(opts.changed_since))
+            nfailed = bb.run()
+    else:
+        bb = BatchBuilder(problems, opts, jobs=opts.jobs, manifest_fn=opts.manifest, verbose=opts.verbose,
+                          history=history, journal=journal, events=events, metrics=metrics,
+                          update_manifest=bool(opts.changed_since))
+        nfailed = bb.run()
+    if history is not None:
+        history.close()
+    if nfailed:
+        sys.exit(1)
+    return bb
@@ -0,0 +1,173 @@
+'''
+Staged, lazy drag-and-drop builds.
+
+LatexToDragDrop runs the whole build when constructed.  DragDropBuilder instead
+exposes each stage of the build, computed on first use and memoized, so tools
+which only need part of the work (e.g. a linter needing the target geometry, or
+a grader needing the answer key) can skip the expensive image rendering:
+
+    builder = DragDropBuilder("quadratic.tex")
+    builder.compile()		# run pdflatex
+    builder.boxes		# target boxes, in latex sp coordinates
+    builder.dnd_spec		# labels, box answers, formula, unit tests, options
+    builder.tests()		# formula unit test results
+    builder.dnd_image()		# render images
+    builder.labels()
+    builder.xml()		# generate the problem XML
+
+The problem's output lock (see latex2dnd.fileutil.OutputLock) is held while the
+images, and then the XML, are written, so that other builds of the problem into
+the same output directory do not interleave with them.  It is never held between
+stages: if another build removed or replaced this build's images meanwhile (their
+sha256 no longer matches), the xml stage renders them again before writing the XML.
+'''
+
+import os
+from collections import OrderedDict
+
+from .main import LatexToDragDrop
+from .store import sha256_file
+
+class DragDropBuilder(object):
+    '''
+    Lazy, staged build of a drag-and-drop problem.  Each stage runs the stages it
+    depends on, and runs at most once.
+    '''
+    def __init__(self, texfn, **options):
+        '''
+        texfn = *.tex filename
+        options = LatexToDragDrop keyword arguments (e.g. compile, dpi, workdir, outdir)
+        '''
+        options['build'] = False
+        self.l2d = LatexToDragDrop(texfn, **options)
+        self.stages = OrderedDict()
+        self.image_hashes = {}		# key = image filename, val = sha256 of the image this build wrote
+
+    def stage(self, name, func):
+        '''
+        Return result of stage name, running func to compute it the first time
+        '''
+        if name not in self.stages:
+            self.stages[name] = func()
+        return self.stages[name]
+
+    def compile(self):
+        '''
+        Run pdflatex (unless compile=False was given); return the PDF filename
+        '''
+        def run():
+            if self.l2d.do_compile:
+                self.l2d.compile_latex()
+            self.l2d.load_dependencies()
+            return self.l2d.pdffn
+        return self.stage('compile', run)
+
+    @property
+    def boxes(self):
+        '''
+        OrderedDict of target and label Box instances, with positions in latex sp units
+        '''
+        def run():
+            self.compile()
+            self.l2d.load_boxes()
+            return self.l2d.BoxSet
+        return self.stage('boxes', run)
+
+    @property
+    def dnd_spec(self):
+        '''
+        Problem specification from the *.dnd file: labels, label contents, box answers
+        (the answer key), formula, unit tests, and options
+        '''
+        def run():
+            self.compile()
+            l2d = self.l2d
+            l2d.load_dnd()
+            return OrderedDict([('labels', l2d.dnd_labels),
+                                ('label_contents', l2d.dnd_label_contents),
+                                ('box_answers', l2d.box_answers),
+                                ('formula', l2d.dnd_formula),
+                                ('unit_tests', l2d.unit_tests),
+                                ('options', l2d.options),
+                                ])
+        return self.stage('dnd_spec', run)
+
+    def images(self):
+        '''
+        Render the dnd image, solution image, and label images (one stage, since the
+        byte budget, hashing, and dedup options act on all the images together)
+        '''
+        def run():
+            self.boxes
+            self.dnd_spec
+            with self.l2d.output_lock:
+                self.render_images()
+            return True
+        return self.stage('images', run)
+
+    def image_files(self):
+        l2d = self.l2d
+        return [l2d.dndimfn, l2d.solimfn] + list(l2d.labels.values())
+
+    def render_images(self):
+        '''
+        Generate the images, and record their sha256, as written by this build.  Call with the output lock held.
+        '''
+        self.l2d.generate_images()
+        self.image_hashes = dict((fn, sha256_file(fn)) for fn in self.image_files())
+
+    def images_intact(self):
+        '''
+        Return True if the images written by the images stage are still in place, unchanged
+        '''
+        return all(os.path.exists(fn) and sha256_file(fn) == self.image_hashes.get(fn) for fn in self.image_files())
+
+    def dnd_image(self):
+        '''
+        Return filename of the dnd problem image
+        '''
+        self.images()
+        return self.l2d.dndimfn
+
+    def solution_image(self):
+        '''
+        Return filename of the solution image
+        '''
+        self.images()
+        return self.l2d.solimfn
+
+    def labels(self):
+        '''
+        Return OrderedDict with key = label number, val = label image filename
+        '''
+        self.images()
+        return self.l2d.labels
+
+    def tests(self):
+        '''
+        Run the formula unit tests (if the problem is checked with a \\DDformula); return list of results
+        '''
+        def run():
+            spec = self.dnd_spec
+            if spec['options'].get('custom_cfn') is not None or not spec['formula'].get('formula'):
+                return []
+            (cfn, check_code) = self.l2d.formula_check_code()
+            return self.l2d.run_formula_tests(check_code)
+        return self.stage('tests', run)
+
+    def xml(self):
+        '''
+        Generate the problem XML file; return the XML string
+        '''
+        def run():
+            self.images()
+            self.tests()
+            l2d = self.l2d
+            with l2d.output_lock:
+                if not self.images_intact():
+                    self.render_images()		# replaced by another build of the problem since the images stage
+                l2d.generate_dnd_xml()
+                l2d.finish_build()
+            with open(l2d.xmlfn) as fp:
+                return fp.read()
+        return self.stage('xml', run)
@@ -3,6 +3,7 @@ Unit tests for calc.py
 """
 
 import unittest
+import threading
 import numpy
 import calc
 from pyparsing import ParseException
@@ -558,3 +559,34 @@ class EvaluatorTest(unittest.TestCase):
             calc.evaluator({'r1': 5}, {}, "r1+r2")
         with self.assertRaisesRegex(calc.UndefinedVariable, 'r1 r3'):
             calc.evaluator(variables, {}, "r1*r3", case_sensitive=True)
+
+    def test_names_used(self):
+        """
+        Check the variables and functions found in a parse, including nested ones
+        """
+        parser = calc.ParseAugmenter("f(x^2 + g(y)) * x || 3k")
+        parser.parse_algebra()
+        self.assertEqual(parser.variables_used, set(['x', 'y']))
+        self.assertEqual(parser.functions_used, set(['f', 'g']))
+
+    def test_concurrent_evaluation(self):
+        """
+        The shared grammar should parse different expressions in several threads at once
+        """
+        errors = []
+
+        def evaluate(k):
+            try:
+                for _ in range(50):
+                    self.assertEqual(calc.evaluator({'x%d' % k: k}, {}, "2*x%d + 1" % k), 2 * k + 1)
+                    with self.assertRaisesRegex(calc.UndefinedVariable, '^y%d$' % k):
+                        calc.evaluator({'x%d' % k: k}, {}, "x%d * y%d" % (k, k))
+            except Exception as err:  # pylint: disable=broad-except
+                errors.append(err)
+
+        threads = [threading.Thread(target=evaluate, args=(k,)) for k in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
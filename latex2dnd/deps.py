@@ -0,0 +1,167 @@
+'''
+Problem dependencies, and git-aware selection of the problems to rebuild.
+
+The dependencies of a problem are its source file (.tex or .dndspec), and the
+local files it pulls in, found by scanning the TeX (including EXTRA_HEADER_TEX
+lines of a .dndspec): figures (\\includegraphics), included TeX (\\input,
+\\include), and local packages and classes (\\usepackage, \\RequirePackage,
+\\documentclass, when a matching .sty or .cls file is next to the source),
+followed recursively.
+
+    latex2dnd batch --changed-since origin/master problems/
+
+builds only the problems whose source or dependencies changed (according to
+git diff --name-only, plus untracked files) since the given revision.
+
+When a problem is compiled, pdflatex -recorder lists every file it actually read
+in <name>.fls; those (apart from files of the TeX installation) are the problem's
+recorded dependencies, stored with the build (in the manifest and the batch
+journal), and used, with the scanned ones, in rebuild and cache decisions.
+'''
+
+import os
+import re
+import subprocess
+from collections import OrderedDict
+
+from .store import sha256_file
+
+GRAPHICS_EXTENSIONS = ['.pdf', '.png', '.jpg', '.jpeg', '.eps']
+
+INCLUDE_PATTERNS = [(re.compile(r'\\includegraphics\s*(?:\[[^\]]*\])?\s*\{([^}]+)\}'), 'graphics'),
+                    (re.compile(r'\\(?:input|include)\s*\{([^}]+)\}'), 'tex'),
+                    (re.compile(r'\\(?:usepackage|RequirePackage)\s*(?:\[[^\]]*\])?\s*\{([^}]+)\}'), 'sty'),
+                    (re.compile(r'\\documentclass\s*(?:\[[^\]]*\])?\s*\{([^}]+)\}'), 'cls'),
+                    ]
+
+def strip_tex_comments(tex):
+    return re.sub(r'(?<!\\)%.*', '', tex)
+
+def candidate_files(name, kind, srcdir):
+    '''
+    Return list of the local files which a reference to name (of kind graphics, tex, sty, or cls)
+    in a source in directory srcdir may denote
+    '''
+    if kind in ['sty', 'cls']:
+        return [os.path.join(srcdir, x.strip() + '.' + kind) for x in name.split(',') if x.strip()]
+    fn = os.path.join(srcdir, name.strip())
+    if os.path.splitext(fn)[1]:
+        return [fn]
+    if kind == 'graphics':
+        return [fn + ext for ext in GRAPHICS_EXTENSIONS]
+    return [fn + '.tex']
+
+def scan_dependencies(problem):
+    '''
+    Return sorted list of absolute filenames of the files problem depends on, including itself.
+    Referenced files with an explicit extension are included even if missing, so that deleting
+    them counts as a change; other candidates are included only if they exist.
+    '''
+    problem = os.path.abspath(problem)
+    deps = set([problem])
+    todo = [problem]
+    while todo:
+        fn = todo.pop()
+        if not os.path.exists(fn) or os.path.splitext(fn)[1] in GRAPHICS_EXTENSIONS:
+            continue
+        with open(fn, errors='replace') as fp:
+            tex = strip_tex_comments(fp.read())
+        srcdir = os.path.dirname(fn)
+        for pattern, kind in INCLUDE_PATTERNS:
+            for name in pattern.findall(tex):
+                for cfn in candidate_files(name, kind, srcdir):
+                    explicit = kind == 'graphics' and cfn == os.path.join(srcdir, name.strip())
+                    if cfn in deps or not (os.path.exists(cfn) or explicit):
+                        continue
+                    deps.add(cfn)
+                    todo.append(cfn)
+    return sorted(deps)
+
+def parse_fls(flsfn):
+    '''
+    Parse pdflatex recorder file flsfn; return (inputs, outputs), lists of absolute filenames
+    '''
+    pwd = os.path.dirname(os.path.abspath(flsfn))
+    inputs = []
+    outputs = []
+    with open(flsfn, errors='replace') as fp:
+        for line in fp:
+            (kind, _, fn) = line.rstrip('\n').partition(' ')
+            if kind == 'PWD':
+                pwd = fn
+            elif kind in ['INPUT', 'OUTPUT']:
+                fn = os.path.normpath(os.path.join(pwd, fn))
+                files = inputs if kind == 'INPUT' else outputs
+                if fn not in files:
+                    files.append(fn)
+    return (inputs, outputs)
+
+def is_tex_system_file(fn):
+    '''
+    Return True if fn belongs to the TeX installation (e.g. under a texmf tree)
+    '''
+    parts = fn.split(os.sep)
+    return any(x.startswith('texmf') or x in ['texlive', 'miktex', 'fonts'] for x in parts)
+
+def recorded_dependencies(flsfn):
+    '''
+    Return sorted list of the files read by the pdflatex run recorded in flsfn, excluding files it
+    also wrote (e.g. the .aux file), and files of the TeX installation
+    '''
+    (inputs, outputs) = parse_fls(flsfn)
+    outputs = set(outputs)
+    return sorted(fn for fn in inputs if fn not in outputs and not is_tex_system_file(fn))
+
+def dependency_hashes(fns):
+    '''
+    Return OrderedDict with key = filename, val = sha256 of its contents (None if missing)
+    '''
+    return OrderedDict((fn, sha256_file(fn) if os.path.isfile(fn) else None) for fn in fns)
+
+def dependencies_unchanged(hashes):
+    '''
+    Return True if all the files in hashes (from dependency_hashes) still have the same contents
+    '''
+    return all((sha256_file(fn) if os.path.isfile(fn) else None) == sha for fn, sha in hashes.items())
+
+def dependency_map(problems, recorded=None):
+    '''
+    Return OrderedDict with key = problem, val = list of its dependencies (absolute filenames):
+    those found by scanning, plus those recorded by earlier builds (recorded = dict with key =
+    problem, val = list of filenames).
+    '''
+    recorded = recorded or {}
+    return OrderedDict((problem, sorted(set(scan_dependencies(problem)) | set(recorded.get(problem, []))))
+                       for problem in problems)
+
+def git_changed_files(rev, cwd=None):
+    '''
+    Return set of absolute filenames of the files changed in the git working tree (containing cwd)
+    since revision rev, including uncommitted changes and untracked files.
+    '''
+    cwd = os.path.abspath(cwd or os.getcwd())
+
+    def git(*args):
+        try:
+            out = subprocess.check_output(('git',) + args, cwd=cwd, stderr=subprocess.PIPE)
+        except (OSError, subprocess.CalledProcessError) as err:
+            msg = getattr(err, 'stderr', None) or b''
+            raise Exception("[latex2dnd] git %s failed: %s %s" % (' '.join(args), err, msg.decode('utf8', 'replace').strip()))
+        return os.fsdecode(out)
+
+    # -z: names are NUL separated and not quoted, so names with newlines, quotes or
+    # non-ASCII characters come through unchanged
+    top = git('rev-parse', '--show-toplevel').strip()
+    names = git('diff', '--name-only', '-z', rev, '--').split('\0')
+    names += git('ls-files', '-z', '--others', '--exclude-standard', '--full-name').split('\0')
+    return set(os.path.normpath(os.path.join(top, x)) for x in names if x)
+
+def changed_problems(problems, changed, deps=None):
+    '''
+    Return the problems (in order) having a dependency in the set changed (absolute filenames).
+    deps = dict with key = problem, val = list of dependencies (default: from scan_dependencies)
+    '''
+    deps = deps or dependency_map(problems)
+    changed = set(os.path.realpath(fn) for fn in changed)
+    return [problem for problem in problems
+            if any(os.path.realpath(fn) in changed for fn in deps[problem])]
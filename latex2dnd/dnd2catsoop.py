@@ -1,6 +1,7 @@
 import os
 import re
 from lxml import etree
+from .fileutil import write_if_changed
 
 class DndToCatsoop:
     '''
@@ -10,7 +11,8 @@ class DndToCatsoop:
         '''
         l2d = LatexToDragDrop instance
         '''
-        ofn = l2d.fnpre + ".md"
+        ofn = l2d.wpath(l2d.fnpre + ".md")
+        self.ofn = ofn
         xmlfn = l2d.xmlfn
         clean_fn = l2d.fnpre.replace(' ', '_')
         clean_fn = clean_fn.replace('.', '_')
@@ -21,8 +23,7 @@ class DndToCatsoop:
         md += 'csq_name = """%s"""\n' % clean_fn
         md += 'csq_nsubmits = %s\n' % l2d.options.get('nsubmits', 10)
         md += "</question>\n"
-        with open(ofn, 'w') as fp:
-            fp.write(md)
+        write_if_changed(ofn, md)
         print("Wrote %s lines of markdown to %s for catsoop" % (len(md.split('\n')), ofn))
 
     def make_drag_and_drop(self, xmlfn, check_fn=None):
@@ -11,6 +11,7 @@ import sys
 import re
 import string
 from collections import OrderedDict
+from .fileutil import write_if_changed
 
 class DNDlabel(object):
     '''
@@ -233,10 +234,10 @@ class DNDspec2tex(object):
         # output latex
         if not output_fp:
             ofn = sfn.replace('.dndspec', '.tex')
-            output_fp = open(ofn, 'w')
+            write_if_changed(ofn, self.dnd_tex)
         else:
             ofn = "output_fp"
-        output_fp.write(self.dnd_tex)
+            output_fp.write(self.dnd_tex)
 
         if self.verbose:
             print("Wrote dnd tex to %s" % ofn)
@@ -0,0 +1,110 @@
+'''
+Structured progress events: one JSON object per line (NDJSON), e.g.
+
+    {"time": 1700000000.123, "event": "stage_finished", "job": "quadratic", "stage": "latex", "seconds": 1.52}
+
+Events:
+
+    job_queued		job
+    job_started		job
+    stage_started	job, stage
+    stage_finished	job, stage, seconds
+    artifact_written	job, path, bytes
+    test_result		job, test, etype, ok
+    error		job, error
+    job_finished	job, status, seconds
+
+Each event is written with a single write() call on an unbuffered file
+descriptor, so events from parallel build processes sharing the descriptor are
+not interleaved within a line.  Only processes started by fork share the
+descriptor; builds in pool processes started otherwise (spawn or forkserver,
+e.g. the default on macOS) record their events with an EventRecorder, and the
+parent writes them when each build finishes.
+'''
+
+import os
+import sys
+import json
+import time
+
+class EventStream(object):
+    '''
+    Writer of NDJSON events to a file descriptor.  fields = fields included in every event.
+    '''
+    def __init__(self, fd, **fields):
+        self.fd = fd
+        self.fields = fields
+
+    def bind(self, **fields):
+        '''
+        Return EventStream writing to the same descriptor, with additional fields in every event
+        '''
+        allfields = dict(self.fields)
+        allfields.update(fields)
+        return EventStream(self.fd, **allfields)
+
+    def emit(self, event, **fields):
+        self.write_lines([event_line(event, self.fields, fields)])
+
+    def write_lines(self, lines):
+        '''
+        Write event lines (e.g. recorded by an EventRecorder), one write() call each
+        '''
+        for line in lines:
+            os.write(self.fd, line.encode('utf8'))
+
+class EventRecorder(object):
+    '''
+    Event stream keeping the event lines in memory (in self.lines, shared with the streams made by
+    bind), for a parent process to write later with write_lines
+    '''
+    def __init__(self, lines=None, **fields):
+        self.lines = [] if lines is None else lines
+        self.fields = fields
+
+    def bind(self, **fields):
+        allfields = dict(self.fields)
+        allfields.update(fields)
+        return EventRecorder(self.lines, **allfields)
+
+    def emit(self, event, **fields):
+        self.lines.append(event_line(event, self.fields, fields))
+
+class NullEvents(object):
+    '''
+    Event stream which discards all events
+    '''
+    def bind(self, **fields):
+        return self
+
+    def emit(self, event, **fields):
+        pass
+
+    def write_lines(self, lines):
+        pass
+
+def event_line(event, *fieldsets):
+    '''
+    Return NDJSON line (str) for event, with the fields in the dicts fieldsets
+    '''
+    data = {'time': round(time.time(), 3), 'event': event}
+    for fields in fieldsets:
+        data.update(fields)
+    return json.dumps(data, default=str) + '\n'
+
+def open_event_stream(fmt, fd=1):
+    '''
+    Return event stream for the --events and --events-fd command line options.  When events go
+    to stdout, all other output (including that of subprocesses) is sent to stderr instead, so
+    that stdout carries only events.
+    '''
+    if not fmt:
+        return NullEvents()
+    if fmt != "ndjson":
+        raise ValueError("Unknown event format %s (use ndjson)" % fmt)
+    if fd == 1:
+        sys.stdout.flush()
+        fd = os.dup(1)
+        os.dup2(2, 1)
+        sys.stdout = sys.stderr
+    return EventStream(fd)
@@ -0,0 +1,293 @@
+'''
+Atomic output file writes, which leave unchanged files alone.
+
+Outputs are first written to a temporary file in the destination directory,
+then compared with the existing file.  Identical files are not touched (so
+their mtime is preserved, and rsync / make see no change); changed files are
+renamed into place, so readers never observe a partially written file.
+
+Builds sharing an output directory coordinate through a per-problem OutputLock,
+and only ever clean up files recorded as theirs in an OwnedFiles record.
+'''
+
+import os
+import json
+import asyncio
+import time
+import uuid
+import shutil
+import filecmp
+import tempfile
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+def temp_name_for(fn):
+    '''
+    Return a unique temporary filename in the same directory as fn
+    '''
+    dn, bn = os.path.split(fn)
+    return os.path.join(dn, '.%s.%s.tmp' % (bn, uuid.uuid4().hex[:12]))
+
+def files_equal(fn1, fn2):
+    '''
+    Return True if files fn1 and fn2 both exist and have the same contents
+    '''
+    if not (os.path.exists(fn1) and os.path.exists(fn2)):
+        return False
+    return filecmp.cmp(fn1, fn2, shallow=False)
+
+def replace_if_changed(srcfn, fn):
+    '''
+    Atomically move srcfn to fn, unless fn already has the same contents, in which
+    case fn is left alone.  srcfn is removed in either case.
+    Return True if fn was replaced.
+    '''
+    if files_equal(srcfn, fn):
+        os.unlink(srcfn)
+        return False
+    os.replace(srcfn, fn)
+    return True
+
+def write_if_changed(fn, data):
+    '''
+    Atomically write data (str or bytes) to fn, unless fn already has exactly that content.
+    Return True if fn was written.
+    '''
+    if not isinstance(data, bytes):
+        data = data.encode('utf8')
+    if os.path.exists(fn) and os.path.getsize(fn) == len(data):
+        with open(fn, 'rb') as fp:
+            if fp.read() == data:
+                return False
+    tmpfn = temp_name_for(fn)
+    try:
+        with open(tmpfn, 'xb') as fp:
+            fp.write(data)
+        os.replace(tmpfn, fn)
+    except Exception:
+        if os.path.exists(tmpfn):
+            os.unlink(tmpfn)
+        raise
+    return True
+
+class OutputSnapshot(object):
+    '''
+    Snapshot of the output files of a build (files in dirs with names starting with one of
+    prefixes), so that a failed build can be rolled back: files it created are removed, and
+    files it replaced or removed are restored.
+
+    Existing files are hardlinked (or, where that fails, copied) into a hidden backup
+    directory.  Hardlinks are cheap and safe here, since outputs are always replaced by
+    rename, never rewritten in place.
+    '''
+    def __init__(self, dirs, prefixes):
+        self.dirs = sorted(set(os.path.abspath(dn) for dn in dirs))
+        self.prefixes = tuple(prefixes)
+        self.backup_dir = tempfile.mkdtemp(prefix='.latex2dnd_snapshot_', dir=self.dirs[0])
+        self.files = {}
+        for k, fn in enumerate(self.matching()):
+            bfn = os.path.join(self.backup_dir, str(k))
+            try:
+                os.link(fn, bfn)
+            except OSError:
+                shutil.copy2(fn, bfn)
+            self.files[fn] = bfn
+
+    def matching(self):
+        fns = []
+        for dn in self.dirs:
+            for bn in sorted(os.listdir(dn)):
+                fn = os.path.join(dn, bn)
+                if bn.startswith(self.prefixes) and os.path.isfile(fn):
+                    fns.append(fn)
+        return fns
+
+    def rollback(self):
+        '''
+        Restore the output files to their state when the snapshot was taken
+        '''
+        for fn in self.matching():
+            if fn not in self.files:
+                os.unlink(fn)
+        for fn, bfn in self.files.items():
+            if os.path.exists(fn) and (os.path.samefile(fn, bfn) or files_equal(fn, bfn)):
+                continue
+            os.replace(bfn, fn)
+        self.discard()
+
+    def discard(self):
+        '''
+        Keep the current output files, and remove the backup
+        '''
+        shutil.rmtree(self.backup_dir, ignore_errors=True)
+
+class OutputLock(object):
+    '''
+    Advisory lock on a problem's outputs in an output directory, held with flock (or msvcrt.locking
+    on Windows) on a lock file there.  Builds of the same problem into the same directory wait for
+    each other; builds of other problems are not affected.  Use as a context manager, or in coroutines
+    as an asynchronous context manager (async with).
+
+    The lock file is removed on release (with flock; not on Windows, where an open file cannot be
+    removed).  A build which was waiting on the removed file, and then gets the lock on it, sees that
+    the file is no longer the one at fn, and locks that instead, so two builds never each hold a lock,
+    on different files.
+    '''
+    def __init__(self, fn, timeout=None, poll=0.1, verbose=False):
+        '''
+        fn = lock filename
+        timeout = seconds to wait for the lock (None = wait indefinitely); LockTimeout is raised after that
+        '''
+        self.fn = fn
+        self.timeout = timeout
+        self.poll = poll
+        self.verbose = verbose
+        self.fp = None
+        self.waiting = False
+
+    def try_lock(self):
+        try:
+            if fcntl is not None:
+                fcntl.flock(self.fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                self.fp.seek(0)
+                msvcrt.locking(self.fp.fileno(), msvcrt.LK_NBLCK, 1)
+        except (IOError, OSError):
+            return False
+        if fcntl is not None and not self.is_current():
+            self.fp.close()			# removed by the build which held it
+            self.fp = open(self.fn, 'a+')
+            return self.try_lock()
+        return True
+
+    def is_current(self):
+        '''
+        Return True if the open lock file is (still) the file at self.fn
+        '''
+        try:
+            st = os.stat(self.fn)
+        except FileNotFoundError:
+            return False
+        fst = os.fstat(self.fp.fileno())
+        return (st.st_dev, st.st_ino) == (fst.st_dev, fst.st_ino)
+
+    def acquire(self):
+        start = self.start_waiting()
+        while not self.try_lock():
+            self.check_waiting(start)
+            time.sleep(self.poll)
+        return self.locked_now()
+
+    async def acquire_async(self):
+        '''
+        Acquire the lock from a coroutine: waits with asyncio.sleep, so the event loop (and other builds
+        on it, even of the same problem) keep running meanwhile
+        '''
+        start = self.start_waiting()
+        while not self.try_lock():
+            self.check_waiting(start)
+            await asyncio.sleep(self.poll)
+        return self.locked_now()
+
+    def start_waiting(self):
+        self.fp = open(self.fn, 'a+')
+        self.waiting = False
+        return time.time()
+
+    def check_waiting(self, start):
+        '''
+        Called while the lock is held by another build: report waiting, and raise LockTimeout after timeout
+        '''
+        if not self.waiting:
+            self.waiting = True
+            print("[latex2dnd] Waiting for another build to finish writing outputs (lock %s)" % self.fn)
+        if self.timeout is not None and time.time() - start > self.timeout:
+            self.fp.close()
+            self.fp = None
+            raise LockTimeout("Timed out after %s sec waiting for lock %s" % (self.timeout, self.fn))
+
+    def locked_now(self):
+        self.fp.seek(0)
+        self.fp.truncate()
+        self.fp.write("%d\n" % os.getpid())		# holder, for diagnostics
+        self.fp.flush()
+        return self
+
+    def release(self):
+        if self.fp is None:
+            return
+        if fcntl is not None:
+            try:
+                os.unlink(self.fn)		# while still locked: see the class docstring
+            except FileNotFoundError:
+                pass
+            fcntl.flock(self.fp.fileno(), fcntl.LOCK_UN)
+        else:
+            self.fp.seek(0)
+            msvcrt.locking(self.fp.fileno(), msvcrt.LK_UNLCK, 1)
+        self.fp.close()
+        self.fp = None
+
+    @property
+    def locked(self):
+        return self.fp is not None
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc):
+        self.release()
+
+    async def __aenter__(self):
+        return await self.acquire_async()
+
+    async def __aexit__(self, *exc):
+        self.release()
+
+class LockTimeout(Exception):
+    pass
+
+class OwnedFiles(object):
+    '''
+    Record, in a small JSON file, of the output files which a problem's builds wrote in an output
+    directory.  Cleanup of old outputs only removes files in this record, never files which
+    merely match a filename pattern, so outputs written by anything else are left alone.
+    Update it only while holding the problem's OutputLock.
+    '''
+    def __init__(self, fn):
+        self.fn = fn
+        self.dir = os.path.dirname(os.path.abspath(fn))
+        self.files = set()
+        if os.path.exists(fn):
+            with open(fn) as fp:
+                try:
+                    self.files = set(json.load(fp).get('files', []))
+                except ValueError:
+                    pass			# damaged record; files in it are no longer deleted
+
+    def key(self, fn):
+        return os.path.relpath(os.path.abspath(fn), self.dir).replace(os.sep, '/')
+
+    def owns(self, fn):
+        return self.key(fn) in self.files
+
+    def add(self, fns):
+        self.files.update(self.key(fn) for fn in fns)
+
+    def remove(self, fn):
+        '''
+        Delete owned file fn, and drop it from the record
+        '''
+        if os.path.exists(fn):
+            os.unlink(fn)
+        self.files.discard(self.key(fn))
+
+    def save(self):
+        '''
+        Write the record, dropping files which no longer exist
+        '''
+        self.files = set(x for x in self.files if os.path.exists(os.path.join(self.dir, x)))
+        write_if_changed(self.fn, json.dumps({'files': sorted(self.files)}, indent=4))
@@ -5,6 +5,7 @@ Handle DDformula script testing
 import imp
 import sys
 import json
+import random
 
 def import_from_string(codestr, name='codestr'):
     """Import a module from a specified string.
@@ -19,34 +20,49 @@ class FormulaTester(object):
     '''
     Evaluate python script for DDformula answer checking, and perform unit tests on it.
     '''
-    def __init__(self, check_code, box_answers, unit_tests):
+    def __init__(self, check_code, box_answers, unit_tests, seed=None, max_tests=None):
         '''
         check_code = string with python script code for customresponse
         box_answers = expected correct answer dict with keys = target_id, values = draggable_id
         unit_tests = list of dicts with etype (expected answer type) and target_assignments for tests
+        seed = if not None, seed for the random numbers used in formula sampling, set before each test,
+               so that test results are reproducible
+        max_tests = if not None, run only this many tests (the answer key test first), for quick draft builds
 
         Note that an draggable_id may appear with multiple target_id keys.  
         Each target_id is unique, though.
         '''
         check_code = check_code.replace('from calc import evaluator', 'from latex2dnd.calc import evaluator')
         self.code = check_code
+        self.seed = seed
         self.env = {}
         try:
             self.mod = import_from_string(check_code)
         except Exception as err:
             sys.stderr.write("Failed to evaluate DDformula script code!  Err=%s\n" % (str(err)))
             sys.exit(0)
+        # private random number generator for formula sampling, so that concurrent testers
+        # (e.g. in threads) neither share nor disturb each other's random state
+        self.random = random.Random()
+        if hasattr(self.mod, 'random'):
+            self.mod.random = self.random
         for ut in unit_tests:
             ut['expected_ans'] = self.make_expected_ans(ut['target_assignments'])
         self.unit_tests = [{'etype': 'correct', 'expected_ans': self.make_expected_ans(box_answers) }]
         self.unit_tests += unit_tests
+        self.num_tests = len(self.unit_tests)
+        if max_tests is not None:
+            self.unit_tests = self.unit_tests[:max(1, max_tests)]
 
     def make_expected_ans(self, target_assignments):
         return [ {draggable_id: target_id} for target_id, draggable_id in list(target_assignments.items()) ]
 
     def run_tests(self):
         cnt = 0
-        print("---------- Running %d DD formula unit tests ----------" % len(self.unit_tests))
+        if len(self.unit_tests) < self.num_tests:
+            print("---------- Running %d of %d DD formula unit tests ----------" % (len(self.unit_tests), self.num_tests))
+        else:
+            print("---------- Running %d DD formula unit tests ----------" % len(self.unit_tests))
         self.test_results = []
         for ut in self.unit_tests:
             cnt += 1
@@ -67,6 +83,8 @@ class FormulaTester(object):
         '''
         assert etype=="correct" or etype=="incorrect"
         ret = None
+        if self.seed is not None:
+            self.random.seed(self.seed)
         try:
             ret = self.mod.dnd_check_function(None, json.dumps(expected_ans))
         except Exception as err:
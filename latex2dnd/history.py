@@ -0,0 +1,129 @@
+'''
+Build timing history: a small local SQLite database of per-problem build times,
+with the time spent in each stage (latex, images, xml, ...).
+
+Batch builds record every problem's timings, and use the history to schedule
+the historically slowest problems first (longest processing time first), which
+shortens parallel builds, and to estimate when the build will be done.
+'''
+
+import time
+import sqlite3
+from collections import OrderedDict
+
+from .shard import problem_key
+
+class BuildHistory(object):
+    '''
+    SQLite database of build timings.  Problems are keyed by their path relative to
+    the current directory (see latex2dnd.shard.problem_key).
+    '''
+    def __init__(self, fn, nrecent=5):
+        '''
+        fn = database filename (created if missing)
+        nrecent = number of recent successful builds of a problem averaged for its expected build time
+        '''
+        self.fn = fn
+        self.nrecent = nrecent
+        self.db = sqlite3.connect(fn, timeout=30)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS builds (id INTEGER PRIMARY KEY, problem TEXT,
+                           status TEXT, seconds REAL, finished REAL)''')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS stages (build_id INTEGER, stage TEXT, seconds REAL)''')
+        self.db.execute('''CREATE INDEX IF NOT EXISTS builds_problem ON builds (problem)''')
+        self.db.commit()
+
+    def record(self, problem, status, seconds, stages=None):
+        '''
+        Record a build of problem; stages = dict with key = stage name, val = seconds
+        '''
+        cur = self.db.execute('INSERT INTO builds (problem, status, seconds, finished) VALUES (?, ?, ?, ?)',
+                              (problem_key(problem), status, seconds, time.time()))
+        self.db.executemany('INSERT INTO stages (build_id, stage, seconds) VALUES (?, ?, ?)',
+                            [(cur.lastrowid, stage, secs) for stage, secs in (stages or {}).items()])
+        self.db.commit()
+
+    def expected_seconds(self, problem):
+        '''
+        Return mean build time of the recent successful builds of problem, or None if there are none
+        '''
+        rows = self.db.execute('''SELECT seconds FROM builds WHERE problem = ? AND status = 'ok'
+                                  ORDER BY finished DESC LIMIT ?''', (problem_key(problem), self.nrecent)).fetchall()
+        if not rows:
+            return None
+        return sum(row[0] for row in rows) / len(rows)
+
+    def costs(self, problems):
+        '''
+        Return dict with key = problem key, val = expected build seconds, for the problems with history
+        '''
+        costs = {}
+        for problem in problems:
+            secs = self.expected_seconds(problem)
+            if secs is not None:
+                costs[problem_key(problem)] = secs
+        return costs
+
+    def stage_seconds(self, problem):
+        '''
+        Return OrderedDict with key = stage, val = mean seconds, over the recent successful builds of problem
+        '''
+        rows = self.db.execute('''SELECT stage, AVG(stages.seconds) FROM stages WHERE build_id IN
+                                  (SELECT id FROM builds WHERE problem = ? AND status = 'ok'
+                                   ORDER BY finished DESC LIMIT ?)
+                                  GROUP BY stage ORDER BY stage''', (problem_key(problem), self.nrecent)).fetchall()
+        return OrderedDict(rows)
+
+    def close(self):
+        self.db.close()
+
+def longest_first(problems, costs):
+    '''
+    Return problems ordered by decreasing expected build time (costs = dict with key = problem key,
+    val = seconds).  Problems without history count as the mean; ties keep their order.
+    '''
+    if not costs:
+        return list(problems)
+    default_cost = sum(costs.values()) / len(costs)
+    return sorted(problems, key=lambda x: -costs.get(problem_key(x), default_cost))
+
+class Progress(object):
+    '''
+    Track progress of a batch build, and estimate the time left, from the expected build
+    time of each problem (from history), or the mean build time so far.
+    '''
+    def __init__(self, problems, costs, jobs=1):
+        self.problems = problems
+        self.costs = dict(costs)
+        self.jobs = jobs
+        self.done = set()
+        self.seconds = []
+
+    def expected(self, problem):
+        key = problem_key(problem)
+        if key in self.costs:
+            return self.costs[key]
+        known = self.seconds or list(self.costs.values())
+        return sum(known) / len(known) if known else None
+
+    def finished(self, problem, seconds):
+        self.done.add(problem)
+        self.seconds.append(seconds)
+
+    def seconds_left(self):
+        '''
+        Return estimated seconds until all problems are built, or None if unknown
+        '''
+        left = [self.expected(problem) for problem in self.problems if problem not in self.done]
+        if None in left:
+            return None
+        return sum(left) / max(1, min(self.jobs, len(left)))
+
+    def report(self):
+        '''
+        Return progress message, e.g. "3/10 done, ETA 14:05:12 (in 42 sec)"
+        '''
+        msg = "%d/%d done" % (len(self.done), len(self.problems))
+        left = self.seconds_left()
+        if left is not None and len(self.done) < len(self.problems):
+            msg += ", ETA %s (in %d sec)" % (time.strftime("%H:%M:%S", time.localtime(time.time() + left)), left)
+        return msg
@@ -0,0 +1,95 @@
+'''
+Checkpoint journal for batch builds: one JSON line per completed problem, with a
+hash of its inputs and its result, appended (and flushed to disk) as each build
+finishes.  If a batch build dies partway, latex2dnd batch --resume skips the
+problems which were built successfully and whose inputs are unchanged.
+'''
+
+import os
+import json
+import time
+import hashlib
+from collections import OrderedDict
+
+from .shard import problem_key
+from .deps import dependencies_unchanged
+
+# build options which do not change the outputs
+NON_OUTPUT_OPTIONS = ['verbose', 'imverbose', 'remote_cache', 'lock_timeout']
+
+def input_hash(problem, options):
+    '''
+    Return hash of the inputs of a problem build: its source file, and the build options
+    (dict of LatexToDragDrop keyword arguments).
+    '''
+    sha = hashlib.sha256()
+    with open(problem, 'rb') as fp:
+        sha.update(fp.read())
+    options = dict((k, v) for k, v in options.items() if k not in NON_OUTPUT_OPTIONS)
+    sha.update(json.dumps(options, sort_keys=True, default=str).encode('utf8'))
+    return sha.hexdigest()
+
+class BuildJournal(object):
+    '''
+    Append-only journal of completed problem builds (JSON lines)
+    '''
+    def __init__(self, fn, resume=False):
+        '''
+        fn = journal filename
+        resume = keep (and load) the existing journal; otherwise a new journal is started, replacing
+                 the existing one when the first build is recorded (so that a run which records
+                 nothing, e.g. is interrupted at once, can still be resumed from the old journal)
+        '''
+        self.fn = fn
+        self.entries = OrderedDict()
+        self.started = resume		# False until the existing journal is replaced
+        if resume:
+            self.load()
+
+    def load(self):
+        '''
+        Load the entries of the journal; a truncated last line (from a crash) is ignored
+        '''
+        if not os.path.exists(self.fn):
+            return
+        with open(self.fn) as fp:
+            for line in fp:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                self.entries[entry['problem']] = entry
+
+    def append(self, problem, ihash, result):
+        '''
+        Record the result (dict, from build_problem) of building problem, with input hash ihash
+        '''
+        entry = OrderedDict([('problem', problem_key(problem)), ('input_hash', ihash), ('finished', time.time())])
+        entry.update(result)
+        line = json.dumps(entry) + '\n'
+        if self.started and os.path.exists(self.fn) and os.path.getsize(self.fn):
+            with open(self.fn, 'rb') as fp:
+                fp.seek(-1, os.SEEK_END)
+                if fp.read() != b'\n':
+                    line = '\n' + line		# after a truncated line, from a crash
+        with open(self.fn, 'a' if self.started else 'w') as fp:
+            fp.write(line)
+            fp.flush()
+            os.fsync(fp.fileno())
+        self.started = True
+        self.entries[entry['problem']] = entry
+
+    def completed(self, problem, ihash):
+        '''
+        Return the journal entry for problem if it was built successfully from inputs with hash ihash,
+        none of the dependencies recorded by that build changed, and all its artifacts still exist;
+        else return None
+        '''
+        entry = self.entries.get(problem_key(problem))
+        if entry is None or entry['status'] != 'ok' or entry['input_hash'] != ihash:
+            return None
+        if not all(os.path.exists(fn) for fn in entry['artifacts']):
+            return None
+        if not dependencies_unchanged(entry.get('dependencies', {})):
+            return None
+        return entry
@@ -24,10 +24,16 @@ import os
 import sys
 import re
 import json
+import time
+import contextlib
 import optparse
 import random
 import string
 import glob
+import shutil
+import tempfile
+import subprocess
+from shlex import quote
 try:
     from path import path
 except:
@@ -37,14 +43,28 @@ from collections import OrderedDict
 from .formula import FormulaTester
 from .dndspec import DNDspec2tex
 from .dnd2catsoop import DndToCatsoop
+from .remote import open_store
+from .store import ArtifactStore, LabelCache, preamble_hash_for_tex, sha256_file, sha256_bytes
+from .deps import recorded_dependencies, scan_dependencies, dependency_hashes
+from .pngutil import strip_png_metadata
+from .fileutil import write_if_changed, replace_if_changed, temp_name_for, OutputLock, OwnedFiles
+from .manifest import BuildManifest
+from .olx import CourseArchive, course_image_dir, DEFAULT_IMAGE_URL
+from .events import NullEvents, open_event_stream
 
 class PageImage(object):
     '''
     Grab page of PDF, convert to PNG, and get HighRes BoundingBox for image
+
+    Each step is a shell command (made by a *_cmd method) whose output is parsed
+    separately, so the same steps can also be run asynchronously (see aio.AsyncPageImage).
     '''
-    def __init__(self, fn, page=1, imfn=None, pdfimfn=None, dpi=300, verbose=False):
+    def __init__(self, fn, page=1, imfn=None, pdfimfn=None, dpi=300, verbose=False, run=True, timed=None):
         '''
         fn = filename
+        run = (bool) False to only set up filenames, without running any tools
+        timed = function returning a context which times the named stage (crop or rasterize), e.g.
+                LatexToDragDrop.timed
         '''
         if fn.endswith('.pdf'):
             fnpre = fn[:-4]
@@ -55,27 +75,62 @@ class PageImage(object):
         if imfn is None:
             imfn = fnpre + "_image.png"
         self.verbose = verbose
+        self.fn = fn
+        self.page = page
+        self.pdfimfn = pdfimfn
+        self.imfn = imfn
+        self.timed = timed or (lambda stage: contextlib.nullcontext())
+        if not run:
+            return
 
-        # get page from PDF
-        cmd = "pdfseparate -l %s -f %s %s tmp.pdf" % (page, page, fn)
-        if verbose:
+        # get page from PDF, into a temporary file unique to this page image
+        tmpfn = temp_name_for(pdfimfn) + ".pdf"
+        try:
+            with self.timed('crop'):
+                cmd = self.separate_cmd(tmpfn)
+                self.run_tool(cmd)
+                self.check_output_file(tmpfn, cmd, "pdfseparate")
+
+                # crop the file, verbosely, to get the bounding box
+                cmd = self.crop_cmd(tmpfn)
+                try:
+                    bbstr = self.tool_output(cmd)
+                except Exception as err:
+                    print("===> [latex2dnd] error running pdfcrop, command: %s" % cmd)
+                    print("Error: ", err)
+                    raise
+        finally:
+            if os.path.exists(tmpfn):
+                os.unlink(tmpfn)
+        self.set_bounding_box(bbstr, cmd)
+        self.render(dpi)
+
+    def run_tool(self, cmd):
+        if self.verbose:
             print(cmd)
         os.system(cmd)
-        if not os.path.exists("tmp.pdf"):
-            raise Exception("===> [latex2dnd] error running pdfseparate, command: %s" % cmd)
 
-        # crop the file, verbosely, to get the bounding box
-        cmd = 'pdfcrop --verbose tmp.pdf %s' % (pdfimfn)
-        if verbose:
+    def tool_output(self, cmd):
+        if self.verbose:
             print(cmd)
-        try:
-            with os.popen(cmd) as cfp:
-                bbstr = cfp.read()
-        except Exception as err:
-            print("===> [latex2dnd] error running pdfcrop, command: %s" % cmd)
-            print("Error: ", err)
-            raise
+        with os.popen(cmd) as fp:
+            return fp.read()
+
+    @staticmethod
+    def check_output_file(fn, cmd, tool):
+        if not os.path.exists(fn):
+            raise Exception("===> [latex2dnd] error running %s, command: %s" % (tool, cmd))
+
+    def separate_cmd(self, tmpfn):
+        return "pdfseparate -l %s -f %s %s %s" % (self.page, self.page, quote(self.fn), quote(tmpfn))
+
+    def crop_cmd(self, tmpfn):
+        return 'pdfcrop --verbose %s %s' % (quote(tmpfn), quote(self.pdfimfn))
 
+    def set_bounding_box(self, bbstr, cmd):
+        '''
+        Set self.hrbb from the pdfcrop output bbstr
+        '''
         try:
             hrbb_str = re.findall('HiResBoundingBox:([^\n]+)', bbstr)[0].split()
         except Exception as err:
@@ -87,29 +142,36 @@ class PageImage(object):
         def pt2in(x):
             return float(x) * 1.0/72
 
-        hrbb = list(map(pt2in, hrbb_str))
+        self.hrbb = list(map(pt2in, hrbb_str))
 
-        if verbose:
-            print("BoundingBox (inches): %s" % hrbb)
+        if self.verbose:
+            print("BoundingBox (inches): %s" % self.hrbb)
 
-        self.fn = fn
-        self.pdfimfn = pdfimfn
-        self.imfn = imfn
-        self.hrbb = hrbb
+    def render(self, dpi):
+        '''
+        Generate PNG from the cropped PDF, at the specified dpi.
+        This may be called again to re-rasterize the page at a different resolution,
+        without re-running pdfseparate and pdfcrop.
+        '''
+        with self.timed('rasterize'):
+            self.run_tool(self.render_cmd(dpi))
+        self.dpi = dpi
+        self.set_size(self.tool_output(self.size_cmd()))
 
-        # generate PNG from cropped PDF
-        cmd = "pdftoppm -r %s -png %s > %s" % (dpi, pdfimfn, imfn)
-        if verbose:
-            print(cmd)
-        os.system(cmd)
-        
-        # get png image size
-        # file mytest1.png
-        # mytest1.png: PNG image data, 2550 x 3301, 8-bit/color RGB, non-interlaced
+    def render_cmd(self, dpi):
+        return "pdftoppm -r %s -png %s > %s" % (dpi, quote(self.pdfimfn), quote(self.imfn))
 
-        with os.popen('file %s' % imfn) as ifp:
-            imdat = ifp.read().split()[4:7]
-        if verbose:
+    def size_cmd(self):
+        return 'file %s' % quote(self.imfn)
+
+    def set_size(self, fileinfo):
+        '''
+        Set self.sizex, self.sizey from the output of the file command, which is like:
+
+        mytest1.png: PNG image data, 2550 x 3301, 8-bit/color RGB, non-interlaced
+        '''
+        imdat = fileinfo.split(': ', 1)[-1].split()[3:6]
+        if self.verbose:
             print(imdat)
         imx = int(imdat[0])
         imy = int(imdat[2][:-1])
@@ -117,34 +179,15 @@ class PageImage(object):
         self.sizex = imx
         self.sizey = imy
 
-    def NegateBox(self, box, outfn=None):
-        '''
-        Negate image area where box is positioned.
-        '''
+    def negate_cmd(self, box, outfn):
         # make sure box is set for context of this image
         box.offset_by_bb(self.hrbb) 
         geom = box.png_geom(self.sizex, self.sizey)
-        
-        if outfn is None:
-            outfn = self.imfn
-
-        cmd = 'convert {imfn} -region {geom} -negate {outfn}'.format(imfn=self.imfn, 
-                                                                     geom=geom,
-                                                                     outfn=outfn)
-        if self.verbose:
-            print(cmd)
-        os.system(cmd)
-        if not os.path.exists(outfn):
-            raise Exception("===> [latex2dnd] error running convert, command: %s" % cmd)
-        
-    def WhiteBox(self, boxes, outfn=None):
-        '''
-        White-out image area where box is positioned.
-        Process multiple boxes together.
-        '''
-        if outfn is None:
-            outfn = self.imfn
+        return 'convert {imfn} -region {geom} -negate {outfn}'.format(imfn=quote(self.imfn), 
+                                                                      geom=geom,
+                                                                      outfn=quote(outfn))
 
+    def whitebox_cmd(self, boxes, outfn):
         if not isinstance(boxes, list):
             boxes = [ boxes ]
 
@@ -156,34 +199,48 @@ class PageImage(object):
 
             regions.append('-region {geom} -threshold -1 '.format(geom=geom))
 
-        cmd = 'convert {imfn} {regions} {outfn}'.format(imfn=self.imfn, 
-                                                        regions=' '.join(regions),
-                                                        outfn=outfn)
-        if self.verbose:
-            print(cmd)
-        os.system(cmd)
-        if not os.path.exists(outfn):
-            raise Exception("===> [latex2dnd] error running convert, command: %s" % cmd)
+        return 'convert {imfn} {regions} {outfn}'.format(imfn=quote(self.imfn), 
+                                                         regions=' '.join(regions),
+                                                         outfn=quote(outfn))
 
-    def ExtractBox(self, box, outfn=None):
-        '''
-        Extract image in boxed area
-        '''
+    def extract_cmd(self, box, outfn):
         # make sure box is set for context of this image
         box.offset_by_bb(self.hrbb) 
         geom = box.png_geom(self.sizex, self.sizey, delta=4.5)
+        return 'convert {imfn} -crop {geom} {outfn}'.format(imfn=quote(self.imfn), 
+                                                            geom=geom,
+                                                            outfn=quote(outfn))
+
+    def NegateBox(self, box, outfn=None):
+        '''
+        Negate image area where box is positioned.
+        '''
+        if outfn is None:
+            outfn = self.imfn
+        cmd = self.negate_cmd(box, outfn)
+        self.run_tool(cmd)
+        self.check_output_file(outfn, cmd, "convert")
         
+    def WhiteBox(self, boxes, outfn=None):
+        '''
+        White-out image area where box is positioned.
+        Process multiple boxes together.
+        '''
         if outfn is None:
-            outfn = self.imfn[:-4] + '_extract.png'
+            outfn = self.imfn
+        cmd = self.whitebox_cmd(boxes, outfn)
+        self.run_tool(cmd)
+        self.check_output_file(outfn, cmd, "convert")
 
-        cmd = 'convert {imfn} -crop {geom} {outfn}'.format(imfn=self.imfn, 
-                                                           geom=geom,
-                                                           outfn=outfn)
-        if self.verbose:
-            print(cmd)
-        os.system(cmd)
-        if not os.path.exists(outfn):
-            raise Exception("===> [latex2dnd] error running convert, command: %s" % cmd)
+    def ExtractBox(self, box, outfn=None):
+        '''
+        Extract image in boxed area
+        '''
+        if outfn is None:
+            outfn = self.imfn[:-4] + '_extract.png'
+        cmd = self.extract_cmd(box, outfn)
+        self.run_tool(cmd)
+        self.check_output_file(outfn, cmd, "convert")
 
         
 class Box(object):
@@ -264,6 +321,52 @@ class Box(object):
         return geom
 
 
+class DpiSearch(object):
+    '''
+    Search for the highest dpi at which the images fit within a byte budget, given the
+    image size at a starting dpi which is too large.
+
+    PNG size grows roughly with the pixel area, i.e. with dpi^2, so that is used to
+    guess a DPI which fits; the guess is then refined by bisection, with a few renders.
+    '''
+    def __init__(self, dpi, nbytes, budget, min_dpi=20, max_trials=8):
+        self.dpi = dpi			# last dpi tried
+        self.nbytes = nbytes		# image bytes at the last dpi tried
+        self.budget = budget
+        self.min_dpi = min_dpi
+        self.max_trials = max_trials
+        self.trials = 0
+        self.fail_dpi = dpi		# lowest dpi known to exceed the budget
+        self.fit_dpi = None		# highest dpi known to fit within the budget
+        self.done = False
+
+    def next_dpi(self):
+        '''
+        Return next dpi to try, or None if the search is done
+        '''
+        if self.done or self.trials >= self.max_trials:
+            return None
+        if self.fit_dpi is None:
+            dpi = int(self.dpi * (1.0 * self.budget / self.nbytes) ** 0.5 * 0.95)
+            return max(self.min_dpi, min(dpi, self.fail_dpi - 1))
+        return (self.fit_dpi + self.fail_dpi) // 2
+
+    def record(self, dpi, nbytes):
+        '''
+        Record that the images take nbytes at dpi
+        '''
+        self.trials += 1
+        self.dpi = dpi
+        self.nbytes = nbytes
+        if nbytes <= self.budget:
+            self.fit_dpi = dpi
+        else:
+            self.fail_dpi = dpi
+            if dpi <= self.min_dpi:
+                self.done = True
+        if self.fit_dpi is not None and self.fail_dpi - self.fit_dpi <= 2:
+            self.done = True
+
 class LatexToDragDrop(object):
     '''
     Grab boxes from latex *.aux file, 
@@ -283,81 +386,188 @@ class LatexToDragDrop(object):
     def __init__(self, texfn, compile=True, verbose=True, dpi=300, imverbose=False, outdir='.',
                  can_reuse=False, custom_cfn=None, randomize_solution_filename=True, do_cleanup=False,
                  command_line_options_override=True,
-                 interactionmode=None):
+                 interactionmode=None, max_bytes=None, label_cache=None, dedup_dir=None,
+                 hash_filenames=None, reproducible=False, image_url=DEFAULT_IMAGE_URL, workdir=None, env=None,
+                 build=True, events=None, latex_log=False, remote_cache=None, single_latex_pass=False,
+                 max_formula_tests=None, lock_timeout=600):
         '''
         texfn = *.tex filename
+        max_bytes = byte budget for the dnd image plus labels; the DPI is lowered until the images fit.
+                    Use "image:N" to instead limit each image to N bytes.
+        label_cache = directory (or ArtifactStore) for a persistent cache of rendered label images
+        remote_cache = URL of a shared cache server (see latex2dnd.remote), behind the label cache
+        dedup_dir = directory (or ArtifactStore) in which each distinct output image is stored once;
+                    the output image files become hardlinks to those copies
+        hash_filenames = "sol" to name the solution image by a truncated hash of its contents (instead of
+                         a random string), or "all" to name all images that way
+        reproducible = (bool) True to make identical inputs give byte-identical outputs: pins the pdflatex
+                       date and the formula test random seed, strips PNG metadata, sorts JSON keys, and names
+                       the solution image by content hash (unless hash_filenames is specified)
+        image_url = base URL for images; the XML expects images to be in <image_url>/<name>/
+        workdir = directory in which pdflatex is run, and relative to which texfn and outdir are taken
+                  (default: the current directory).  Builds never change the current directory.
+        env = environment for the pdflatex runs (default: os.environ).  It is copied, and the
+              latex2dnd tex directory added to its TEXINPUTS, for this build only; os.environ is
+              not modified, so builds may run concurrently in threads.
+        build = (bool) True to run the whole build now; if False, nothing is done until build() (or
+                the individual stages, see DragDropBuilder) are called
+        events = EventStream (see latex2dnd.events) to which stage, artifact, and test result events are sent
+        latex_log = (bool) True to send the output of pdflatex to <name>_pdflatex.log, instead of stdout
+        single_latex_pass = (bool) True to run pdflatex once, instead of twice, when that is safe: the
+                            second run is skipped if the first left the *.aux file unchanged
+        max_formula_tests = if not None, run only this many of the formula unit tests (answer key test first)
+        lock_timeout = seconds to wait for another build of the problem to finish writing its outputs
+                       (see OutputLock), before giving up with LockTimeout; None to wait indefinitely
 
         command_line_options_override = (bool) True if provided parameers should override whatever is specified in the tex or dndspec file
         '''
         self.command_line_options_override = command_line_options_override
-        if compile:
-            # set the TEXINPUTS path
-            mydir = os.path.dirname(__file__)
-            oldti = os.environ.get('TEXINPUTS', "")
-            texpath = os.path.abspath(mydir + '/tex')
-            newti = "::%s" % texpath
-            if oldti:
-                newti += ":" + oldti
-            os.environ['TEXINPUTS'] = newti
-                
-            if verbose:
-                print("Setting TEXINPUTS=%s" % os.environ['TEXINPUTS'])
-                print("Running latex twice")
-                print("-"*77)
-            imstr = ""
-            if interactionmode:
-                imstr = "-interaction=%s" % interactionmode
-            # run pdflatex TWICE
-            for k in range(2):
-                os.system('pdflatex %s %s' % (imstr, texfn))
-            if verbose:
-                print("="*77)
+        self.workdir = path(os.path.abspath(workdir or os.getcwd()))
+        self.env = self.tool_environment(env, reproducible)
+        self.texfn = texfn
+        self.do_compile = compile
+        self.interactionmode = interactionmode
+        self.do_cleanup = do_cleanup
+        self.randomize_solution_filename = randomize_solution_filename
 
-        outdir = path(outdir)
+        outdir = self.wpath(outdir)
 
         if not os.path.exists(outdir):
             os.mkdir(outdir)
-        if not os.path.isdir(outdir):
-            print("Error: output directory '%s' is not a directory" % outdir)
-            return
 
         self.outdir = outdir
         self.max_image_width = 780
         self.options = {}
+        self.image_url = image_url
         self.test_results = {}
+        self.testsfn = None
+        self.tested_check_code = None
+        self.stage_times = OrderedDict()	# stage name -> seconds spent in it
+        self.dependencies = OrderedDict()	# filename -> sha256, see load_dependencies
+        self.events = events or NullEvents()
+        self.latex_log = latex_log
+        self.single_latex_pass = single_latex_pass
+        self.max_formula_tests = max_formula_tests
         self.verbose = verbose
         self.imverbose = imverbose
         self.options['can_reuse'] = can_reuse
         self.options['custom_cfn'] = custom_cfn
-        self.texfn = texfn
         self.fnpre = path(texfn[:-4])
-        self.pdffn = self.fnpre + '.pdf'
-        self.dndimfn = outdir / (self.fnpre + '_dnd.png')
-        self.solimfn = outdir / (self.fnpre + '_dnd_sol.png')
-        self.dpi = dpi
-        self.load_boxes()
-        self.load_dnd()
+        self.pdffn = self.wpath(self.fnpre + '.pdf')
 
-        if randomize_solution_filename:
-            randkey = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(6))
-            self.solimfn = outdir / (self.fnpre + '_dnd_sol_%s.png' % randkey)
-
-        # by convention, page 1 has the main drag-and-drop image,
-        # and page 2 has the labels, in individual boxes.
+        self.image_outdir = (outdir / self.fnpre).parent
+        self.dpi = dpi
+        self.max_bytes = max_bytes
+        self.min_dpi = 20
+        self.labelpi = None
+        self.cache_label_images = True		# False while searching for a DPI (see fit_images_to_byte_budget)
+        self.output_lock = OutputLock(self.image_outdir / ('.%s.latex2dnd.lock' % self.fnpre.basename()),
+                                      timeout=lock_timeout)
+
+        self.label_cache = None
+        if label_cache is not None or remote_cache is not None:
+            label_cache = open_store(label_cache, remote_cache, verbose=verbose)
+            mydir = os.path.dirname(__file__)
+            with open(os.path.abspath(mydir + '/tex/latex2dnd.tex')) as fp:
+                l2dtex = fp.read()
+            self.preamble_hash = preamble_hash_for_tex(self.wpath(self.texfn), extra=l2dtex)
+            self.label_cache = LabelCache(label_cache, self.preamble_hash, verbose=verbose)
+
+        self.dedup_store = None
+        if dedup_dir is not None:
+            if not isinstance(dedup_dir, ArtifactStore):
+                dedup_dir = ArtifactStore(dedup_dir, verbose=verbose)
+            self.dedup_store = dedup_dir
+
+        self.reproducible = reproducible
+        if reproducible and not hash_filenames:
+            hash_filenames = "sol"
+        self.hash_filenames = hash_filenames
+
+        if build:
+            self.build()
+
+    def build(self):
+        '''
+        Run all the stages of the build: compile latex, load boxes and labels, generate the
+        images, then the XML (which runs the formula tests).
+        '''
+        if self.do_compile:
+            with self.timed('latex'):
+                self.compile_latex()
+        if not os.path.isdir(self.outdir):
+            print("Error: output directory '%s' is not a directory" % self.outdir)
+            return
+        with self.timed('load'):
+            self.load_dependencies()
+            self.load_boxes()
+            self.load_dnd()
+        with self.output_lock:
+            with self.timed('images'):
+                self.generate_images()
+            self.generate_dnd_xml()
+            self.finish_build()
+
+    def owned_files(self):
+        '''
+        Return the OwnedFiles record of the outputs written by builds of this problem in the output directory
+        '''
+        return OwnedFiles(self.image_outdir / ('.%s_dnd.owned.json' % self.fnpre.basename()))
 
-        if do_cleanup:
-            self.cleanup_old_solution_image_files()
+    def load_dependencies(self):
+        '''
+        Set self.dependencies, an OrderedDict with key = filename, val = sha256 of contents, for the local
+        files the problem depends on: those pdflatex read, according to its recorder (*.fls) file, or (if
+        there is none) those found by scanning the tex file.  Local package and class files are included
+        in the label cache key, since they can change how labels are rendered.
+        '''
+        flsfn = self.wpath(self.fnpre + '.fls')
+        if os.path.exists(flsfn):
+            fns = recorded_dependencies(flsfn)
+        else:
+            fns = scan_dependencies(self.wpath(self.texfn))
+        self.dependencies = dependency_hashes(fns)
+        if self.label_cache is not None:
+            styles = [(os.path.basename(fn), sha) for fn, sha in self.dependencies.items()
+                      if os.path.splitext(fn)[1] in ['.sty', '.cls', '.def', '.cfg', '.fd', '.clo']]
+            if styles:
+                self.label_cache.preamble_hash = sha256_bytes(json.dumps([self.preamble_hash, styles]))
+        if self.verbose:
+            print("%d local dependencies" % len(self.dependencies))
+        return self.dependencies
 
-        self.generate_dnd_image()
-        self.generate_label_images(outdir)
-        self.generate_dnd_xml()
+    @contextlib.contextmanager
+    def timed(self, stage):
+        '''
+        Context adding the time spent in it to self.stage_times[stage] (seconds)
+        '''
+        start = time.time()
+        self.events.emit('stage_started', stage=stage)
+        try:
+            yield
+        finally:
+            seconds = time.time() - start
+            self.stage_times[stage] = round(self.stage_times.get(stage, 0) + seconds, 3)
+            self.events.emit('stage_finished', stage=stage, seconds=round(seconds, 3))
 
-        if do_cleanup and os.path.exists("tmp.pdf"):
-            os.unlink("tmp.pdf")
-            if verbose:
+    def finish_build(self):
+        '''
+        Remove leftover temporary files and images which the new XML no longer uses, and print
+        summary of the outputs.  Call only once the XML has been written.
+        '''
+        self.remove_old_images()
+        if self.do_cleanup and os.path.exists(self.wpath("tmp.pdf")):
+            os.unlink(self.wpath("tmp.pdf"))
+            if self.verbose:
                 print("    Removed tmp.pdf")
 
-        if verbose:
+        owned = self.owned_files()
+        owned.add(self.artifacts())
+        owned.save()
+        for fn in self.artifacts():
+            self.events.emit('artifact_written', path=os.path.abspath(fn), bytes=os.path.getsize(fn))
+
+        if self.verbose:
             print("="*70)
             print("Done.  Generated:")
             print("    %s -- edX drag-and-drop question XML" % self.xmlfn)
@@ -371,23 +581,364 @@ class LatexToDragDrop(object):
             print("The XML expects images to be in %s" % self.imdir)
             print("="*70)
 
+    def compile_latex(self):
+        '''
+        Run pdflatex (twice) on the tex file, in the working directory.  With single_latex_pass, the
+        second run is skipped when it is not needed (see latex_rerun_needed).
+        '''
+        if self.verbose:
+            print("Using TEXINPUTS=%s" % self.env['TEXINPUTS'])
+            print("Running latex twice")
+            print("-"*77)
+        # run pdflatex TWICE
+        aux = self.read_aux()
+        with self.latex_output() as out:
+            for k in range(2):
+                if k and not self.latex_rerun_needed(aux):
+                    break
+                subprocess.call(self.latex_cmd(), cwd=self.workdir, env=self.env, stdout=out, stderr=out)
+        if self.verbose:
+            print("="*77)
+
+    def read_aux(self):
+        '''
+        Return contents of the *.aux file (bytes), or None if there is none
+        '''
+        try:
+            with open(self.wpath(self.fnpre + '.aux'), 'rb') as fp:
+                return fp.read()
+        except (IOError, OSError):
+            return None
+
+    def latex_rerun_needed(self, aux_before):
+        '''
+        Return True if pdflatex should be run again, after a first run which started with *.aux file
+        contents aux_before.  Always True unless single_latex_pass; otherwise True only if the run changed
+        the *.aux file (e.g. the label positions), since only then can a second run differ.
+        '''
+        if not self.single_latex_pass:
+            return True
+        aux = self.read_aux()
+        if aux is not None and aux == aux_before:
+            if self.verbose:
+                print("[latex2dnd] %s.aux unchanged, skipping second pdflatex run" % self.fnpre)
+            return False
+        return True
+
+    @contextlib.contextmanager
+    def latex_output(self):
+        '''
+        Context giving the file to which pdflatex output goes: the pdflatex log file if latex_log,
+        else None (stdout)
+        '''
+        if not self.latex_log:
+            yield None
+            return
+        logfn = self.wpath(self.fnpre + '_pdflatex.log')
+        if self.verbose:
+            print("Sending pdflatex output to %s" % logfn)
+        with open(logfn, 'wb') as fp:
+            yield fp
+
+    def latex_cmd(self):
+        '''
+        Return pdflatex command (list of arguments)
+        '''
+        cmd = ['pdflatex', '-recorder']
+        if self.interactionmode:
+            cmd.append("-interaction=%s" % self.interactionmode)
+        cmd.append(self.texfn)
+        return cmd
+
+    def generate_images(self):
+        '''
+        Generate the dnd image, solution image, and label images.  They are made in a scratch
+        directory, then moved into image_outdir when done.  Requires load_boxes and load_dnd.
+        '''
+        self.prepare_images()
+        try:
+            self.generate_dnd_image()
+            self.generate_label_images(self.scratch)
+            if self.max_bytes:
+                self.fit_images_to_byte_budget()
+            self.postprocess_images()
+        finally:
+            shutil.rmtree(self.scratch, ignore_errors=True)
+
+    def prepare_images(self):
+        '''
+        Make the scratch directory for generating images, and set the image filenames.
+        By convention, page 1 of the PDF has the main drag-and-drop image, and page 2
+        has the labels, in individual boxes.
+        '''
+        self.scratch = path(tempfile.mkdtemp(prefix='.latex2dnd_', dir=self.image_outdir))
+        self.dndimfn = self.scratch / (self.fnpre.basename() + '_dnd.png')
+        self.solimfn = self.scratch / (self.fnpre.basename() + '_dnd_sol.png')
+        if self.randomize_solution_filename and not self.hash_filenames:
+            randkey = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(6))
+            self.solimfn = self.scratch / (self.fnpre.basename() + '_dnd_sol_%s.png' % randkey)
+
+    def postprocess_images(self):
+        '''
+        Strip metadata, rename, and dedup the generated images as requested, then move
+        them from the scratch directory into the output directory
+        '''
+        if self.reproducible:
+            self.strip_image_metadata()
+        if self.hash_filenames:
+            self.rename_images_by_content_hash()
+        if self.dedup_store is not None:
+            self.dedup_output_images()
+        self.commit_output_images()
+
+    def artifacts(self):
+        '''
+        Return list of the output files generated by this build.
+        '''
+        files = [self.xmlfn, self.dndimfn, self.solimfn] + list(self.labels.values())
+        if self.testsfn:
+            files.append(self.testsfn)
+        if getattr(self, 'd2c', None) is not None:
+            files.append(self.d2c.ofn)
+        return files
+
+    def remove_old_images(self):
+        '''
+        Remove images of this problem left from previous builds: old randomly named solution images
+        (with cleanup), and stale hash-named images.  This is done only after the new XML has been
+        written, so that the XML on disk never refers to removed images, even if the build fails.
+        '''
+        if self.do_cleanup:
+            self.cleanup_old_solution_image_files()
+        if self.hash_filenames:
+            self.remove_stale_hashed_images()
+
     def cleanup_old_solution_image_files(self):
         '''
-        Delete old solution image files, if present
+        Delete old solution image files, other than the current one, if present.  Only files written by
+        earlier builds of this problem (according to its OwnedFiles record) are deleted.  Call with the
+        output lock held.
         '''
         old_solimfn_pat = path(self.outdir) / (self.fnpre + '_dnd_sol_??????.png')
-        print("pat=%s" % old_solimfn_pat)
-        old_sol_image_files = list(glob.glob(old_solimfn_pat))
+        current = os.path.abspath(self.solimfn) if getattr(self, 'solimfn', None) else None	# not set before a build
+        owned = self.owned_files()
+        self.adopt_legacy_solution_images(owned)
+        old_sol_image_files = []
+        for fn in sorted(glob.glob(old_solimfn_pat)):
+            if os.path.abspath(fn) == current:
+                continue
+            if owned.owns(fn):
+                old_sol_image_files.append(fn)
+            elif self.verbose:
+                print("[latex2dnd] Not removing %s, which was not written by a build of this problem" % fn)
         if old_sol_image_files:
             if self.verbose:
                 print("[latex2dnd] Cleaning up by removing %d old files:" % (len(old_sol_image_files)))
             for fn in old_sol_image_files:
-                os.unlink(fn)
-                print("            Removed %s" % fn)
+                owned.remove(fn)
+                if self.verbose:
+                    print("            Removed %s" % fn)
+            owned.save()
+
+    def adopt_legacy_solution_images(self, owned):
+        '''
+        If there is no OwnedFiles record yet (before the first build by a version of latex2dnd which keeps
+        one), add the solution images named as latex2dnd names them (random 6 character suffix) to owned,
+        as written by earlier builds, so that cleanup can remove them.
+        '''
+        if os.path.exists(owned.fn):
+            return
+        legacy_pat = re.compile(re.escape(self.fnpre.basename()) + '_dnd_sol_[A-Z0-9]{6}\\.png$')
+        legacy = [fn for fn in glob.glob(path(self.outdir) / (self.fnpre + '_dnd_sol_??????.png'))
+                  if legacy_pat.match(os.path.basename(fn))]
+        if legacy and self.verbose:
+            print("[latex2dnd] No record of the files written by earlier builds: taking %d old solution images as theirs"
+                  % len(legacy))
+        owned.add(legacy)
+
+    def wpath(self, fn):
+        '''
+        Return path for filename fn, taken relative to the build's working directory
+        '''
+        return self.workdir / fn
+
+    @staticmethod
+    def tool_environment(env=None, reproducible=False):
+        '''
+        Return environment (dict) for the pdflatex runs of one build: a copy of env (default os.environ),
+        with the latex2dnd tex directory in TEXINPUTS.  For reproducible builds, pdftex takes the PDF
+        creation date (and \\today) from SOURCE_DATE_EPOCH (default 0).
+        '''
+        env = dict(os.environ if env is None else env)
+        mydir = os.path.dirname(__file__)
+        texpath = os.path.abspath(mydir + '/tex')
+        newti = "::%s" % texpath
+        if env.get('TEXINPUTS'):
+            newti += ":" + env['TEXINPUTS']
+        env['TEXINPUTS'] = newti
+        if reproducible:
+            if not env.get('SOURCE_DATE_EPOCH', '').isdigit():
+                env['SOURCE_DATE_EPOCH'] = '0'
+            env['FORCE_SOURCE_DATE'] = '1'
+        return env
+
+    def strip_image_metadata(self):
+        '''
+        Remove timestamps and other text metadata added by the image tools, from all output images
+        '''
+        for fn in [self.dndimfn, self.solimfn] + list(self.labels.values()):
+            strip_png_metadata(fn)
+
+    def rename_images_by_content_hash(self):
+        '''
+        Rename the solution image (or all images, if hash_filenames="all") to include a truncated hash
+        of the image contents, e.g. myfile_dnd_sol_0123456789ab.png.  Unchanged images thus keep the
+        same filename (and URL) across builds, while the solution image name remains unguessable.
+
+        Unchanged images are then not rewritten (see commit_output_images), so their modification
+        times are preserved.
+        '''
+        def hash_rename(fn, stem):
+            newfn = path(fn).parent / ('%s_%s.png' % (stem, sha256_file(fn)[:12]))
+            os.rename(fn, newfn)
+            return newfn
+
+        stem = self.fnpre.basename()
+        self.solimfn = hash_rename(self.solimfn, stem + '_dnd_sol')
+        self.dndpi.imfn = self.solimfn
+        if self.hash_filenames == "all":
+            self.dndimfn = hash_rename(self.dndimfn, stem + '_dnd')
+            for labelnum, lfn in list(self.labels.items()):
+                self.labels[labelnum] = hash_rename(lfn, stem + '_dnd_label%s' % labelnum)
+
+    def remove_stale_hashed_images(self):
+        '''
+        Remove hash-named images of this problem, left from previous builds, which are no longer used.
+        Only files written by earlier builds of this problem (according to its OwnedFiles record) are removed.
+        '''
+        current = [path(fn).basename() for fn in [self.solimfn, self.dndimfn] + list(self.labels.values())]
+        hashed_pat = re.compile(re.escape(self.fnpre.basename()) + '_dnd(_sol|_label[0-9]+)?_[0-9a-f]{12}\\.png$')
+        owned = self.owned_files()
+        for fn in glob.glob(self.image_outdir / (self.fnpre.basename() + '_dnd*.png')):
+            bfn = path(fn).basename()
+            if hashed_pat.match(bfn) and bfn not in current and owned.owns(fn):
+                owned.remove(fn)
+                if self.verbose:
+                    print("    Removed stale image %s" % fn)
+        owned.save()
+
+    def commit_output_images(self):
+        '''
+        Move the generated images from the scratch directory into the output directory.
+        Each move is an atomic rename, and images identical to the existing file are
+        not moved at all, leaving the existing file (and its mtime) alone.
+        '''
+        def commit(fn):
+            outfn = self.image_outdir / path(fn).basename()
+            if not replace_if_changed(fn, outfn) and self.imverbose:
+                print("    %s unchanged" % outfn)
+            return outfn
+
+        self.solimfn = commit(self.solimfn)
+        self.dndimfn = commit(self.dndimfn)
+        for labelnum, lfn in list(self.labels.items()):
+            self.labels[labelnum] = commit(lfn)
+        owned = self.owned_files()
+        self.adopt_legacy_solution_images(owned)
+        owned.add([self.solimfn, self.dndimfn] + list(self.labels.values()))
+        owned.save()
+
+    def dedup_output_images(self):
+        '''
+        Store each distinct output image once, in the dedup store, making the output files
+        hardlinks to the stored copies.  Identical images emitted by other problems
+        (e.g. common labels) then share storage.
+        '''
+        images = [self.dndimfn, self.solimfn] + list(self.labels.values())
+        nsaved = 0
+        bytes_saved = 0
+        for fn in images:
+            nbytes = self.dedup_store.link_file(fn)
+            if nbytes:
+                nsaved += 1
+                bytes_saved += nbytes
+        self.dedup_bytes_saved = bytes_saved
+        print("[latex2dnd] dedup: %d of %d images already stored in %s, %d bytes saved" % (nsaved, len(images),
+                                                                                           self.dedup_store.root,
+                                                                                           bytes_saved))
+
+    def formula_check_code(self):
+        '''
+        Return (check function name, customresponse python script code) for checking answers
+        using the \\DDformula.  Requires load_dnd.
+        '''
+        cfn = 'check_%s' % self.fnpre.basename()
+        cfn = cfn.replace('-', '_')		# cfn must be a legal python procedure name
+
+        mydir = os.path.dirname(__file__)
+        libpath = path(os.path.abspath(mydir + '/lib'))
+        with open(libpath / 'dnd_formulacheck.py') as cfp:
+            check_code = cfp.read()
+
+        # map from draggable labels to label formula contents
+        dmap = {}
+        for lname, lsym in list(self.dnd_label_contents.items()):
+            lsym = lsym.strip()
+            if lsym.startswith('$') and lsym.endswith('$'):
+                lsym = lsym[1:-1]
+            dmap[lname] = lsym
+
+        dndf = self.dnd_formula
+
+        # do some error checking here - validate samples string
+        if dndf.get('formula'):
+            m = re.search('([^@]+)@([^:]+):([^\#]+)#(\d+)', repr(dndf['samples']))
+            if not m:
+                print("WARNING!!! Incorrect \DDforumla samples expression?  you have:")
+                print("  formula = %s" % dndf['formula'])
+                print("  samples = %s" % dndf['samples'])
+                print("  expect  = %s" % dndf['expect'])
+
+        info = {'CHECK_FUNCTION': cfn,
+                'CHECK_DMAP': repr(dmap),
+                'CHECK_FORMULA': repr(dndf['formula']),
+                'CHECK_SAMPLES': repr(dndf['samples']),
+                'CHECK_EXPECT': repr(dndf['expect']),
+                'CHECK_ERROR_MSG': repr(dndf['err']),
+                'OPTION_ALLOW_EMPTY': repr(self.options.get('allow_empty', False)),
+                'OPTION_HIDE_FORMULA_INPUT': repr(self.options.get('hide_formula_input', False))
+                }
+
+        for key, val in list(info.items()):
+            check_code = check_code.replace(key, val)
+        return (cfn, check_code)
+
+    def run_formula_tests(self, check_code):
+        '''
+        Run the \\DDformula unit tests on the check code, and write the results to *_dnd_tests.json.
+        Tests already run on the same check code are not run again.
+        '''
+        if check_code == self.tested_check_code:
+            return self.test_results
+        fut = FormulaTester(check_code, self.box_answers, self.unit_tests,
+                            seed=(0 if self.reproducible else None), max_tests=self.max_formula_tests)
+        try:
+            with self.timed('tests'):
+                self.test_results = fut.run_tests()
+        finally:
+            for k, ret in enumerate(fut.test_results):
+                self.events.emit('test_result', test=k + 1, etype=ret['test_etype'], ok=ret['test_ok'])
+        self.tested_check_code = check_code
+        tfn = self.wpath(self.fnpre + '_dnd_tests.json')
+        write_if_changed(tfn, json.dumps(self.test_results, indent=4, sort_keys=self.reproducible))
+        self.testsfn = tfn
+        if self.verbose:
+            print("Wrote unit test results to %s" % tfn)
+        return self.test_results
 
     def generate_dnd_xml(self):
-        xmlfn = self.fnpre + '_dnd.xml'
-        self.imdir = '/static/images/%s/' % self.fnpre.basename()
+        xmlfn = self.wpath(self.fnpre + '_dnd.xml')
+        self.imdir = course_image_dir(self.fnpre.basename(), self.image_url)
 
         xml = etree.Element('span')
         cr = etree.SubElement(xml, 'customresponse')
@@ -440,60 +991,16 @@ class LatexToDragDrop(object):
             # with customresponse script code, instead of the default
             # dnd grader.
 
-            cfn = 'check_%s' % self.fnpre.basename()
-            cfn = cfn.replace('-', '_')		# cfn must be a legal python procedure name
+            (cfn, check_code) = self.formula_check_code()
             cr.set('cfn', cfn)
             
             script = etree.SubElement(xml, 'script')
             script.set('type', "text/python")
-
-            mydir = os.path.dirname(__file__)
-            libpath = path(os.path.abspath(mydir + '/lib'))
-            with open(libpath / 'dnd_formulacheck.py') as cfp:
-                check_code = cfp.read()
-
-            # map from draggable labels to label formula contents
-            dmap = {}
-            for lname, lsym in list(self.dnd_label_contents.items()):
-                lsym = lsym.strip()
-                if lsym.startswith('$') and lsym.endswith('$'):
-                    lsym = lsym[1:-1]
-                dmap[lname] = lsym
-
-            dndf = self.dnd_formula
-
-            # do some error checking here - validate samples string
-            if dndf.get('formula'):
-                m = re.search('([^@]+)@([^:]+):([^\#]+)#(\d+)', repr(dndf['samples']))
-                if not m:
-                    print("WARNING!!! Incorrect \DDforumla samples expression?  you have:")
-                    print("  formula = %s" % dndf['formula'])
-                    print("  samples = %s" % dndf['samples'])
-                    print("  expect  = %s" % dndf['expect'])
-
-            info = {'CHECK_FUNCTION': cfn,
-                    'CHECK_DMAP': repr(dmap),
-                    'CHECK_FORMULA': repr(dndf['formula']),
-                    'CHECK_SAMPLES': repr(dndf['samples']),
-                    'CHECK_EXPECT': repr(dndf['expect']),
-                    'CHECK_ERROR_MSG': repr(dndf['err']),
-                    'OPTION_ALLOW_EMPTY': repr(self.options.get('allow_empty', False)),
-                    'OPTION_HIDE_FORMULA_INPUT': repr(self.options.get('hide_formula_input', False))
-                    }
-
-            for key, val in list(info.items()):
-                check_code = check_code.replace(key, val)
             script.text = '\n' + check_code
             if self.verbose:
                 print(script.text)
 
-            fut = FormulaTester(check_code, self.box_answers, self.unit_tests)
-            self.test_results = fut.run_tests()
-            tfn = self.fnpre + '_dnd_tests.json'
-            with open(tfn,'w') as fp:
-                fp.write(json.dumps(self.test_results, indent=4))
-            if self.verbose:
-                print("Wrote unit test results to %s" % tfn)
+            self.run_formula_tests(check_code)
 
         else:
 
@@ -538,8 +1045,8 @@ class LatexToDragDrop(object):
         img = etree.SubElement(sol, 'img')
         img.set('src', self.imdir + self.solimfn.basename())
 
-        with open(xmlfn,'w') as fp:
-            fp.write(etree.tostring(xml, pretty_print=True).decode())
+        with self.timed('xml'):		# the formula tests are timed on their own, as 'tests'
+            write_if_changed(xmlfn, etree.tostring(xml, pretty_print=True).decode())
 
         self.xmlfn = xmlfn
 
@@ -548,6 +1055,34 @@ class LatexToDragDrop(object):
         The image from latex has solutions in it.  We white-out the
         boxes to make the dnd image.
         '''
+        self.choose_dpi()
+        if self.dpi=="max":
+            # automatically set DPI by limiting image width to max_image_width
+            self.dndpi = PageImage(self.pdffn, page=1, imfn=self.solimfn, dpi=self.final_dpi, verbose=self.imverbose,
+                                   timed=self.timed)
+            if self.reduce_dpi_to_fit_width():
+                self.dndpi = PageImage(self.pdffn, page=1, imfn=self.solimfn, dpi=self.final_dpi,
+                                       verbose=self.imverbose, timed=self.timed)
+                self.check_image_width()
+            
+        self.dndpi = PageImage(self.pdffn, page=1, imfn=self.solimfn, dpi=self.final_dpi, verbose=self.imverbose,
+                               timed=self.timed)
+        # old test
+        #self.dndpi.NegateBox(self.BoxSet['box1'], outfn='test.png')
+        self.dndpi.WhiteBox(self.answer_boxes(), outfn=self.dndimfn)
+
+    def answer_boxes(self):
+        '''
+        Return list of the target boxes, which are whited-out in the dnd image
+        '''
+        return [ self.BoxSet['box'+n] for n in self.box_answers ]
+
+    def choose_dpi(self):
+        '''
+        Set self.final_dpi (the dpi for the first rendering of the images) from the dpi requested.
+        The dpi may be "max" (autoscale to fit max_image_width), "maxNNN" (start at NNN, and autoscale),
+        or "max:WWW" (autoscale to fit WWW pixels width).
+        '''
         if type(self.dpi) in [str, str] and ('max' in self.dpi):
             self.final_dpi = 300
         else:
@@ -564,45 +1099,210 @@ class LatexToDragDrop(object):
                 self.dpi = "max"
                 self.max_image_width = int(m.group(1))
                 print("[latex2dnd] Using %d as maximum image width" % self.max_image_width)
+        self.final_dpi = int(self.final_dpi)
 
-        if self.dpi=="max":
-            # automatically set DPI by limiting image width to max_image_width
-            self.dndpi = PageImage(self.pdffn, page=1, imfn=self.solimfn, dpi=self.final_dpi, verbose=self.imverbose)            
-            if self.dndpi.sizex > self.max_image_width:
-                print("[latex2dnd] Page width %d exceeds max=%s at dpi=%s" % (self.dndpi.sizex, self.max_image_width, self.final_dpi))
-                newdpi = int(self.final_dpi * 1.0 * self.max_image_width / self.dndpi.sizex * 0.95)
-                print("            Reducing dpi to %s" % newdpi)
-                self.final_dpi = newdpi
-                self.dndpi = PageImage(self.pdffn, page=1, imfn=self.solimfn, dpi=self.final_dpi, verbose=self.imverbose)            
-                if self.dndpi.sizex > self.max_image_width:
-                    print("[latex2dnd] Page width %d STILL exceeds max=%s at dpi=%s" % (self.dndpi.sizex, self.max_image_width, self.final_dpi))
-            
-        self.dndpi = PageImage(self.pdffn, page=1, imfn=self.solimfn, dpi=self.final_dpi, verbose=self.imverbose)
-        # old test
-        #self.dndpi.NegateBox(self.BoxSet['box1'], outfn='test.png')
-        self.dndpi.WhiteBox([ self.BoxSet['box'+n] for n in self.box_answers], outfn=self.dndimfn)
+    def reduce_dpi_to_fit_width(self):
+        '''
+        If the dnd image (self.dndpi) is wider than max_image_width, reduce self.final_dpi
+        so that it fits, and return True.
+        '''
+        if self.dndpi.sizex <= self.max_image_width:
+            return False
+        print("[latex2dnd] Page width %d exceeds max=%s at dpi=%s" % (self.dndpi.sizex, self.max_image_width, self.final_dpi))
+        newdpi = int(self.final_dpi * 1.0 * self.max_image_width / self.dndpi.sizex * 0.95)
+        print("            Reducing dpi to %s" % newdpi)
+        self.final_dpi = newdpi
+        return True
+
+    def check_image_width(self):
+        if self.dndpi.sizex > self.max_image_width:
+            print("[latex2dnd] Page width %d STILL exceeds max=%s at dpi=%s" % (self.dndpi.sizex, self.max_image_width, self.final_dpi))
 
     def generate_label_images(self, outdir='.'):
         outdir = path(outdir)
         # page with all labels
-        self.labelimfn = outdir / self.fnpre + "_labels.png"	
-        labelpi = PageImage(self.pdffn, page=2, imfn=self.labelimfn, dpi=self.final_dpi, verbose=self.imverbose)
+        self.labelimfn = self.outdir / self.fnpre + "_labels.png"	
+        if self.load_cached_label_images(outdir):
+            return
+        if self.labelpi is None:
+            self.labelpi = PageImage(self.pdffn, page=2, imfn=self.labelimfn, pdfimfn=self.label_pdf_filename(),
+                                     dpi=self.final_dpi, verbose=self.imverbose, timed=self.timed)
+        elif self.labelpi.dpi != self.final_dpi:
+            self.labelpi.render(self.final_dpi)
+        with self.timed('labels'):
+            self.extract_label_images(outdir)
+        self.save_cached_label_images()
+
+    def label_pdf_filename(self):
+        return self.wpath(self.fnpre + "_labels.pdf")
+
+    def label_cache_entries(self):
+        '''
+        Return list of (labelnum, label tex, label box size) for all labels, for use with the label cache.
+        The box size is in latex sp units, as given in the *.aux file.  The tex is None for labels
+        missing from the *.dnd file; those are not cached, since nothing identifies their content.
+        '''
+        label_tex = {}
+        for lname, labnum in self.dnd_labels.items():
+            label_tex[labnum] = self.dnd_label_contents[lname]
+        entries = []
+        for label, box in self.BoxSet.items():
+            if not label.startswith('boxLABEL'):
+                continue
+            labelnum = label[8:]
+            llx, lly, urx, ury = [int(x) for x in box.numbers.split(', ')]
+            entries.append((labelnum, label_tex.get(labelnum), (urx - llx, ury - lly)))
+        return entries
 
+    def load_cached_label_images(self, outdir):
+        '''
+        If every label image is available from the label cache, write them out and return True.
+        Otherwise return False, and the page of labels needs to be rasterized.
+        '''
+        if self.label_cache is None:
+            return False
+        entries = self.label_cache_entries()
+        if any(tex is None for labelnum, tex, box_size in entries):
+            return False
+        found = self.label_cache.get_many([(tex, box_size, self.final_dpi) for labelnum, tex, box_size in entries])
+        hits = OrderedDict((entry[0], data) for entry, data in zip(entries, found) if data is not None)
+        if self.verbose:
+            print("[latex2dnd] label cache: %d hits, %d misses so far (%.0f%% hit rate)" % (self.label_cache.hits,
+                                                                                         self.label_cache.misses,
+                                                                                         self.label_cache.hit_rate()))
+        if len(hits) < len(entries):
+            return False
         self.labels = OrderedDict()
-        
-        # extract each label box
+        for labelnum, data in hits.items():
+            outfn = outdir / (self.fnpre.basename() + '_dnd_label%s.png' % labelnum)
+            with open(outfn, 'wb') as fp:
+                fp.write(data)
+            self.labels[labelnum] = outfn
+        if self.verbose:
+            print("  %s labels (all from label cache, at dpi=%s)" % (len(self.labels), self.final_dpi))
+        return True
+
+    def save_cached_label_images(self):
+        '''
+        Store label images in the label cache (unless cache_label_images is off)
+        '''
+        if self.label_cache is None or not self.cache_label_images:
+            return
+        for labelnum, tex, box_size in self.label_cache_entries():
+            if tex is None:
+                continue
+            with open(self.labels[labelnum], 'rb') as fp:
+                self.label_cache.put(tex, box_size, self.final_dpi, fp.read())
+
+    def extract_label_images(self, outdir='.'):
+        '''
+        Extract each label from the rasterized page of labels, into its own image file.
+        '''
+        self.labels = OrderedDict()
+        for labelnum, (box, outfn) in self.label_boxes(outdir).items():
+            self.labelpi.ExtractBox(box, outfn)
+            self.labels[labelnum] = outfn
+        if self.verbose:
+            print("  %s labels" % len(self.labels))
+            # print json.dumps(self.labels, indent=4)
+
+    def label_boxes(self, outdir='.'):
+        '''
+        Return OrderedDict with key = label number, val = (label box, label image filename in outdir)
+        '''
+        outdir = path(outdir)
+        boxes = OrderedDict()
         # by convention, the label boxes are named boxLABEL###
         for label, box in self.BoxSet.items():
             if not label.startswith('boxLABEL'):
                 continue
             m = re.search('boxLABEL([0-9]+)', label)
             labelnum = m.group(1)
-            outfn = outdir / self.fnpre + '_dnd_label%s.png' % labelnum
-            labelpi.ExtractBox(box, outfn)
-            self.labels[label[8:]] = outfn
+            boxes[label[8:]] = (box, outdir / (self.fnpre.basename() + '_dnd_label%s.png' % labelnum))
+        return boxes
+
+    def render_images(self, dpi):
+        '''
+        Re-rasterize the (already separated and cropped) dnd and label pages at a new dpi,
+        and regenerate the dnd image and label images from them.
+        '''
+        self.final_dpi = dpi
+        self.dndpi.render(dpi)
+        self.dndpi.WhiteBox(self.answer_boxes(), outfn=self.dndimfn)
+        self.generate_label_images(self.scratch)
+
+    def fit_images_to_byte_budget(self):
+        '''
+        Choose the highest DPI (no higher than the one requested) for which the dnd image
+        plus all the label images fit within self.max_bytes.  If max_bytes is given as
+        image:N then each of those images must separately be at most N bytes.
+
+        Only the label images at the chosen DPI are stored in the label cache, not those
+        of the trial renders.
+        '''
+        search = self.start_dpi_search()
+        if search is None:
+            return
+        self.cache_label_images = False
+        try:
+            dpi = search.next_dpi()
+            while dpi is not None:
+                self.render_images(dpi)
+                self.record_dpi_trial(search, dpi)
+                dpi = search.next_dpi()
+            if search.fit_dpi is not None and search.fit_dpi != search.dpi:
+                self.render_images(search.fit_dpi)
+        finally:
+            self.cache_label_images = True
+        self.save_cached_label_images()
+        self.report_dpi_search(search)
+
+    def start_dpi_search(self):
+        '''
+        Return DpiSearch for fitting the images into max_bytes, or None if they already fit
+        '''
+        budget = str(self.max_bytes)
+        per_image = False
+        m = re.match("image:([0-9]+)$", budget)
+        if m:
+            per_image = True
+            budget = m.group(1)
+        try:
+            budget = int(budget)
+        except Exception:
+            raise Exception("[latex2dnd] bad max_bytes value '%s', should be N or image:N" % self.max_bytes)
+        self.budget_per_image = per_image
+
+        dpi = self.final_dpi
+        nbytes = self.image_bytes()
+        if nbytes <= budget:
+            print("[latex2dnd] Images use %d bytes at dpi=%s, within max_bytes=%s" % (nbytes, dpi, self.max_bytes))
+            return None
+        return DpiSearch(dpi, nbytes, budget, min_dpi=self.min_dpi)
+
+    def image_bytes(self):
+        '''
+        Return total size of the dnd image plus the label images (or the largest, if max_bytes is per image)
+        '''
+        sizes = [os.path.getsize(fn) for fn in [self.dndimfn] + list(self.labels.values())]
+        if self.budget_per_image:
+            return max(sizes)
+        return sum(sizes)
+
+    def record_dpi_trial(self, search, dpi):
+        nbytes = self.image_bytes()
+        search.record(dpi, nbytes)
         if self.verbose:
-            print("  %s labels" % len(self.labels))
-            # print json.dumps(self.labels, indent=4)
+            print("[latex2dnd] dpi=%s gives %d bytes (max_bytes=%s)" % (dpi, nbytes, self.max_bytes))
+
+    def report_dpi_search(self, search):
+        if search.fit_dpi is None:
+            print("[latex2dnd] WARNING: images still use %d bytes at minimum dpi=%s, exceeding max_bytes=%s" % (search.nbytes,
+                                                                                                             search.dpi,
+                                                                                                             self.max_bytes))
+            return
+        print("[latex2dnd] Chose dpi=%s to fit max_bytes=%s (images use %d bytes)" % (search.fit_dpi, self.max_bytes,
+                                                                                       self.image_bytes()))
 
     def load_dnd(self):
         '''
@@ -620,7 +1320,7 @@ class LatexToDragDrop(object):
         self.dnd_formula = {}
         self.unit_tests = []
 
-        dndfn = self.fnpre + '.dnd'
+        dndfn = self.wpath(self.fnpre + '.dnd')
 
         if not os.path.exists(dndfn):
             print("Error: %s does not exist; did the latex compilation fail?" % dndfn)
@@ -709,14 +1409,14 @@ class LatexToDragDrop(object):
         
         if 0:
             # old way uses the *.pos file, but that doesn't contain all the points
-            posfn = self.fnpre + '.pos'
+            posfn = self.wpath(self.fnpre + '.pos')
         
             for k in open(posfn):
                 b = Box(k, hrbb)
                 BoxSet[b.label] = b
         else:
             # use the *.aux file instead; it has all the zpos points
-            auxfn = self.fnpre + ".aux"
+            auxfn = self.wpath(self.fnpre + ".aux")
             for k in open(auxfn):
                 if not k.startswith('\\zref@newlabel'):
                     continue
@@ -738,12 +1438,52 @@ class LatexToDragDrop(object):
         self.BoxSet = BoxSet
 
 
-def CommandLine(opts=None, args=None, arglist=None, return_object=False):
+# named build profiles: option values (by optparse dest) set by --profile.  Options given explicitly
+# on the command line, before or after --profile, take precedence (see BuildOptionParser).
+BUILD_PROFILES = OrderedDict([
+    # fast author iteration: low DPI, one pdflatex run where safe, a fixed solution image name
+    # (so old ones do not pile up), and only the answer key plus one more formula test
+    ('draft', {'resolution': '100', 'single_latex_pass': True, 'nonrandom': True, 'max_formula_tests': 2}),
+    # checking the look of a problem: medium DPI, all formula tests
+    ('preview', {'resolution': '150', 'single_latex_pass': True, 'nonrandom': True}),
+    # publishing: full DPI, two pdflatex runs, all formula tests, reproducible outputs (stripped PNG
+    # metadata, content-hashed solution image name), and cleanup of old solution images
+    ('production', {'resolution': '300', 'reproducible': True, 'do_cleanup': True}),
+])
+
+class BuildOption(optparse.Option):
     '''
-    Main command line.  Accepts args, to allow for simple unit testing.
+    optparse Option which records its destination in parser.given when it is given on the command line
+    '''
+    def process(self, opt, value, values, parser):
+        parser.given.add(self.dest)
+        return optparse.Option.process(self, opt, value, values, parser)
+
+class BuildOptionParser(optparse.OptionParser):
+    '''
+    OptionParser which, after parsing, sets the option values of the --profile build profile, for all
+    the options not given explicitly (wherever they appear relative to --profile)
+    '''
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('option_class', BuildOption)
+        optparse.OptionParser.__init__(self, *args, **kwargs)
+        self.given = set()
+
+    def parse_args(self, args=None, values=None):
+        self.given = set()
+        (opts, args) = optparse.OptionParser.parse_args(self, args, values)
+        if getattr(opts, 'profile', None):
+            for dest, val in BUILD_PROFILES[opts.profile].items():
+                if dest not in self.given:
+                    setattr(opts, dest, val)
+        return (opts, args)
+
+def make_option_parser(usage="usage: %prog [options] [filename.tex | filename.dndspec]"):
     '''
-    parser = optparse.OptionParser(usage="usage: %prog [options] [filename.tex | filename.dndspec]",
-                                   version="%prog 1.1.1")
+    Return optparse parser with the options for building drag-and-drop problems.
+    '''
+    parser = BuildOptionParser(usage=usage,
+                               version="%prog 1.1.1")
     parser.add_option('-v', '--verbose', 
                       dest='verbose', 
                       default=False, action='store_true',
@@ -780,6 +1520,26 @@ def CommandLine(opts=None, args=None, arglist=None, return_object=False):
                       dest="resolution",
                       default="300",
                       help="Resolution of PNG files in DPI (default 300), can set to 'max' to auto-scale",)
+    parser.add_option("--max-bytes",
+                      action="store",
+                      dest="max_bytes",
+                      default=None,
+                      help="Byte budget for dnd image plus labels; the DPI is lowered to fit.  Use image:N to limit each image to N bytes",)
+    parser.add_option("--label-cache",
+                      action="store",
+                      dest="label_cache",
+                      default=None,
+                      help="Directory for a persistent cache of rendered label images, shared across problems",)
+    parser.add_option("--remote-cache",
+                      action="store",
+                      dest="remote_cache",
+                      default=None,
+                      help="URL of a shared build cache server (see latex2dnd cache-server), consulted on label cache misses",)
+    parser.add_option("--dedup-dir",
+                      action="store",
+                      dest="dedup_dir",
+                      default=None,
+                      help="Store each distinct output image once in this directory, and hardlink output images to it",)
     parser.add_option("--cfn",
                       action="store",
                       dest="custom_cfn",
@@ -799,17 +1559,151 @@ def CommandLine(opts=None, args=None, arglist=None, return_object=False):
                       action="store_true",
                       dest="do_cleanup",
                       default=False,
-                      help="Remove old solution image files, and tmp.pdf",)
+                      help="Remove old solution image files, and tmp.pdf.  Only files recorded (in .<name>_dnd.owned.json, in "
+                           "the output directory) as written by builds of the problem are removed",)
     parser.add_option("--nonrandom",
                       action="store_true",
                       dest="nonrandom",
                       default=False,
                       help="Do not use a random string in the solution filename",)
+    parser.add_option("--hash-filenames",
+                      type="choice",
+                      choices=["sol", "all"],
+                      dest="hash_filenames",
+                      default=None,
+                      help="Name the solution image (sol), or all images (all), by a hash of their contents, instead of a random string",)
+    parser.add_option("--reproducible",
+                      action="store_true",
+                      dest="reproducible",
+                      default=False,
+                      help="Make identical inputs give byte-identical XML, JSON, and images",)
+    parser.add_option("--olx-archive",
+                      action="store",
+                      dest="olx_archive",
+                      default=None,
+                      help="Also export the problem(s) into this edX OLX course archive (.tar.gz or .zip)",)
+    parser.add_option("--manifest",
+                      action="store",
+                      dest="manifest",
+                      default=None,
+                      help="Write a manifest of the build artifacts (size, sha256, problem) to this JSON file",)
+    parser.add_option("--events",
+                      action="store",
+                      dest="events",
+                      default=None,
+                      help="Emit structured progress events in this format (ndjson); pdflatex output then goes to <name>_pdflatex.log",)
+    parser.add_option("--events-fd",
+                      action="store",
+                      type="int",
+                      dest="events_fd",
+                      default=1,
+                      help="File descriptor to write events to (default 1, stdout; all other output then goes to stderr)",)
+    parser.add_option("--single-latex-pass",
+                      action="store_true",
+                      dest="single_latex_pass",
+                      default=False,
+                      help="Run pdflatex once instead of twice, unless the first run changes the .aux file",)
+    parser.add_option("--max-formula-tests",
+                      action="store",
+                      type="int",
+                      dest="max_formula_tests",
+                      default=None,
+                      help="Run only this many formula unit tests (the answer key test first)",)
+    parser.add_option("--profile",
+                      type="choice",
+                      choices=list(BUILD_PROFILES.keys()),
+                      action="store",
+                      dest="profile",
+                      default=None,
+                      help="Build profile: draft (fast: -r 100, one pdflatex run where safe, 2 formula tests), "
+                           "preview (-r 150), or production (-r 300, --reproducible, --cleanup); "
+                           "options given before or after it take precedence",)
+    parser.add_option("--latex-log",
+                      action="store_true",
+                      dest="latex_log",
+                      default=False,
+                      help="Send pdflatex output to <name>_pdflatex.log instead of the terminal",)
     parser.add_option("--tex-options-override",
                       action="store_true",
                       default=False,
                       help="allow options in tex or dndspec file to override command line options",)
 
+    return parser
+
+def build_options(opts):
+    '''
+    Return dict of LatexToDragDrop keyword arguments, given parsed command line options.
+    '''
+    return dict(compile=(not opts.skip_latex), 
+                verbose=opts.verbose, 
+                dpi=opts.resolution,
+                outdir=opts.output_dir,
+                imverbose=opts.very_verbose,
+                can_reuse=opts.can_reuse,
+                custom_cfn=opts.custom_cfn,
+                do_cleanup=opts.do_cleanup,
+                command_line_options_override=(not opts.tex_options_override),
+                randomize_solution_filename=(not opts.nonrandom),
+                max_bytes=opts.max_bytes,
+                label_cache=opts.label_cache,
+                remote_cache=opts.remote_cache,
+                dedup_dir=opts.dedup_dir,
+                hash_filenames=opts.hash_filenames,
+                reproducible=opts.reproducible,
+                image_url=opts.image_url,
+                latex_log=(opts.latex_log or bool(opts.events)),
+                single_latex_pass=opts.single_latex_pass,
+                max_formula_tests=opts.max_formula_tests,
+    )
+
+def check_image_url_for_archive(opts):
+    '''
+    Course archives put images in /static/images/<name>/, so the XML must expect them there.
+    '''
+    if opts.olx_archive and opts.image_url.rstrip('/') != DEFAULT_IMAGE_URL:
+        print("[latex2dnd] Warning: ignoring image URL %s, since the course archive puts images in %s" % (opts.image_url,
+                                                                                                          DEFAULT_IMAGE_URL))
+        opts.image_url = DEFAULT_IMAGE_URL
+
+def SubCommand(arglist):
+    '''
+    Return the function implementing the subcommand named by arglist[0], or None.
+    Subcommands are run as latex2dnd <subcommand> [options] ...
+    '''
+    if not arglist:
+        return None
+    if arglist[0] == "batch":
+        from .batch import BatchCommandLine
+        return BatchCommandLine
+    if arglist[0] == "manifest-diff":
+        from .manifest import ManifestDiffCommandLine
+        return ManifestDiffCommandLine
+    if arglist[0] == "manifest-merge":
+        from .manifest import ManifestMergeCommandLine
+        return ManifestMergeCommandLine
+    if arglist[0] == "serve":
+        from .serve import ServeCommandLine
+        return ServeCommandLine
+    if arglist[0] == "cache-server":
+        from .remote import CacheServerCommandLine
+        return CacheServerCommandLine
+    if arglist[0] == "worker":
+        from .spool import WorkerCommandLine
+        return WorkerCommandLine
+    return None
+
+def CommandLine(opts=None, args=None, arglist=None, return_object=False):
+    '''
+    Main command line.  Accepts args, to allow for simple unit testing.
+    '''
+    if not opts:
+        if arglist is None:
+            arglist = sys.argv[1:]
+        subcommand = SubCommand(arglist)
+        if subcommand is not None:
+            return subcommand(arglist[1:])
+    parser = make_option_parser()
+
     if not opts:
         (opts, args) = parser.parse_args(arglist)
 
@@ -818,31 +1712,50 @@ def CommandLine(opts=None, args=None, arglist=None, return_object=False):
         sys.exit(0)
     fn = args[0]
 
-    if fn.endswith(".dndspec"):
-        try:
-            s2t = DNDspec2tex(fn, verbose=opts.verbose)
-        except Exception as err:
-            print("[latex2dnd] Failed to run dndspec2tex on input file %s, err=%s" % (fn, err))
-            raise
-        if opts.output_tex:
-            sys.exit(0)
-        fn = s2t.tex_filename
-
-    l2d = LatexToDragDrop(fn, 
-                          compile=(not opts.skip_latex), 
-                          verbose=opts.verbose, 
-                          dpi=opts.resolution,
-                          outdir=opts.output_dir,
-                          imverbose=opts.very_verbose,
-                          can_reuse=opts.can_reuse,
-                          custom_cfn=opts.custom_cfn,
-                          do_cleanup=opts.do_cleanup,
-                          command_line_options_override=(not opts.tex_options_override),
-                          randomize_solution_filename=(not opts.nonrandom),
-    )
-    if opts.output_catsoop:
-        d2c = DndToCatsoop(l2d)
-        l2d.d2c = d2c
+    try:
+        events = open_event_stream(opts.events, opts.events_fd).bind(job=os.path.splitext(os.path.basename(fn))[0])
+    except ValueError as err:
+        parser.error(str(err))
+    events.emit('job_started')
+    start = time.time()
+    try:
+        if fn.endswith(".dndspec"):
+            try:
+                s2t = DNDspec2tex(fn, verbose=opts.verbose)
+            except Exception as err:
+                print("[latex2dnd] Failed to run dndspec2tex on input file %s, err=%s" % (fn, err))
+                raise
+            if opts.output_tex:
+                sys.exit(0)
+            fn = s2t.tex_filename
+
+        check_image_url_for_archive(opts)
+        l2d = LatexToDragDrop(fn, events=events, **build_options(opts))
+        if opts.output_catsoop:
+            d2c = DndToCatsoop(l2d)
+            l2d.d2c = d2c
+            events.emit('artifact_written', path=str(d2c.ofn), bytes=os.path.getsize(d2c.ofn))
+    except (Exception, SystemExit) as err:
+        if isinstance(err, SystemExit) and not err.code:
+            events.emit('job_finished', status='ok', seconds=round(time.time() - start, 3))
+        else:
+            events.emit('error', error="%s: %s" % (err.__class__.__name__, err))
+            events.emit('job_finished', status='failed', seconds=round(time.time() - start, 3))
+        raise
+    events.emit('job_finished', status='ok', seconds=round(time.time() - start, 3))
+
+    if opts.olx_archive:
+        with CourseArchive(opts.olx_archive, verbose=opts.verbose) as archive:
+            archive.add_build(l2d)
+
+    if opts.manifest:
+        manifest = BuildManifest(opts.manifest)
+        if os.path.exists(opts.manifest):
+            manifest = BuildManifest.load(opts.manifest)
+        manifest.add_files(l2d.artifacts(), args[0])
+        manifest.save()
+        if opts.verbose:
+            print("Wrote build manifest to %s" % opts.manifest)
 
     if return_object:
         return l2d
@@ -0,0 +1,158 @@
+'''
+Build manifests: lists of build artifacts, with size, content hash, and the
+problem which produced each.  Comparing the manifests of two builds tells
+which files need to be uploaded (or purged from a CDN), and which removed.
+'''
+
+import os
+import json
+import optparse
+from collections import OrderedDict
+from .store import sha256_file
+from .fileutil import write_if_changed
+
+class BuildManifest(object):
+    '''
+    Manifest of build artifacts.
+
+    artifacts = dict with key = artifact path (relative to the manifest file's directory),
+                val = dict with size, sha256, problem
+    problems = dict with key = problem (source filename), val = dict with build information
+               (e.g. status, seconds)
+    '''
+    def __init__(self, fn=None):
+        '''
+        fn = manifest filename; artifact paths are stored relative to its directory
+        '''
+        self.fn = fn
+        self.artifacts = OrderedDict()
+        self.problems = OrderedDict()
+
+    def base_dir(self):
+        if self.fn is None:
+            return os.getcwd()
+        return os.path.dirname(os.path.abspath(self.fn))
+
+    def relpath(self, fn):
+        return os.path.relpath(os.path.abspath(fn), self.base_dir())
+
+    def add_file(self, fn, problem):
+        '''
+        Add artifact file fn, produced by problem, to the manifest.
+        '''
+        self.artifacts[self.relpath(fn)] = OrderedDict([('size', os.path.getsize(fn)),
+                                                        ('sha256', sha256_file(fn)),
+                                                        ('problem', problem),
+                                                        ])
+
+    def add_files(self, fns, problem, **info):
+        '''
+        Add all the files fns produced by problem; info = extra build information for the problem
+        '''
+        for fn in fns:
+            self.add_file(fn, problem)
+        self.problems.setdefault(problem, OrderedDict()).update(info)
+
+    def remove_problem(self, problem):
+        '''
+        Remove problem, and all the artifacts it produced, from the manifest
+        '''
+        for rfn in [rfn for rfn, info in self.artifacts.items() if info['problem'] == problem]:
+            del self.artifacts[rfn]
+        self.problems.pop(problem, None)
+
+    def update(self, other):
+        '''
+        Merge artifacts and problems from other manifest into this one (other takes precedence).
+        '''
+        for rfn, info in other.artifacts.items():
+            if other.fn is not None:
+                rfn = self.relpath(os.path.join(other.base_dir(), rfn))
+            self.artifacts[rfn] = info
+        self.problems.update(other.problems)
+
+    def to_json(self):
+        data = OrderedDict([('artifacts', OrderedDict(sorted(self.artifacts.items()))),
+                            ('problems', OrderedDict(sorted(self.problems.items()))),
+                            ])
+        return json.dumps(data, indent=4)
+
+    def save(self, fn=None):
+        if fn is not None and fn != self.fn:
+            other = BuildManifest(fn)
+            other.update(self)
+            return other.save()
+        write_if_changed(self.fn, self.to_json() + '\n')
+
+    @classmethod
+    def load(cls, fn):
+        manifest = cls(fn)
+        with open(fn) as fp:
+            data = json.load(fp, object_pairs_hook=OrderedDict)
+        manifest.artifacts = data.get('artifacts', OrderedDict())
+        manifest.problems = data.get('problems', OrderedDict())
+        return manifest
+
+    def diff(self, new):
+        '''
+        Compare this (old) manifest with new manifest.  Return dict with lists of
+        added, changed, and removed artifact paths.  Paths are compared as stored,
+        i.e. relative to each manifest's directory, so that two builds in different
+        directories can be compared.
+        '''
+        old_artifacts = self.artifacts
+        new_artifacts = new.artifacts
+        added = sorted(set(new_artifacts) - set(old_artifacts))
+        removed = sorted(set(old_artifacts) - set(new_artifacts))
+        changed = sorted(rfn for rfn in set(new_artifacts) & set(old_artifacts)
+                         if new_artifacts[rfn]['sha256'] != old_artifacts[rfn]['sha256'])
+        return OrderedDict([('added', added), ('changed', changed), ('removed', removed)])
+
+def ManifestDiffCommandLine(arglist=None):
+    '''
+    latex2dnd manifest-diff old_manifest.json new_manifest.json
+
+    List artifacts added, changed, and removed between two builds.
+    '''
+    parser = optparse.OptionParser(usage="usage: %prog manifest-diff [options] old_manifest.json new_manifest.json")
+    parser.add_option("--json",
+                      action="store_true",
+                      dest="json",
+                      default=False,
+                      help="Output the differences as JSON",)
+    (opts, args) = parser.parse_args(arglist)
+    if len(args) != 2:
+        parser.error('wrong number of arguments')
+    diff = BuildManifest.load(args[0]).diff(BuildManifest.load(args[1]))
+    if opts.json:
+        print(json.dumps(diff, indent=4))
+    else:
+        for change, rfns in diff.items():
+            for rfn in rfns:
+                print("%s %s" % (change, rfn))
+    return diff
+
+def ManifestMergeCommandLine(arglist=None):
+    '''
+    latex2dnd manifest-merge -o merged_manifest.json manifest.json ...
+
+    Combine the manifests of several builds (e.g. the shards of a sharded batch build) into one.
+    '''
+    parser = optparse.OptionParser(usage="usage: %prog manifest-merge [options] -o merged.json manifest.json ...")
+    parser.add_option("-o", "--output",
+                      action="store",
+                      dest="output",
+                      default=None,
+                      help="Filename for the merged manifest",)
+    (opts, args) = parser.parse_args(arglist)
+    if not args or not opts.output:
+        parser.error('need an output file (-o) and manifests to merge')
+    merged = BuildManifest(opts.output)
+    for fn in args:
+        merged.update(BuildManifest.load(fn))
+    merged.save()
+    print("[latex2dnd] Merged %d manifests (%d problems, %d artifacts) into %s" % (len(args),
+                                                                                  len(merged.problems),
+                                                                                  len(merged.artifacts),
+                                                                                  opts.output))
+    return merged
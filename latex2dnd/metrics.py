@@ -0,0 +1,178 @@
+'''
+Build telemetry for batch builds, as a Prometheus text format (0.0.4) file, e.g. for
+the Prometheus node exporter's textfile collector:
+
+    latex2dnd batch --metrics /var/lib/node_exporter/textfile/latex2dnd.prom problems/
+
+The file is rewritten atomically (write to a temporary file, then rename) when the
+build starts, as each problem finishes, and when the build is done, so a scrape
+never sees a partial file.  The TYPE and HELP lines of a counter name its sample
+(e.g. latex2dnd_problems_built_total), as the text format parser of the node exporter
+requires; the final "# EOF" line is a comment to it.  Metrics:
+
+    latex2dnd_problems_built_total		problems built successfully
+    latex2dnd_problems_failed_total		problems whose build failed
+    latex2dnd_cache_hits_total{cache}		label cache hits (cache="label"), and problems
+						skipped as unchanged by --resume (cache="journal")
+    latex2dnd_cache_misses_total{cache}		label cache misses
+    latex2dnd_stage_duration_seconds{stage}	histogram of per-problem stage durations: latex,
+						crop, rasterize, labels, xml, tests (formula tests)
+    latex2dnd_build_duration_seconds		histogram of whole problem build durations
+    latex2dnd_written_bytes_total		bytes of build artifacts written
+    latex2dnd_child_peak_rss_bytes		peak resident set size of the tools run (pdflatex,
+						poppler, ImageMagick)
+    latex2dnd_batch_problems{state}		problems in the batch: total, and done
+    latex2dnd_batch_running			1 while the batch build runs, then 0
+    latex2dnd_batch_start_time_seconds		when the batch build started (unix time)
+'''
+
+import sys
+import time
+from collections import OrderedDict
+
+try:
+    import resource
+except ImportError:
+    resource = None			# not on Windows
+
+from .fileutil import write_if_changed
+
+STAGES = ['latex', 'crop', 'rasterize', 'labels', 'xml', 'tests']
+BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+
+def peak_child_rss():
+    '''
+    Return peak resident set size (bytes) of the terminated child processes of this process, or None if unknown
+    '''
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024	# kilobytes, except on macOS
+
+def format_value(val):
+    if isinstance(val, float):
+        return repr(round(val, 6))
+    return str(val)
+
+class Histogram(object):
+    '''
+    Cumulative histogram of observed values, with fixed bucket upper bounds
+    '''
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = list(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, val):
+        for k, bound in enumerate(self.buckets):
+            if val <= bound:
+                self.counts[k] += 1
+        self.count += 1
+        self.sum += val
+
+    def samples(self, name, labels=''):
+        '''
+        Return list of sample lines; labels = label string, e.g. 'stage="latex"'
+        '''
+        sep = ',' if labels else ''
+        lines = []
+        for bound, cnt in zip(self.buckets, self.counts):
+            lines.append('%s_bucket{%s%sle="%s"} %d' % (name, labels, sep, format_value(float(bound)), cnt))
+        lines.append('%s_bucket{%s%sle="+Inf"} %d' % (name, labels, sep, self.count))
+        labels = '{%s}' % labels if labels else ''
+        lines.append('%s_sum%s %s' % (name, labels, format_value(self.sum)))
+        lines.append('%s_count%s %d' % (name, labels, self.count))
+        return lines
+
+class BuildMetrics(object):
+    '''
+    Metrics of a batch build, written to a Prometheus text format file
+    '''
+    def __init__(self, fn, nproblems=0):
+        self.fn = fn
+        self.nproblems = nproblems
+        self.ndone = 0
+        self.running = True
+        self.start_time = time.time()
+        self.built = 0
+        self.failed = 0
+        self.cache_hits = OrderedDict([('label', 0), ('journal', 0)])
+        self.cache_misses = OrderedDict([('label', 0)])
+        self.stages = OrderedDict((stage, Histogram()) for stage in STAGES)
+        self.builds = Histogram()
+        self.bytes_written = 0
+        self.child_rss = 0
+
+    def observe(self, result, resumed=False):
+        '''
+        Add the result (dict, from batch.build_problem) of a problem build.  A resumed problem (skipped
+        as unchanged) only counts as a journal cache hit.
+        '''
+        self.ndone += 1
+        if resumed:
+            self.cache_hits['journal'] += 1
+            return
+        if result['status'] == 'ok':
+            self.built += 1
+        else:
+            self.failed += 1
+        self.builds.observe(result['seconds'])
+        for stage, seconds in result.get('stages', {}).items():
+            if stage in self.stages:
+                self.stages[stage].observe(seconds)
+        label_cache = result.get('label_cache') or {}
+        self.cache_hits['label'] += label_cache.get('hits', 0)
+        self.cache_misses['label'] += label_cache.get('misses', 0)
+        self.bytes_written += result.get('bytes', 0)
+        self.child_rss = max(self.child_rss, result.get('child_rss') or 0)
+
+    def render(self):
+        '''
+        Return the metrics, in Prometheus text format
+        '''
+        lines = []
+
+        def family(name, mtype, help, samples):
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, mtype))
+            lines.extend(samples)
+
+        family('latex2dnd_problems_built_total', 'counter', 'Problems built successfully.',
+               ['latex2dnd_problems_built_total %d' % self.built])
+        family('latex2dnd_problems_failed_total', 'counter', 'Problems whose build failed.',
+               ['latex2dnd_problems_failed_total %d' % self.failed])
+        family('latex2dnd_cache_hits_total', 'counter', 'Label cache hits, and problems skipped as unchanged (journal).',
+               ['latex2dnd_cache_hits_total{cache="%s"} %d' % x for x in self.cache_hits.items()])
+        family('latex2dnd_cache_misses_total', 'counter', 'Label cache misses.',
+               ['latex2dnd_cache_misses_total{cache="%s"} %d' % x for x in self.cache_misses.items()])
+        samples = []
+        for stage, hist in self.stages.items():
+            samples += hist.samples('latex2dnd_stage_duration_seconds', 'stage="%s"' % stage)
+        family('latex2dnd_stage_duration_seconds', 'histogram', 'Duration of each stage of the problem builds.',
+               samples)
+        family('latex2dnd_build_duration_seconds', 'histogram', 'Duration of the problem builds.',
+               self.builds.samples('latex2dnd_build_duration_seconds'))
+        family('latex2dnd_written_bytes_total', 'counter', 'Bytes of build artifacts written.',
+               ['latex2dnd_written_bytes_total %d' % self.bytes_written])
+        family('latex2dnd_child_peak_rss_bytes', 'gauge', 'Peak resident set size of the tools run by the builds.',
+               ['latex2dnd_child_peak_rss_bytes %d' % self.child_rss])
+        family('latex2dnd_batch_problems', 'gauge', 'Problems in the batch build.',
+               ['latex2dnd_batch_problems{state="total"} %d' % self.nproblems,
+                'latex2dnd_batch_problems{state="done"} %d' % self.ndone])
+        family('latex2dnd_batch_running', 'gauge', 'Whether the batch build is running.',
+               ['latex2dnd_batch_running %d' % int(self.running)])
+        family('latex2dnd_batch_start_time_seconds', 'gauge', 'Start time of the batch build.',
+               ['latex2dnd_batch_start_time_seconds %s' % format_value(round(self.start_time, 3))])
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        '''
+        Atomically rewrite the metrics file
+        '''
+        write_if_changed(self.fn, self.render())
+
+    def finish(self):
+        self.running = False
+        self.write()
@@ -0,0 +1,160 @@
+'''
+Course archive export: stream drag-and-drop problems into an edX OLX tar.gz or
+zip file, with the layout
+
+    problem/<name>.xml
+    static/images/<name>/<image>.png
+
+Each problem is added as soon as it is built; files are copied from disk into
+the archive incrementally, so memory use does not grow with the course size.
+'''
+
+import os
+import io
+import time
+import tarfile
+import zipfile
+from lxml import etree
+
+from .fileutil import temp_name_for
+
+DEFAULT_IMAGE_URL = "/static/images"
+
+def course_image_dir(name, image_url=DEFAULT_IMAGE_URL):
+    '''
+    Return the URL directory prefix for the images of problem name
+    '''
+    return '%s/%s/' % (image_url.rstrip('/'), name)
+
+def archive_format(fn):
+    '''
+    Return "zip" or "tar" depending on the archive filename
+    '''
+    if fn.endswith(".zip"):
+        return "zip"
+    if fn.endswith(".tar.gz") or fn.endswith(".tgz"):
+        return "tar"
+    raise Exception("[latex2dnd] Unknown course archive format for %s (use .tar.gz, .tgz, or .zip)" % fn)
+
+def problem_olx(xmlfn, name):
+    '''
+    Return OLX (bytes) for a problem, given the *_dnd.xml file produced by latex2dnd.
+    '''
+    span = etree.parse(xmlfn).getroot()
+    problem = etree.Element('problem')
+    problem.set('display_name', name)
+    problem.append(span)
+    return etree.tostring(problem, pretty_print=True)
+
+class CourseArchive(object):
+    '''
+    OLX course archive (tar.gz or zip), written incrementally.  The archive is built
+    in a temporary file, and renamed into place when closed.
+    '''
+    def __init__(self, fn, fmt=None, root="course", verbose=False):
+        '''
+        fn = archive filename
+        fmt = "tar" or "zip" (default: from fn's extension)
+        root = top-level directory of the course within the archive
+        '''
+        self.fn = fn
+        self.fmt = fmt or archive_format(fn)
+        self.root = root
+        self.verbose = verbose
+        self.names = []
+        self.mtime = time.time()
+        self.tmpfn = temp_name_for(os.path.abspath(fn))
+        if self.fmt == "zip":
+            self.zip = zipfile.ZipFile(self.tmpfn, "w", zipfile.ZIP_DEFLATED)
+        else:
+            self.tar = tarfile.open(self.tmpfn, "w:gz")
+
+    def arcname(self, *parts):
+        return "/".join((self.root,) + parts)
+
+    def add_file(self, fn, arcname):
+        if self.fmt == "zip":
+            self.zip.write(fn, arcname)
+        else:
+            self.tar.add(fn, arcname)
+
+    def add_data(self, data, arcname):
+        if self.fmt == "zip":
+            self.zip.writestr(arcname, data)
+        else:
+            info = tarfile.TarInfo(arcname)
+            info.size = len(data)
+            info.mtime = self.mtime
+            self.tar.addfile(info, io.BytesIO(data))
+
+    def add_problem(self, name, artifacts):
+        '''
+        Add problem name to the archive, given its artifact files: the *_dnd.xml file
+        goes in problem/, and the *.png images in static/images/<name>/.
+        '''
+        if name in self.names:
+            raise Exception("[latex2dnd] Problem %s already in course archive %s" % (name, self.fn))
+        self.names.append(name)
+        for fn in artifacts:
+            if fn.endswith("_dnd.xml"):
+                self.add_data(problem_olx(fn, name), self.arcname("problem", name + ".xml"))
+            elif fn.endswith(".png"):
+                self.add_file(fn, self.arcname("static", "images", name, os.path.basename(fn)))
+        if self.verbose:
+            print("[latex2dnd] Added problem %s to course archive %s" % (name, self.fn))
+
+    def add_build(self, l2d):
+        '''
+        Add the problem built by LatexToDragDrop instance l2d
+        '''
+        name = l2d.fnpre.basename()
+        if l2d.imdir != course_image_dir(name):
+            raise Exception("[latex2dnd] Problem %s expects images in %s, but the course archive puts them in %s" % (name, l2d.imdir, course_image_dir(name)))
+        self.add_problem(name, l2d.artifacts())
+
+    def add_result(self, result):
+        '''
+        Add the problem in DragDropResult result (from latex2dnd.api.build_dnd), directly from memory
+        '''
+        if result.imdir != course_image_dir(result.name):
+            raise Exception("[latex2dnd] Problem %s expects images in %s, but the course archive puts them in %s" % (result.name, result.imdir, course_image_dir(result.name)))
+        if result.name in self.names:
+            raise Exception("[latex2dnd] Problem %s already in course archive %s" % (result.name, self.fn))
+        self.names.append(result.name)
+        span = etree.fromstring(result.xml.encode('utf8'))
+        problem = etree.Element('problem')
+        problem.set('display_name', result.name)
+        problem.append(span)
+        self.add_data(etree.tostring(problem, pretty_print=True), self.arcname("problem", result.name + ".xml"))
+        for bn, data in result.images.items():
+            self.add_data(data, self.arcname("static", "images", result.name, bn))
+
+    def close(self):
+        if self.fmt == "zip":
+            self.zip.close()
+        else:
+            self.tar.close()
+        os.replace(self.tmpfn, self.fn)
+        print("[latex2dnd] Wrote course archive %s with %d problems" % (self.fn, len(self.names)))
+
+    def abort(self):
+        '''
+        Close and remove the partially written archive
+        '''
+        try:
+            if self.fmt == "zip":
+                self.zip.close()
+            else:
+                self.tar.close()
+        finally:
+            if os.path.exists(self.tmpfn):
+                os.unlink(self.tmpfn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
@@ -0,0 +1,39 @@
+'''
+Small helpers for PNG files produced by the image tools (pdftoppm, convert).
+'''
+
+import struct
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# chunks which carry build-time metadata (e.g. ImageMagick's date:create and date:modify)
+# rather than image data
+VOLATILE_CHUNKS = (b'tEXt', b'zTXt', b'iTXt', b'tIME')
+
+def strip_png_metadata(fn):
+    '''
+    Remove text and timestamp chunks from PNG file fn, so that identical images
+    are byte-identical regardless of when they were made.
+    Return True if the file was changed.
+    '''
+    with open(fn, 'rb') as fp:
+        data = fp.read()
+    if not data.startswith(PNG_SIGNATURE):
+        return False
+    chunks = [PNG_SIGNATURE]
+    pos = len(PNG_SIGNATURE)
+    while pos + 8 <= len(data):
+        (length,) = struct.unpack('>I', data[pos:pos+4])
+        ctype = data[pos+4:pos+8]
+        end = pos + 12 + length		# length, type, data, crc
+        if ctype not in VOLATILE_CHUNKS:
+            chunks.append(data[pos:end])
+        pos = end
+        if ctype == b'IEND':
+            break
+    newdata = b''.join(chunks)
+    if newdata == data:
+        return False
+    with open(fn, 'wb') as fp:
+        fp.write(newdata)
+    return True
@@ -0,0 +1,338 @@
+'''
+Shared build cache over HTTP: a simple key/value server, storing blobs by key
+(GET, HEAD, and PUT /<key>), and artifact stores using one, so that the label
+images rendered by one author's (or CI runner's) build are reused by everyone's.
+
+Run the bundled cache server with
+
+    latex2dnd cache-server --dir /srv/latex2dnd-cache --port 8081
+
+and build with
+
+    latex2dnd --remote-cache http://cachehost:8081 ...
+
+Builds look up label images in their local cache directory (--label-cache)
+first; misses fall through to the shared cache, fetched in parallel over
+persistent connections, and what they find is kept locally.  Newly rendered
+labels are stored in both.  The shared cache being unreachable only makes
+builds slower: its errors count as misses.
+
+The server does not authenticate clients, and cannot check what they store:
+cache keys name what was rendered (label TeX, size, and resolution), not the
+contents.  Anyone who can reach it can replace any label image, so run it
+only on a trusted network (or behind an authenticating proxy).
+'''
+
+import os
+import re
+import sys
+import http.client
+import threading
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .store import ArtifactStore
+
+KEY_PATTERN = re.compile(r'^[0-9a-f]{16,128}$')
+DEFAULT_LOCAL_CACHE = os.path.join('~', '.cache', 'latex2dnd', 'labels')
+
+class HttpArtifactStore(object):
+    '''
+    Artifact store backed by an HTTP key/value cache server.  Each thread keeps its own
+    persistent (keep-alive) connection, which is reused for all its requests; get_many
+    fetches on a pool of fetch_jobs threads kept for the life of the store, so that their
+    connections are reused too.
+    '''
+    _stores = {}
+    _stores_lock = threading.Lock()
+
+    def __init__(self, url, timeout=10, fetch_jobs=8, verbose=False):
+        '''
+        url = base URL of the cache server, e.g. http://cachehost:8081
+        timeout = seconds to wait for the server
+        fetch_jobs = number of blobs fetched in parallel by get_many
+        '''
+        parts = urlsplit(url)
+        if parts.scheme not in ['http', 'https']:
+            raise ValueError("Bad cache URL %s (should be http://host:port)" % url)
+        self.url = url.rstrip('/')
+        self.scheme = parts.scheme
+        self.netloc = parts.netloc
+        self.prefix = parts.path.rstrip('/')
+        self.timeout = timeout
+        self.fetch_jobs = fetch_jobs
+        self.verbose = verbose
+        self.local = threading.local()
+        self.connections = 0		# number of connections opened
+        self.errors = 0
+        self.count_lock = threading.Lock()
+        self.pool = None
+        self.pool_pid = None
+        self.pool_lock = threading.Lock()
+
+    @classmethod
+    def for_url(cls, url, **kwargs):
+        '''
+        Return the store for url (and options kwargs) shared by all builds in this process, so that its
+        connections are reused
+        '''
+        key = (url.rstrip('/'), tuple(sorted(kwargs.items())))
+        with cls._stores_lock:
+            if key not in cls._stores:
+                cls._stores[key] = cls(url, **kwargs)
+            return cls._stores[key]
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():	# connections are not shared with forked processes
+            if self.scheme == 'https':
+                conn = http.client.HTTPSConnection(self.netloc, timeout=self.timeout)
+            else:
+                conn = http.client.HTTPConnection(self.netloc, timeout=self.timeout)
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+            with self.count_lock:
+                self.connections += 1
+        return conn
+
+    def request(self, method, key, data=None):
+        '''
+        Send request for key; return (status, body).  A dropped keep-alive connection is retried once
+        on a new connection.  Errors (e.g. server unreachable) return (None, None).
+        '''
+        if not KEY_PATTERN.match(key):
+            raise ValueError("Bad cache key %s" % key)
+        for attempt in range(2):
+            conn = self.connection()
+            try:
+                conn.request(method, "%s/%s" % (self.prefix, key), body=data)
+                resp = conn.getresponse()
+                return (resp.status, resp.read())
+            except (http.client.HTTPException, OSError) as err:
+                conn.close()
+                self.local.conn = None
+                if attempt:
+                    with self.count_lock:
+                        self.errors += 1
+                    if self.verbose:
+                        print("[latex2dnd] remote cache %s: %s %s failed, err=%s" % (self.url, method, key, err))
+        return (None, None)
+
+    def has(self, key):
+        return self.request('HEAD', key)[0] == 200
+
+    def get(self, key):
+        '''
+        Return bytes stored under key, or None if not present (or the server cannot be reached)
+        '''
+        (status, data) = self.request('GET', key)
+        return data if status == 200 else None
+
+    def get_many(self, keys):
+        '''
+        Return list of the bytes stored under each of keys (None for misses), fetched in parallel
+        '''
+        keys = list(keys)
+        if len(keys) < 2 or self.fetch_jobs < 2:
+            return [self.get(key) for key in keys]
+        return list(self.fetch_pool().map(self.get, keys))
+
+    def fetch_pool(self):
+        '''
+        Return the pool of fetch threads, started on first use (and again in forked processes, which
+        do not inherit threads)
+        '''
+        with self.pool_lock:
+            if self.pool is None or self.pool_pid != os.getpid():
+                self.pool = ThreadPoolExecutor(max_workers=self.fetch_jobs)
+                self.pool_pid = os.getpid()
+            return self.pool
+
+    def close(self):
+        '''
+        Stop the fetch threads, and close this thread's connection
+        '''
+        with self.pool_lock:
+            if self.pool is not None and self.pool_pid == os.getpid():
+                self.pool.shutdown()
+            self.pool = None
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+    def put(self, key, data):
+        '''
+        Store data under key.  Return key, or None if the server could not store it.
+        '''
+        (status, body) = self.request('PUT', key, data)
+        return key if status in [200, 201, 204] else None
+
+class TieredArtifactStore(ArtifactStore):
+    '''
+    Local ArtifactStore in front of a shared HttpArtifactStore: local misses fall through to the
+    shared store (blobs found there are kept locally), and new blobs are stored in both.  Blobs
+    already stored locally are uploaded if the shared store does not have them (e.g. it was
+    emptied, or they were rendered before it was used).
+    '''
+    def __init__(self, root, remote, verbose=False):
+        ArtifactStore.__init__(self, root, verbose=verbose)
+        self.remote = remote
+        self.remote_hits = 0
+        self.remote_keys = set()		# keys known to be in the shared store
+
+    def has(self, key):
+        return ArtifactStore.has(self, key) or self.remote.has(key)
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def get_many(self, keys):
+        keys = list(keys)
+        found = [ArtifactStore.get(self, key) for key in keys]
+        missing = [k for k, data in enumerate(found) if data is None]
+        for k, data in zip(missing, self.remote.get_many([keys[k] for k in missing])):
+            if data is not None:
+                ArtifactStore.put(self, keys[k], data)
+                self.remote_keys.add(keys[k])
+                self.remote_hits += 1
+                found[k] = data
+        return found
+
+    def put(self, key, data):
+        if key not in self.remote_keys:
+            if (ArtifactStore.has(self, key) and self.remote.has(key)) or self.remote.put(key, data):
+                self.remote_keys.add(key)
+        return ArtifactStore.put(self, key, data)
+
+def open_store(local, remote_url=None, verbose=False):
+    '''
+    Return the artifact store for local directory local (or ArtifactStore), with the shared cache
+    at remote_url behind it, if given.  The local directory defaults to ~/.cache/latex2dnd/labels
+    when only a remote cache is given.
+    '''
+    if remote_url is None:
+        if isinstance(local, ArtifactStore):
+            return local
+        return ArtifactStore(local, verbose=verbose)
+    if isinstance(local, ArtifactStore):
+        local = local.root
+    local = local or os.path.expanduser(DEFAULT_LOCAL_CACHE)
+    return TieredArtifactStore(local, HttpArtifactStore.for_url(remote_url, verbose=verbose), verbose=verbose)
+
+class CacheRequestHandler(BaseHTTPRequestHandler):
+    '''
+    GET, HEAD, and PUT of blobs by key, stored in the server's ArtifactStore
+    '''
+    protocol_version = "HTTP/1.1"		# keep-alive, for connection reuse
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def send_data(self, code, data, content_type="application/octet-stream", body=True):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if body:
+            self.wfile.write(data)
+
+    def key(self):
+        key = self.path.split('?')[0].strip('/').split('/')[-1]
+        return key if KEY_PATTERN.match(key) else None
+
+    def do_GET(self, body=True):
+        key = self.key()
+        if key is None:
+            return self.send_data(400, b'bad key\n', "text/plain", body)
+        data = self.server.store.get(key)
+        if data is None:
+            self.server.count('misses')
+            return self.send_data(404, b'not found\n', "text/plain", body)
+        self.server.count('hits')
+        self.send_data(200, data, body=body)
+
+    def do_HEAD(self):
+        self.do_GET(body=False)
+
+    def do_PUT(self):
+        key = self.key()
+        nbytes = int(self.headers.get('Content-Length', 0))
+        if nbytes > self.server.max_blob_bytes:
+            self.close_connection = True		# the body is not read
+            return self.send_data(413, b'too large\n', "text/plain")
+        data = self.rfile.read(nbytes)
+        if key is None:
+            return self.send_data(400, b'bad key\n', "text/plain")
+        existed = self.server.store.has(key)
+        self.server.store.put(key, data)
+        self.server.count('puts')
+        self.send_data(200 if existed else 201, b'')
+
+class CacheServer(ThreadingHTTPServer):
+    '''
+    Minimal HTTP key/value cache server, storing blobs in a local directory; port=0 picks a free port.
+    It accepts any blob under any key, from anyone: serve only trusted networks.
+    '''
+    daemon_threads = True
+
+    def __init__(self, root, host="127.0.0.1", port=8081, max_blob_bytes=50000000, verbose=False):
+        self.store = ArtifactStore(root)
+        self.max_blob_bytes = max_blob_bytes
+        self.verbose = verbose
+        self.stats = {'hits': 0, 'misses': 0, 'puts': 0}
+        self.stats_lock = threading.Lock()
+        ThreadingHTTPServer.__init__(self, (host, port), CacheRequestHandler)
+
+    def count(self, name):
+        with self.stats_lock:
+            self.stats[name] += 1
+
+    def url(self):
+        return "http://%s:%d" % self.server_address[:2]
+
+def CacheServerCommandLine(arglist=None):
+    '''
+    latex2dnd cache-server [options]
+    '''
+    import optparse
+    parser = optparse.OptionParser(usage="usage: %prog cache-server [options]")
+    parser.add_option("--dir",
+                      action="store",
+                      dest="dir",
+                      default="latex2dnd_cache",
+                      help="Directory in which cached blobs are stored (default latex2dnd_cache)",)
+    parser.add_option("--host",
+                      action="store",
+                      dest="host",
+                      default="127.0.0.1",
+                      help="Address to listen on (default 127.0.0.1).  The server does not authenticate clients: listen only on trusted networks",)
+    parser.add_option("--port",
+                      action="store",
+                      type="int",
+                      dest="port",
+                      default=8081,
+                      help="Port to listen on (default 8081)",)
+    parser.add_option("-v", "--verbose",
+                      action="store_true",
+                      dest="verbose",
+                      default=False,
+                      help="Log every request",)
+    (opts, args) = parser.parse_args(arglist)
+    if args:
+        parser.error('cache-server takes no arguments')
+    server = CacheServer(opts.dir, host=opts.host, port=opts.port, verbose=opts.verbose)
+    print("[latex2dnd] Serving build cache in %s on %s" % (opts.dir, server.url()))
+    if not opts.host.startswith('127.') and opts.host not in ['localhost', '::1']:
+        print("[latex2dnd] Warning: anyone who can reach %s can overwrite cached labels; serve only trusted networks"
+              % server.url())
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return server
@@ -0,0 +1,353 @@
+'''
+Local HTTP build server: authors submit .tex or .dndspec sources, and get back the
+problem XML and images, without needing a local TeX install.
+
+Usage:
+
+    latex2dnd serve [options]
+
+Endpoints:
+
+    POST /jobs				submit a build; JSON body with keys
+					  source = TeX or dndspec text
+					  name = problem name (default "problem"; letters,
+					    digits, _ and - only)
+					  format = "tex" or "dndspec" (default "tex")
+					  files = optional dict of filename -> base64 data (figures, .sty files)
+					returns the job status (202 if queued, 200 if an identical
+					submission was already built or is in progress)
+    GET  /jobs/<id>			job status: queued, running, done, or failed.  Only the
+					most recent finished jobs are kept (see --keep-jobs);
+					older ones are forgotten, and return 404.
+    GET  /jobs/<id>/artifacts.zip	zip of the XML, images, and formula test results
+    GET  /stats				queue depth, job counts, and build latency
+
+Builds run on a bounded pool of worker threads, each in its own scratch directory
+(see latex2dnd.api.build_dnd).  Submissions are keyed by a hash of their content,
+so an identical submission reuses the previous result.
+'''
+
+import io
+import sys
+import math
+import json
+import time
+import base64
+import hashlib
+import zipfile
+import threading
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .api import build_dnd, check_name, check_filename
+
+def submission_key(name, fmt, source, files):
+    '''
+    Return hash identifying a submission by its content
+    '''
+    sha = hashlib.sha256(json.dumps([name, fmt, source, sorted(files.keys())]).encode('utf8'))
+    for bn in sorted(files.keys()):
+        data = files[bn]
+        sha.update(data if isinstance(data, bytes) else data.encode('utf8'))
+    return sha.hexdigest()[:16]
+
+def percentile(values, pct):
+    '''
+    Return the pct percentile of list values (nearest rank), or None if empty
+    '''
+    if not values:
+        return None
+    values = sorted(values)
+    k = int(math.ceil(pct / 100.0 * len(values))) - 1
+    return round(values[max(0, k)], 3)
+
+class BuildJob(object):
+    '''
+    One submitted build, and (when done) its DragDropResult
+    '''
+    def __init__(self, key, name, fmt, source, files):
+        self.id = key
+        self.name = name
+        self.fmt = fmt
+        self.source = source
+        self.files = files
+        self.status = "queued"
+        self.error = None
+        self.result = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    def info(self):
+        ret = OrderedDict([('id', self.id),
+                           ('name', self.name),
+                           ('status', self.status),
+                           ('error', self.error),
+                           ])
+        if self.finished is not None:
+            ret['build_seconds'] = round(self.finished - self.started, 3)
+            ret['total_seconds'] = round(self.finished - self.submitted, 3)
+        if self.status == "done":
+            ret['artifacts'] = '/jobs/%s/artifacts.zip' % self.id
+            ret['files'] = list(self.result.files().keys())
+            ret['test_results'] = self.result.test_results
+        return ret
+
+    def artifacts_zip(self):
+        '''
+        Return bytes of a zip file with all the job's outputs
+        '''
+        sio = io.BytesIO()
+        with zipfile.ZipFile(sio, "w", zipfile.ZIP_DEFLATED) as zfp:
+            for bn, data in self.result.files().items():
+                zfp.writestr(bn, data)
+        return sio.getvalue()
+
+class JobQueue(object):
+    '''
+    Queue of build jobs, run on a pool of at most workers threads.  At most max_queued
+    jobs may be waiting; further submissions are refused until the queue drains.  Only the
+    keep_finished most recently finished jobs (with their results) are kept in memory.
+    '''
+    def __init__(self, workers=2, max_queued=100, build_options=None, build_func=build_dnd, verbose=False,
+                 keep_finished=100):
+        '''
+        build_options = LatexToDragDrop keyword arguments used for every build
+        build_func = function building one problem, called as build_func(source, name=, fmt=,
+                     extra_files=, **build_options) and returning a DragDropResult
+        '''
+        self.workers = workers
+        self.max_queued = max_queued
+        self.keep_finished = keep_finished
+        self.build_options = build_options or {}
+        self.build_func = build_func
+        self.verbose = verbose
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.jobs = OrderedDict()
+        self.nsubmitted = 0
+        self.nreused = 0
+        self.nexpired = 0
+
+    def submit(self, source, name="problem", fmt="tex", files=None):
+        '''
+        Queue a build; return (job, reused).  Raises QueueFull if too many jobs are waiting.
+        '''
+        if fmt not in ["tex", "dndspec"]:
+            raise ValueError("Unknown source format %s (use tex or dndspec)" % fmt)
+        check_name(name)
+        files = files or {}
+        for bn in files:
+            check_filename(bn)
+        key = submission_key(name, fmt, source, files)
+        with self.lock:
+            self.nsubmitted += 1
+            job = self.jobs.get(key)
+            if job is not None and job.status != "failed":
+                self.nreused += 1
+                return job, True
+            if self.count("queued") >= self.max_queued:
+                raise QueueFull("%d jobs already queued" % self.max_queued)
+            job = BuildJob(key, name, fmt, source, files)
+            self.jobs.pop(key, None)
+            self.jobs[key] = job
+        self.pool.submit(self.run_job, job)
+        return job, False
+
+    def run_job(self, job):
+        job.started = time.time()
+        job.status = "running"
+        try:
+            options = dict(self.build_options)
+            job.result = self.build_func(job.source, name=job.name, fmt=job.fmt, extra_files=job.files, **options)
+            status = "done"
+        except (Exception, SystemExit) as err:
+            job.error = "%s: %s" % (err.__class__.__name__, err)
+            status = "failed"
+            if self.verbose:
+                traceback.print_exc()
+        job.finished = time.time()
+        job.status = status
+        with self.lock:
+            self.expire()
+        print("[latex2dnd] %s job %s (%s) in %.1f sec" % (job.status, job.id, job.name, job.finished - job.started))
+        sys.stdout.flush()
+
+    def expire(self):
+        '''
+        Forget the oldest finished jobs beyond keep_finished, so that a long-running server does not keep
+        every result in memory.  Call with self.lock held.
+        '''
+        finished = sorted([job for job in self.jobs.values() if job.finished is not None], key=lambda job: job.finished)
+        for job in finished[:max(0, len(finished) - self.keep_finished)]:
+            del self.jobs[job.id]
+            self.nexpired += 1
+
+    def get(self, key):
+        with self.lock:
+            return self.jobs.get(key)
+
+    def count(self, status):
+        return len([job for job in list(self.jobs.values()) if job.status == status])
+
+    def stats(self):
+        '''
+        Return dict of queue depth, job counts, and build latency statistics
+        '''
+        with self.lock:
+            jobs = list(self.jobs.values())
+        finished = [job for job in jobs if job.finished is not None]
+        ret = OrderedDict([('queue_depth', len([job for job in jobs if job.status == "queued"])),
+                           ('running', len([job for job in jobs if job.status == "running"])),
+                           ('workers', self.workers),
+                           ('submitted', self.nsubmitted),
+                           ('reused', self.nreused),
+                           ('done', len([job for job in jobs if job.status == "done"])),
+                           ('failed', len([job for job in jobs if job.status == "failed"])),
+                           ('expired', self.nexpired),
+                           ])
+        for what, values in [('build_seconds', [job.finished - job.started for job in finished]),
+                             ('total_seconds', [job.finished - job.submitted for job in finished])]:
+            ret[what] = OrderedDict([('count', len(values)),
+                                     ('mean', round(sum(values) / len(values), 3) if values else None),
+                                     ('p50', percentile(values, 50)),
+                                     ('p90', percentile(values, 90)),
+                                     ('max', round(max(values), 3) if values else None),
+                                     ])
+        return ret
+
+    def shutdown(self, wait=True):
+        self.pool.shutdown(wait=wait)
+
+class QueueFull(Exception):
+    pass
+
+class BuildRequestHandler(BaseHTTPRequestHandler):
+    '''
+    HTTP interface to the server's JobQueue
+    '''
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def send_data(self, code, data, content_type):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_json(self, code, obj):
+        self.send_data(code, json.dumps(obj, indent=4).encode('utf8'), "application/json")
+
+    def do_GET(self):
+        queue = self.server.queue
+        parts = self.path.split('?')[0].strip('/').split('/')
+        if parts == ['stats']:
+            return self.send_json(200, queue.stats())
+        if len(parts) in [2, 3] and parts[0] == 'jobs':
+            job = queue.get(parts[1])
+            if job is None:
+                return self.send_json(404, {'error': 'no job %s' % parts[1]})
+            if len(parts) == 2:
+                return self.send_json(200, job.info())
+            if parts[2] == 'artifacts.zip':
+                if job.status != "done":
+                    return self.send_json(409, job.info())
+                return self.send_data(200, job.artifacts_zip(), "application/zip")
+        self.send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path.split('?')[0].strip('/') != 'jobs':
+            return self.send_json(404, {'error': 'not found'})
+        try:
+            nbytes = int(self.headers.get('Content-Length', 0))
+            if nbytes > self.server.max_request_bytes:
+                return self.send_json(413, {'error': 'request too large (%d bytes)' % nbytes})
+            req = json.loads(self.rfile.read(nbytes).decode('utf8'))
+            name = req.get('name', 'problem')
+            check_name(name)
+            files = dict((bn, base64.b64decode(data)) for bn, data in (req.get('files') or {}).items())
+            for bn in files:
+                check_filename(bn)
+            job, reused = self.server.queue.submit(req['source'],
+                                                   name=name,
+                                                   fmt=req.get('format', 'tex'),
+                                                   files=files)
+        except QueueFull as err:
+            return self.send_json(503, {'error': 'queue full: %s' % err})
+        except (KeyError, ValueError, TypeError) as err:
+            return self.send_json(400, {'error': "%s: %s" % (err.__class__.__name__, err)})
+        self.send_json(200 if reused else 202, job.info())
+
+class BuildServer(ThreadingHTTPServer):
+    '''
+    HTTP build server; port=0 picks a free port (see server_address)
+    '''
+    daemon_threads = True
+
+    def __init__(self, queue, host="127.0.0.1", port=8080, max_request_bytes=10000000, verbose=False):
+        self.queue = queue
+        self.max_request_bytes = max_request_bytes
+        self.verbose = verbose
+        ThreadingHTTPServer.__init__(self, (host, port), BuildRequestHandler)
+
+    def url(self):
+        return "http://%s:%d" % self.server_address[:2]
+
+def ServeCommandLine(arglist=None):
+    '''
+    latex2dnd serve [options]
+    '''
+    from .main import make_option_parser, build_options
+    parser = make_option_parser(usage="usage: %prog serve [options]")
+    parser.add_option("--host",
+                      action="store",
+                      dest="host",
+                      default="127.0.0.1",
+                      help="Address to listen on (default 127.0.0.1)",)
+    parser.add_option("--port",
+                      action="store",
+                      type="int",
+                      dest="port",
+                      default=8080,
+                      help="Port to listen on (default 8080)",)
+    parser.add_option("-j", "--jobs",
+                      action="store",
+                      type="int",
+                      dest="jobs",
+                      default=2,
+                      help="Number of builds to run in parallel (default 2)",)
+    parser.add_option("--max-queued",
+                      action="store",
+                      type="int",
+                      dest="max_queued",
+                      default=100,
+                      help="Maximum number of jobs waiting to be built (default 100)",)
+    parser.add_option("--keep-jobs",
+                      action="store",
+                      type="int",
+                      dest="keep_jobs",
+                      default=100,
+                      help="Number of finished jobs (and their outputs) kept for clients to fetch (default 100)",)
+    (opts, args) = parser.parse_args(arglist)
+    if args:
+        parser.error('serve takes no arguments')
+    options = build_options(opts)
+    for name in ['compile', 'outdir']:
+        options.pop(name)
+    queue = JobQueue(workers=opts.jobs, max_queued=opts.max_queued, build_options=options, verbose=opts.verbose,
+                     keep_finished=opts.keep_jobs)
+    server = BuildServer(queue, host=opts.host, port=opts.port, verbose=opts.verbose)
+    print("[latex2dnd] Serving builds on %s, with %d workers" % (server.url(), opts.jobs))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        queue.shutdown(wait=False)
+    return server
@@ -0,0 +1,80 @@
+'''
+Deterministic sharding of batch builds: split the problems of a course build
+into N balanced subsets, so that N parallel CI jobs each build one, e.g.
+
+    latex2dnd batch --shard 2/4 --manifest shard2.json problems/
+
+Without timing data, problems are assigned by a stable hash of their path.  With
+the build times of an earlier build (the problems section of a build manifest,
+given by --shard-costs), they are assigned slowest first, each to the shard with
+the least total build time so far, which balances the shards' build times.
+
+Every shard computes the same partition independently, from the same problem list
+and timing data.  Combine the per-shard manifests with latex2dnd manifest-merge.
+'''
+
+import os
+import hashlib
+
+from .manifest import BuildManifest
+
+def parse_shard(spec):
+    '''
+    Parse shard specification "i/N" (1 <= i <= N); return (i, N)
+    '''
+    try:
+        (index, count) = [int(x) for x in spec.split('/')]
+    except ValueError:
+        raise ValueError("Bad shard %s (should be i/N, e.g. 1/4)" % spec)
+    if not (count >= 1 and 1 <= index <= count):
+        raise ValueError("Bad shard %s (should be i/N, with 1 <= i <= N)" % spec)
+    return (index, count)
+
+def problem_key(problem):
+    '''
+    Return key identifying problem across machines: its path relative to the current directory
+    '''
+    return os.path.normpath(os.path.relpath(problem)).replace(os.sep, '/')
+
+def stable_hash(key):
+    return int(hashlib.sha256(key.encode('utf8')).hexdigest()[:16], 16)
+
+def load_costs(fns):
+    '''
+    Return dict with key = problem key, val = build seconds, from the build manifests fns
+    '''
+    costs = {}
+    for fn in fns:
+        for problem, info in BuildManifest.load(fn).problems.items():
+            if info.get('seconds') is not None:
+                costs[problem_key(problem)] = float(info['seconds'])
+    return costs
+
+def partition(problems, count, costs=None):
+    '''
+    Split problems into count shards; return list of count lists of problems (each in the
+    original order).  costs = dict with key = problem key, val = estimated build seconds.
+    '''
+    shards = [[] for k in range(count)]
+    keys = dict((problem, problem_key(problem)) for problem in problems)
+    known = [costs[key] for key in keys.values() if key in (costs or {})]
+    if not known:
+        for problem in problems:
+            shards[stable_hash(keys[problem]) % count].append(problem)
+        return shards
+    default_cost = sum(known) / len(known)		# for problems without timing data
+    cost = dict((problem, costs.get(keys[problem], default_cost)) for problem in problems)
+    totals = [0.0] * count
+    for problem in sorted(problems, key=lambda x: (-cost[x], keys[x])):
+        k = totals.index(min(totals))
+        shards[k].append(problem)
+        totals[k] += cost[problem]
+    order = dict((problem, n) for n, problem in enumerate(problems))
+    return [sorted(shard, key=order.get) for shard in shards]
+
+def select_shard(problems, spec, costs=None):
+    '''
+    Return the problems in shard spec ("i/N")
+    '''
+    (index, count) = parse_shard(spec)
+    return partition(problems, count, costs)[index - 1]
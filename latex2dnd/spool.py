@@ -0,0 +1,421 @@
+'''
+Spool-directory work queue: build workers on several machines sharing a filesystem
+take jobs from a common spool directory, with no broker service.
+
+Usage:
+
+    latex2dnd worker --spool DIR --submit [dir_or_file ...]	# queue problems
+    latex2dnd worker --spool DIR [options]			# run a worker
+
+Spool directory layout:
+
+    queue/<id>.json	jobs waiting to be built
+    claimed/<id>.json	jobs being built; a worker claims a job by renaming it from queue/
+			(atomic, so each job is claimed by exactly one worker), then records
+			its worker id and a claim token in it, and touches it periodically
+			while building
+    results/<id>.json	build result (status, artifacts, error, worker)
+    logs/<id>.log	build output, including pdflatex's
+
+A claim not touched for longer than the lease timeout (e.g. its worker died) is
+renamed back into queue/, and built again by the next free worker.  A worker
+whose claim was lost that way (e.g. it was suspended) discards its own result
+when it finishes, leaving the job to its new claimant.
+
+Finishing, releasing, or requeueing a claim first renames it aside, to
+claimed/<id>.<token>.<action> (atomic, so no other worker can act on it
+meanwhile), then checks it: a claim which turns out to be someone else's (or
+no longer stale) is renamed back.
+'''
+
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import hashlib
+import threading
+import contextlib
+import traceback
+from collections import OrderedDict
+
+from .fileutil import write_if_changed
+
+SPOOL_DIRS = ["queue", "claimed", "results", "logs"]
+
+@contextlib.contextmanager
+def redirect_output(logfn):
+    '''
+    Send stdout and stderr (at the file descriptor level, so that the output of
+    subprocesses like pdflatex is included) to logfn, within the context.
+    '''
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = [os.dup(1), os.dup(2)]
+    saved_files = (sys.stdout, sys.stderr)
+    with open(logfn, 'a', buffering=1) as fp:
+        os.dup2(fp.fileno(), 1)
+        os.dup2(fp.fileno(), 2)
+        sys.stdout = sys.stderr = fp
+        try:
+            yield
+        finally:
+            fp.flush()
+            (sys.stdout, sys.stderr) = saved_files
+            os.dup2(saved[0], 1)
+            os.dup2(saved[1], 2)
+            for fd in saved:
+                os.close(fd)
+
+class Spool(object):
+    '''
+    Spool directory of build jobs
+    '''
+    def __init__(self, spooldir, lease=600):
+        '''
+        spooldir = spool directory (created if missing)
+        lease = seconds after which an untouched claim is considered stale
+        '''
+        self.dir = os.path.abspath(spooldir)
+        self.lease = lease
+        for name in SPOOL_DIRS:
+            if not os.path.isdir(self.path(name)):
+                os.makedirs(self.path(name), exist_ok=True)
+
+    def path(self, *parts):
+        return os.path.join(self.dir, *parts)
+
+    @staticmethod
+    def job_id(problem):
+        '''
+        Return job id for problem source file: its stem, plus a hash of its absolute path
+        '''
+        problem = os.path.abspath(problem)
+        stem = os.path.splitext(os.path.basename(problem))[0]
+        return "%s-%s" % (stem, hashlib.sha256(problem.encode('utf8')).hexdigest()[:8])
+
+    def submit(self, problem):
+        '''
+        Queue a build of problem; return the job id
+        '''
+        problem = os.path.abspath(problem)
+        jid = self.job_id(problem)
+        job = OrderedDict([('id', jid), ('problem', problem), ('submitted', time.time()), ('attempts', 0)])
+        write_if_changed(self.path("queue", jid + ".json"), json.dumps(job, indent=4))
+        return jid
+
+    def pending(self):
+        return sorted(fn[:-5] for fn in os.listdir(self.path("queue")) if fn.endswith(".json"))
+
+    def claimed(self):
+        return sorted(fn[:-5] for fn in os.listdir(self.path("claimed")) if fn.endswith(".json"))
+
+    def claim(self, worker=None):
+        '''
+        Claim the next queued job for worker (id string); return the job (dict), or None if the queue
+        is empty.  The job's claim token identifies this claim in touch, finish, and release.
+        '''
+        for jid in self.pending():
+            qfn = self.path("queue", jid + ".json")
+            cfn = self.path("claimed", jid + ".json")
+            try:
+                os.utime(qfn)		# rename keeps the mtime, which must not look stale once claimed
+                os.rename(qfn, cfn)
+            except (FileNotFoundError, PermissionError):
+                continue		# claimed by another worker first
+            try:
+                with open(cfn) as fp:
+                    job = json.load(fp)
+            except FileNotFoundError:
+                continue		# requeued meanwhile
+            job['attempts'] = job.get('attempts', 0) + 1
+            job['worker'] = worker
+            job['token'] = uuid.uuid4().hex
+            write_if_changed(cfn, json.dumps(job, indent=4))
+            return job
+        return None
+
+    def take_aside(self, jid, token, action):
+        '''
+        Rename the claim on job jid aside, to a name no other worker acts on; return
+        (private filename, claim dict), or (None, None) if there is no claim
+        '''
+        private = self.path("claimed", "%s.%s.%s" % (jid, token or uuid.uuid4().hex, action))
+        try:
+            os.rename(self.path("claimed", jid + ".json"), private)
+            with open(private) as fp:
+                return (private, json.load(fp))
+        except FileNotFoundError:
+            return (None, None)
+        except ValueError:
+            return (private, {})
+
+    def put_back(self, private, jid):
+        '''
+        Rename a claim taken aside back, unless the job was claimed again meanwhile
+        '''
+        cfn = self.path("claimed", jid + ".json")
+        try:
+            os.link(private, cfn)
+        except FileExistsError:
+            pass			# the newer claim stands
+        except OSError:
+            os.replace(private, cfn)	# no hard links on this filesystem
+            return
+        os.unlink(private)
+
+    def requeue(self, private, claim):
+        '''
+        Move a claim taken aside back into the queue, without its claim token, so that a late
+        finish or release by its former worker cannot mistake the next claim for its own
+        '''
+        for key in ['token', 'worker']:
+            claim.pop(key, None)
+        if claim:
+            write_if_changed(private, json.dumps(claim, indent=4))
+        os.rename(private, self.path("queue", os.path.basename(private).rsplit('.', 2)[0] + ".json"))
+
+    def holds(self, job):
+        '''
+        Return True if the claim on job is still the one this job was claimed with (it may have been
+        requeued as stale, and claimed by another worker, meanwhile)
+        '''
+        try:
+            with open(self.path("claimed", job['id'] + ".json")) as fp:
+                claim = json.load(fp)
+        except (FileNotFoundError, ValueError):
+            return False
+        return claim.get('token') == job.get('token')
+
+    def touch(self, job):
+        '''
+        Renew the lease on claimed job; return False if the claim is no longer held (e.g. was requeued)
+        '''
+        if not self.holds(job):
+            return False
+        try:
+            os.utime(self.path("claimed", job['id'] + ".json"))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def requeue_stale(self):
+        '''
+        Move claims older than the lease timeout back into the queue; return list of their job ids
+        '''
+        requeued = []
+        for jid in self.claimed():
+            try:
+                if time.time() - os.path.getmtime(self.path("claimed", jid + ".json")) < self.lease:
+                    continue
+            except FileNotFoundError:
+                continue
+            (private, claim) = self.take_aside(jid, None, 'requeue')
+            if private is None:
+                continue
+            if time.time() - os.path.getmtime(private) < self.lease:
+                self.put_back(private, jid)		# renewed (or claimed again) meanwhile
+                continue
+            self.requeue(private, claim)
+            requeued.append(jid)
+        return requeued
+
+    def finish(self, job, result):
+        '''
+        Write the result of job, and remove its claim.  If the claim is no longer held (it was requeued,
+        and maybe claimed by another worker), nothing is done, and False is returned.
+        '''
+        (private, claim) = self.take_aside(job['id'], job.get('token'), 'finish')
+        if private is None:
+            return False
+        if claim.get('token') != job.get('token'):
+            self.put_back(private, job['id'])
+            return False
+        write_if_changed(self.path("results", job['id'] + ".json"), json.dumps(result, indent=4))
+        os.unlink(private)
+        return True
+
+    def release(self, job):
+        '''
+        Give up the claim on job, putting it back in the queue
+        '''
+        (private, claim) = self.take_aside(job['id'], job.get('token'), 'release')
+        if private is None:
+            return
+        if claim.get('token') != job.get('token'):
+            self.put_back(private, job['id'])
+            return
+        self.requeue(private, claim)
+
+    def result(self, jid):
+        fn = self.path("results", jid + ".json")
+        if not os.path.exists(fn):
+            return None
+        with open(fn) as fp:
+            return json.load(fp)
+
+class Heartbeat(object):
+    '''
+    Thread renewing the lease on a claimed job, every interval seconds, until stopped
+    '''
+    def __init__(self, spool, job, interval):
+        self.spool = spool
+        self.job = job
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            if not self.spool.touch(self.job):
+                return
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+class SpoolWorker(object):
+    '''
+    Worker building jobs from a spool, one at a time.  Run several workers (on one
+    or many hosts) to build in parallel.
+    '''
+    def __init__(self, spool, opts, build_func=None, poll=2.0, max_attempts=3, verbose=False):
+        '''
+        spool = Spool instance
+        opts = parsed build options (as for latex2dnd batch)
+        build_func = function building one problem, called as build_func(problem, opts) and returning
+                     a result dict (default: latex2dnd.batch.build_problem)
+        poll = seconds to wait between checks of an empty queue
+        max_attempts = a job claimed this many times without finishing is failed, instead of built again
+        '''
+        from .batch import build_problem, absolute_options
+        self.spool = spool
+        self.opts = absolute_options(opts)
+        self.build_func = build_func or build_problem
+        self.poll = poll
+        self.max_attempts = max_attempts
+        self.verbose = verbose
+        self.worker = "%s:%d" % (socket.gethostname(), os.getpid())
+        self.nbuilt = 0
+
+    def build(self, job):
+        '''
+        Build one claimed job, with its output going to its log file; return the result dict
+        '''
+        logfn = self.spool.path("logs", job['id'] + ".log")
+        start = time.time()
+        if job['attempts'] > self.max_attempts:
+            result = OrderedDict([('name', job['id']), ('status', 'failed'), ('seconds', 0), ('artifacts', []),
+                                  ('error', "abandoned after %d attempts" % (job['attempts'] - 1))])
+        else:
+            heartbeat = Heartbeat(self.spool, job, max(self.spool.lease / 3.0, 0.01))
+            try:
+                with redirect_output(logfn):
+                    print("[latex2dnd] worker %s building %s (attempt %d)" % (self.worker, job['problem'], job['attempts']))
+                    try:
+                        result = self.build_func(job['problem'], self.opts)
+                    except (Exception, SystemExit) as err:
+                        traceback.print_exc()
+                        result = OrderedDict([('name', job['id']), ('status', 'failed'), ('seconds', 0),
+                                              ('artifacts', []), ('error', "%s: %s" % (err.__class__.__name__, err))])
+            finally:
+                heartbeat.stop()
+        result = OrderedDict(result)
+        result['problem'] = job['problem']
+        result['worker'] = self.worker
+        result['attempts'] = job['attempts']
+        result['log'] = logfn
+        result['finished'] = time.time()
+        held = self.spool.finish(job, result)
+        self.nbuilt += 1
+        msg = "[latex2dnd] %s %s %s (%.1f sec)" % (self.worker, result['status'], job['problem'], time.time() - start)
+        if result.get('error'):
+            msg += ": %s" % result['error']
+        if not held:
+            msg += " (claim lost to a lease timeout; result discarded)"
+        print(msg)
+        sys.stdout.flush()
+        return result
+
+    def run(self, drain=False, max_jobs=None):
+        '''
+        Claim and build jobs until stopped; if drain, return when the queue is empty.
+        Return the number of jobs built.
+        '''
+        while max_jobs is None or self.nbuilt < max_jobs:
+            for jid in self.spool.requeue_stale():
+                print("[latex2dnd] Requeued stale job %s" % jid)
+            job = self.spool.claim(self.worker)
+            if job is None:
+                if drain:
+                    break
+                time.sleep(self.poll)
+                continue
+            try:
+                self.build(job)
+            except KeyboardInterrupt:
+                self.spool.release(job)
+                raise
+        return self.nbuilt
+
+def WorkerCommandLine(arglist=None):
+    '''
+    latex2dnd worker --spool DIR [options]
+    '''
+    from .main import make_option_parser
+    from .batch import find_problems
+    parser = make_option_parser(usage="usage: %prog worker --spool DIR [options] [--submit dir_or_file ...]")
+    parser.add_option("--spool",
+                      action="store",
+                      dest="spool",
+                      default=None,
+                      help="Spool directory holding the job queue",)
+    parser.add_option("--submit",
+                      action="store_true",
+                      dest="submit",
+                      default=False,
+                      help="Queue the problems in the given files or directories, and exit",)
+    parser.add_option("--lease",
+                      action="store",
+                      type="float",
+                      dest="lease",
+                      default=600,
+                      help="Seconds after which a claimed job whose worker stopped renewing it is requeued (default 600)",)
+    parser.add_option("--poll",
+                      action="store",
+                      type="float",
+                      dest="poll",
+                      default=2.0,
+                      help="Seconds between checks of an empty queue (default 2)",)
+    parser.add_option("--drain",
+                      action="store_true",
+                      dest="drain",
+                      default=False,
+                      help="Exit when the queue is empty, instead of waiting for more jobs",)
+    parser.set_defaults(output_dir=None)
+    (opts, args) = parser.parse_args(arglist)
+    if not opts.spool:
+        parser.error('--spool DIR is required')
+    spool = Spool(opts.spool, lease=opts.lease)
+    if opts.submit:
+        problems = find_problems(args or ["."])
+        if not problems:
+            parser.error('no problems found')
+        for problem in problems:
+            spool.submit(problem)
+        print("[latex2dnd] Queued %d problems in %s" % (len(problems), spool.dir))
+        return spool
+    if args:
+        parser.error('problems are only given with --submit')
+    worker = SpoolWorker(spool, opts, poll=opts.poll, verbose=opts.verbose)
+    print("[latex2dnd] Worker %s taking jobs from %s" % (worker.worker, spool.dir))
+    sys.stdout.flush()
+    try:
+        worker.run(drain=opts.drain)
+    except KeyboardInterrupt:
+        pass
+    print("[latex2dnd] Worker %s built %d jobs" % (worker.worker, worker.nbuilt))
+    return worker
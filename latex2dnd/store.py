@@ -0,0 +1,218 @@
+'''
+Content-addressed storage for latex2dnd build artifacts.
+
+An ArtifactStore keeps opaque blobs (e.g. PNG images) in a local directory,
+under keys which are hex digests; the LabelCache uses one to remember
+rendered draggable label images across problems and across builds.  See
+latex2dnd.remote for stores shared over HTTP.
+'''
+
+import os
+import re
+import json
+import hashlib
+try:
+    from path import path
+except:
+    from path import Path as path
+from .fileutil import temp_name_for
+
+def sha256_bytes(data):
+    '''
+    Return hex sha256 digest of data (bytes or str)
+    '''
+    if not isinstance(data, bytes):
+        data = data.encode('utf8')
+    return hashlib.sha256(data).hexdigest()
+
+def sha256_file(fn):
+    '''
+    Return hex sha256 digest of the contents of file fn
+    '''
+    digest = hashlib.sha256()
+    with open(fn, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class ArtifactStore(object):
+    '''
+    Local directory of blobs, each stored once, in a file named by its key.
+    Files are spread over subdirectories named by the first two characters of the key.
+    '''
+    def __init__(self, root, verbose=False):
+        self.root = path(root)
+        self.verbose = verbose
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+
+    def path_for(self, key):
+        return self.root / key[:2] / key
+
+    def has(self, key):
+        return os.path.exists(self.path_for(key))
+
+    def get(self, key):
+        '''
+        Return bytes stored under key, or None if not present
+        '''
+        try:
+            with open(self.path_for(key), 'rb') as fp:
+                return fp.read()
+        except (IOError, OSError):
+            return None
+
+    def get_many(self, keys):
+        '''
+        Return list of the bytes stored under each of keys (None for those not present)
+        '''
+        return [self.get(key) for key in keys]
+
+    def put(self, key, data):
+        '''
+        Store data under key.  The write is atomic, so concurrent readers never see partial blobs.
+        '''
+        fn = self.path_for(key)
+        if os.path.exists(fn):
+            return key
+        dn = os.path.dirname(fn)
+        if not os.path.exists(dn):
+            try:
+                os.makedirs(dn)
+            except OSError:
+                pass		# created by another process meanwhile
+        tmpfn = temp_name_for(fn)
+        with open(tmpfn, 'xb') as fp:
+            fp.write(data)
+        os.replace(tmpfn, fn)
+        return key
+
+    def put_file(self, fn, key=None):
+        '''
+        Store contents of file fn; the key defaults to the sha256 of the contents.
+        Return the key.
+        '''
+        with open(fn, 'rb') as fp:
+            data = fp.read()
+        if key is None:
+            key = sha256_bytes(data)
+        return self.put(key, data)
+
+    def get_file(self, key, fn):
+        '''
+        Write blob stored under key to file fn.  Return True on success, False if key is not present.
+        '''
+        data = self.get(key)
+        if data is None:
+            return False
+        with open(fn, 'wb') as fp:
+            fp.write(data)
+        return True
+
+    def link_file(self, fn):
+        '''
+        Deduplicate file fn: store its contents once, by content hash, and make fn a hardlink
+        to the stored copy.  Return the number of bytes saved, which is the size of fn if
+        identical contents were already stored (from some other file), and zero otherwise.
+        '''
+        key = sha256_file(fn)
+        sfn = self.path_for(key)
+        if os.path.exists(sfn):
+            if os.path.samefile(sfn, fn):
+                return 0
+            # replace fn atomically, via a temporary link in the same directory
+            tmpfn = temp_name_for(fn)
+            try:
+                os.link(sfn, tmpfn)
+            except OSError as err:
+                if self.verbose:
+                    print("[latex2dnd] cannot hardlink %s to %s, err=%s" % (fn, sfn, err))
+                return 0
+            nbytes = os.path.getsize(fn)
+            os.replace(tmpfn, fn)
+            return nbytes
+        dn = os.path.dirname(sfn)
+        if not os.path.exists(dn):
+            try:
+                os.makedirs(dn)
+            except OSError:
+                pass
+        try:
+            os.link(fn, sfn)
+        except OSError as err:
+            # e.g. store is on a different filesystem; keep a copy so later files can at least be linked to it
+            if self.verbose:
+                print("[latex2dnd] cannot hardlink %s to %s, err=%s" % (fn, sfn, err))
+            self.put_file(fn, key)
+        return 0
+
+class LabelCache(object):
+    '''
+    Cache of rendered draggable label images, persistent across problems and builds.
+
+    Entries are keyed by (label TeX, preamble hash, label box size, DPI, image format),
+    which together determine the rendered image.
+    '''
+    def __init__(self, store, preamble_hash, verbose=False):
+        '''
+        store = ArtifactStore (e.g. a TieredArtifactStore, see latex2dnd.remote), or directory name for one
+        preamble_hash = hash of the latex preamble used to render the labels (see preamble_hash_for_tex)
+        '''
+        if not isinstance(store, ArtifactStore):
+            store = ArtifactStore(store)
+        self.store = store
+        self.preamble_hash = preamble_hash
+        self.verbose = verbose
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, tex, box_size, dpi, fmt='png'):
+        keydat = [tex, self.preamble_hash, list(box_size), str(dpi), fmt]
+        return sha256_bytes(json.dumps(keydat))
+
+    def get(self, tex, box_size, dpi, fmt='png'):
+        '''
+        Return cached image bytes, or None on a miss.
+        '''
+        data = self.store.get(self.key(tex, box_size, dpi, fmt))
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return data
+
+    def get_many(self, entries, fmt='png'):
+        '''
+        Return list of cached image bytes (None for misses), for entries = list of (tex, box_size, dpi).
+        The store may fetch them in parallel.
+        '''
+        found = self.store.get_many([self.key(tex, box_size, dpi, fmt) for tex, box_size, dpi in entries])
+        for data in found:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return found
+
+    def put(self, tex, box_size, dpi, data, fmt='png'):
+        return self.store.put(self.key(tex, box_size, dpi, fmt), data)
+
+    def hit_rate(self):
+        ntot = self.hits + self.misses
+        if not ntot:
+            return 0.0
+        return 100.0 * self.hits / ntot
+
+def preamble_hash_for_tex(texfn, extra=""):
+    '''
+    Return hash of the preamble (everything before \\begin{document}) of the latex file texfn,
+    ignoring comments and whitespace, so that preambles which only differ in comments
+    (e.g. the source filename in tex generated from dndspec files) hash the same.
+    extra = additional text to include in the hash (e.g. contents of latex2dnd.tex)
+    '''
+    with open(texfn) as fp:
+        tex = fp.read()
+    preamble = tex.split('\\begin{document}', 1)[0]
+    preamble = re.sub(r'(?<!\\)%.*', '', preamble)
+    preamble = ' '.join(preamble.split())
+    return sha256_bytes(preamble + extra)
@@ -0,0 +1,62 @@
+import os
+import asyncio
+import unittest
+import tempfile
+import shutil
+from latex2dnd.aio import ToolRunner
+from latex2dnd.fileutil import OutputLock, LockTimeout
+
+class TestToolRunner(unittest.TestCase):
+
+    def test_bounded_concurrency(self):
+        async def run_all():
+            runner = ToolRunner(max_procs=2)
+            outs = await asyncio.gather(*[runner.run("sleep 0.1; echo %d" % k) for k in range(6)])
+            return runner, outs
+        runner, outs = asyncio.run(run_all())
+        assert [x.strip() for x in outs] == [str(k) for k in range(6)]
+        assert runner.nrun == 6
+        assert runner.max_running == 2
+        assert runner.running == 0
+
+    def test_run_argument_list(self):
+        async def run_one():
+            return await ToolRunner().run(["echo", "a b"])
+        assert asyncio.run(run_one()) == "a b\n"
+
+    def test_run_merge_stderr(self):
+        async def run_one(merge):
+            return await ToolRunner().run("echo out; echo err >&2", merge_stderr=merge)
+        assert asyncio.run(run_one(True)) == "out\nerr\n"
+
+class TestAsyncLock(unittest.TestCase):
+
+    def test_builds_of_one_problem_on_one_loop(self):
+        tmdir = tempfile.mkdtemp('l2dndtmp')
+        lockfn = os.path.join(tmdir, '.p.latex2dnd.lock')
+        order = []
+
+        async def build(k):
+            async with OutputLock(lockfn, timeout=5, poll=0.01):
+                order.append('start %d' % k)
+                await asyncio.sleep(0.1)
+                order.append('end %d' % k)
+
+        async def ticks():
+            # runs while a build waits on the lock, since waiting does not block the event loop
+            for k in range(3):
+                await asyncio.sleep(0.01)
+            order.append('ticked')
+
+        async def run_all():
+            await asyncio.gather(build(0), build(1), ticks())
+            with self.assertRaises(LockTimeout):
+                async with OutputLock(lockfn, timeout=0.05, poll=0.01):
+                    async with OutputLock(lockfn, timeout=0.05, poll=0.01):
+                        pass
+
+        try:
+            asyncio.run(run_all())
+        finally:
+            shutil.rmtree(tmdir)
+        assert order == ['start 0', 'ticked', 'end 0', 'start 1', 'end 1']
@@ -0,0 +1,56 @@
+import os
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+try:
+    from path import path
+except:
+    from path import Path as path
+import latex2dnd as l2dndmod
+from latex2dnd.api import build_dnd
+from latex2dnd.main import LatexToDragDrop
+
+class TestBuildInMemory(unittest.TestCase):
+
+    def test_build_dnd(self):
+        testdir = path(l2dndmod.__file__).parent / 'testtex'
+        with open(testdir / 'quadratic.tex') as fp:
+            tex = fp.read()
+        cwd = os.getcwd()
+        before = sorted(os.listdir(cwd))
+        result = build_dnd(tex, name='quadratic', randomize_solution_filename=False)
+        self.assertEqual(os.getcwd(), cwd)
+        self.assertEqual(sorted(os.listdir(cwd)), before)
+        self.assertIn('<drag_and_drop_input', result.xml)
+        self.assertEqual(result.imdir, '/static/images/quadratic/')
+        self.assertEqual(result.solution_image, 'quadratic_dnd_sol.png')
+        self.assertIn('quadratic_dnd_label1.png', result.images)
+        self.assertTrue(result.images['quadratic_dnd.png'].startswith(b'\x89PNG'))
+        self.assertIn('quadratic_dnd.xml', result.files())
+
+    def test_bad_names(self):
+        for name in ['../escaped', '/tmp/x', '', '.hidden']:
+            with self.assertRaises(ValueError):
+                build_dnd('hello', name=name)
+        with self.assertRaises(ValueError):
+            build_dnd('hello', name='p', extra_files={'../fig.png': b''})
+
+    def test_concurrent_builds(self):
+        testdir = path(l2dndmod.__file__).parent / 'testtex'
+        sources = [(name, open(testdir / (name + '.tex')).read()) for name in ['quadratic', 'gravity']]
+        environ = dict(os.environ)
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            results = list(pool.map(lambda src: build_dnd(src[1], name=src[0]), sources))
+        self.assertEqual([r.name for r in results], ['quadratic', 'gravity'])
+        self.assertEqual(dict(os.environ), environ)
+
+    def test_tool_environment(self):
+        env = LatexToDragDrop.tool_environment({'TEXINPUTS': '/mytex'})
+        self.assertTrue(env['TEXINPUTS'].startswith('::'))
+        self.assertTrue(env['TEXINPUTS'].endswith(':/mytex'))
+        env2 = LatexToDragDrop.tool_environment({'TEXINPUTS': '/mytex'}, reproducible=True)
+        self.assertEqual(env2['TEXINPUTS'], env['TEXINPUTS'])
+        self.assertEqual(env2['SOURCE_DATE_EPOCH'], '0')
+        self.assertNotEqual(os.environ.get('TEXINPUTS'), env['TEXINPUTS'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,183 @@
+import os
+import contextlib
+import unittest
+import tempfile
+import shutil
+import stat
+from latex2dnd.builder import DragDropBuilder
+from latex2dnd.main import make_option_parser
+
+@contextlib.contextmanager
+def make_temp_directory():
+    temp_dir = tempfile.mkdtemp('l2dndtmp')
+    yield temp_dir
+    shutil.rmtree(temp_dir)
+
+DND = r'''OPTIONS: HIDE_FORMULA_INPUT
+LABEL: 1 = one /// 1
+LABEL: 2 = two /// 2
+LABEL: 3 = mu /// mu
+LABEL: 4 = Bprime /// Bprime
+LABEL: 5 = v /// v
+BOX: 1 = two
+BOX: 2 = v
+BOX: 3 = mu
+BOX: 4 = Bprime
+FORMULA:  ([1]) * ([2]) / ( ([3]) * ([4]) ) 
+FORMULA_SAMPLES:  mu,Bprime,v@1,1,1:20,20,20\#20 
+FORMULA_EXPECT:  2 * v / ( mu * Bprime ) 
+FORMULA_ERR: 
+'''
+
+AUX = r'''\zref@newlabel{box1-ll}{\posx{19926575}\posy{41355292}\abspage{1}}
+\zref@newlabel{box1-ur}{\posx{22183919}\posy{42950133}\abspage{1}}
+\zref@newlabel{boxLABEL1-ll}{\posx{13605475}\posy{41270641}\abspage{2}}
+\zref@newlabel{boxLABEL1-ur}{\posx{14982796}\posy{42950133}\abspage{2}}
+'''
+
+class TestDragDropBuilder(unittest.TestCase):
+
+    def test_stages_without_images(self):
+        with make_temp_directory() as tmdir:
+            for ext, data in [('.dnd', DND), ('.aux', AUX), ('.tex', '')]:
+                with open(os.path.join(tmdir, 'prob' + ext), 'w') as fp:
+                    fp.write(data)
+            builder = DragDropBuilder('prob.tex', compile=False, verbose=False, workdir=tmdir)
+            self.assertEqual(list(builder.boxes.keys()), ['box1', 'boxLABEL1'])
+            self.assertEqual(builder.dnd_spec['box_answers']['2'], 'v')
+            results = builder.tests()
+            self.assertEqual(len(results), 1)
+            self.assertTrue(results[0]['test_ok'])
+            self.assertIs(builder.tests(), results)
+            self.assertEqual(list(builder.stages.keys()), ['compile', 'boxes', 'dnd_spec', 'tests'])
+            self.assertFalse([fn for fn in os.listdir(tmdir) if fn.endswith('.png')])
+
+    def test_lock_held_only_within_stage(self):
+        with make_temp_directory() as tmdir:
+            for ext, data in [('.dnd', DND), ('.aux', AUX), ('.tex', '')]:
+                with open(os.path.join(tmdir, 'prob' + ext), 'w') as fp:
+                    fp.write(data)
+            held = []
+
+            def generate_images(l2d, k):		# stand-in, without tools
+                held.append(l2d.output_lock.locked)
+                l2d.dndimfn = l2d.image_outdir / 'prob_dnd.png'
+                l2d.solimfn = l2d.image_outdir / 'prob_dnd_sol.png'
+                l2d.labels = dict((n, l2d.image_outdir / ('prob_dnd_label%s.png' % n)) for n in l2d.dnd_labels.values())
+                for fn in [l2d.dndimfn, l2d.solimfn] + list(l2d.labels.values()):
+                    with open(fn, 'w') as fp:
+                        fp.write('build %d' % k)
+
+            builders = [DragDropBuilder('prob.tex', compile=False, verbose=False, workdir=tmdir, lock_timeout=1)
+                        for k in range(2)]
+            def generate_dnd_xml(l2d):
+                l2d.xmlfn = l2d.wpath('prob_dnd.xml')
+                with open(l2d.xmlfn, 'w') as fp:
+                    fp.write('<span/>')
+
+            for k, builder in enumerate(builders):
+                l2d = builder.l2d
+                l2d.generate_images = lambda l2d=l2d, k=k: generate_images(l2d, k)
+                l2d.generate_dnd_xml = lambda l2d=l2d: generate_dnd_xml(l2d)
+            builders[0].images()
+            builders[1].images()		# the same problem, in the same process: no deadlock
+            self.assertEqual(held, [True, True])
+            self.assertFalse(any(builder.l2d.output_lock.locked for builder in builders))
+
+            # the images of builders[0] were replaced by builders[1], so its xml stage renders them again
+            builders[0].xml()
+            self.assertEqual(held, [True, True, True])
+            with open(os.path.join(tmdir, 'prob_dnd_sol.png')) as fp:
+                self.assertEqual(fp.read(), 'build 0')
+            self.assertFalse(builders[1].images_intact())
+            self.assertIn('prob_dnd.xml', builders[0].l2d.owned_files().files)
+
+    def test_label_without_tex_not_cached(self):
+        with make_temp_directory() as tmdir:
+            dnd = DND.replace('LABEL: 1 = one /// 1\n', '')
+            for ext, data in [('.dnd', dnd), ('.aux', AUX), ('.tex', '')]:
+                with open(os.path.join(tmdir, 'prob' + ext), 'w') as fp:
+                    fp.write(data)
+            builder = DragDropBuilder('prob.tex', compile=False, verbose=False, workdir=tmdir,
+                                      label_cache=os.path.join(tmdir, 'cache'))
+            builder.boxes
+            builder.dnd_spec
+            l2d = builder.l2d
+            self.assertEqual([x[:2] for x in l2d.label_cache_entries()], [('1', None)])
+            l2d.final_dpi = 300
+            l2d.labels = {'1': os.path.join(tmdir, 'prob_dnd_label1.png')}
+            with open(l2d.labels['1'], 'wb') as fp:
+                fp.write(b'png')
+            l2d.save_cached_label_images()
+            self.assertFalse([fn for dn, dns, fns in os.walk(os.path.join(tmdir, 'cache')) for fn in fns])
+            self.assertFalse(l2d.load_cached_label_images(tmdir))
+            self.assertEqual(l2d.label_cache.misses, 0)		# not even looked up
+
+    def test_recorded_dependencies(self):
+        with make_temp_directory() as tmdir:
+            tmdir = os.path.realpath(tmdir)
+            for ext, data in [('.dnd', DND), ('.aux', AUX), ('.tex', '\\usepackage{macros}'), ('.sty', 'sty')]:
+                with open(os.path.join(tmdir, 'prob' + ext), 'w') as fp:
+                    fp.write(data)
+            with open(os.path.join(tmdir, 'macros.sty'), 'w') as fp:
+                fp.write('\\newcommand{\\x}{x}')
+            builder = DragDropBuilder('prob.tex', compile=False, verbose=False, workdir=tmdir)
+            builder.compile()
+            self.assertEqual([os.path.basename(x) for x in builder.l2d.dependencies], ['macros.sty', 'prob.tex'])
+            with open(os.path.join(tmdir, 'prob.fls'), 'w') as fp:
+                fp.write('PWD %s\nINPUT prob.tex\nINPUT prob.sty\nINPUT prob.aux\nOUTPUT prob.aux\n' % tmdir)
+            builder.l2d.load_dependencies()
+            self.assertEqual([os.path.basename(x) for x in builder.l2d.dependencies], ['prob.sty', 'prob.tex'])
+
+    def test_max_formula_tests(self):
+        with make_temp_directory() as tmdir:
+            dnd = DND + 'TEST: incorrect /// 1,2,3,4 /// mu,v,two,Bprime\nTEST: correct /// 1,2,3,4 /// two,v,mu,Bprime\n'
+            for ext, data in [('.dnd', dnd), ('.aux', AUX), ('.tex', '')]:
+                with open(os.path.join(tmdir, 'prob' + ext), 'w') as fp:
+                    fp.write(data)
+            self.assertEqual(len(DragDropBuilder('prob.tex', compile=False, verbose=False, workdir=tmdir).tests()), 3)
+            results = DragDropBuilder('prob.tex', compile=False, verbose=False, workdir=tmdir, max_formula_tests=2).tests()
+            self.assertEqual([x['test_etype'] for x in results], ['correct', 'incorrect'])
+
+    def test_profile_options(self):
+        def parse(*args):
+            (opts, rest) = make_option_parser().parse_args(list(args))
+            return (opts.resolution, opts.max_formula_tests, opts.single_latex_pass)
+        self.assertEqual(parse('--profile', 'draft'), ('100', 2, True))
+        self.assertEqual(parse('-r', '300', '--profile', 'draft'), ('300', 2, True))
+        self.assertEqual(parse('--profile', 'draft', '-r', '300'), ('300', 2, True))
+        self.assertEqual(parse('--profile', 'draft', '--max-formula-tests', '5'), ('100', 5, True))
+        self.assertEqual(parse('-r', '300'), ('300', None, False))
+
+    def test_single_latex_pass(self):
+        if os.name != 'posix':
+            raise unittest.SkipTest("needs a shell script as a stand-in for pdflatex")
+        with make_temp_directory() as tmdir:
+            bindir = os.path.join(tmdir, 'bin')
+            os.mkdir(bindir)
+            fake = os.path.join(bindir, 'pdflatex')
+            with open(fake, 'w') as fp:
+                fp.write('#!/bin/sh\necho run >> runs.txt\ncp aux.txt prob.aux\n')
+            os.chmod(fake, os.stat(fake).st_mode | stat.S_IEXEC)
+            with open(os.path.join(tmdir, 'aux.txt'), 'w') as fp:
+                fp.write(AUX)
+            env = dict(os.environ, PATH=bindir + os.pathsep + os.environ.get('PATH', ''))
+
+            def runs(**options):
+                if os.path.exists(os.path.join(tmdir, 'runs.txt')):
+                    os.unlink(os.path.join(tmdir, 'runs.txt'))
+                DragDropBuilder('prob.tex', verbose=False, workdir=tmdir, env=env, **options).compile()
+                with open(os.path.join(tmdir, 'runs.txt')) as fp:
+                    return len(fp.readlines())
+
+            with open(os.path.join(tmdir, 'prob.tex'), 'w') as fp:
+                fp.write('')
+            self.assertEqual(runs(single_latex_pass=True), 2)	# no .aux yet
+            self.assertEqual(runs(single_latex_pass=True), 1)	# .aux unchanged by the run
+            self.assertEqual(runs(), 2)
+            with open(os.path.join(tmdir, 'aux.txt'), 'a') as fp:
+                fp.write('\\zref@newlabel{box2-ll}{\\posx{1}\\posy{2}\\abspage{1}}\n')
+            self.assertEqual(runs(single_latex_pass=True), 2)
+
+if __name__ == '__main__':
+    unittest.main()
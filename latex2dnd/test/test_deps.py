@@ -0,0 +1,99 @@
+import os
+import contextlib
+import unittest
+import tempfile
+import shutil
+import subprocess
+from latex2dnd.deps import scan_dependencies, git_changed_files, changed_problems, dependency_map
+from latex2dnd.deps import parse_fls, recorded_dependencies, dependency_hashes, dependencies_unchanged
+
+@contextlib.contextmanager
+def make_temp_directory():
+    temp_dir = tempfile.mkdtemp('l2dndtmp')
+    yield os.path.realpath(temp_dir)
+    shutil.rmtree(temp_dir)
+
+def write(fn, data):
+    with open(fn, 'w') as fp:
+        fp.write(data)
+
+def make_course(tmdir):
+    write(os.path.join(tmdir, 'p1.dndspec'), 'EXTRA_HEADER_TEX: \\usepackage[bwr]{callouts,amsmath}\n'
+          'BEGIN_EXPRESSION\n\\includegraphics[width=2in]{fig1.png} \\includegraphics{fig2}\nEND_EXPRESSION\n')
+    write(os.path.join(tmdir, 'p2.tex'), '\\documentclass{article}\n\\input{common}\n'
+          '% \\includegraphics{commented.png}\n\\begin{document}\\DDlabel{a}{a}\\end{document}\n')
+    write(os.path.join(tmdir, 'callouts.sty'), '\\RequirePackage{tikz}\n')
+    write(os.path.join(tmdir, 'common.tex'), '\\includegraphics{fig2.pdf}\n')
+    write(os.path.join(tmdir, 'fig1.png'), 'png')
+    write(os.path.join(tmdir, 'fig2.pdf'), 'pdf')
+    return [os.path.join(tmdir, x) for x in ['p1.dndspec', 'p2.tex']]
+
+class TestDependencies(unittest.TestCase):
+
+    def test_scan_dependencies(self):
+        with make_temp_directory() as tmdir:
+            (p1, p2) = make_course(tmdir)
+            self.assertEqual([os.path.basename(x) for x in scan_dependencies(p1)],
+                             ['callouts.sty', 'fig1.png', 'fig2.pdf', 'p1.dndspec'])
+            self.assertEqual([os.path.basename(x) for x in scan_dependencies(p2)],
+                             ['common.tex', 'fig2.pdf', 'p2.tex'])
+            os.unlink(os.path.join(tmdir, 'fig1.png'))
+            self.assertIn(os.path.join(tmdir, 'fig1.png'), scan_dependencies(p1))
+
+    def test_changed_since(self):
+        with make_temp_directory() as tmdir:
+            problems = make_course(tmdir)
+
+            def git(*args):
+                subprocess.check_output(('git', '-c', 'user.name=test', '-c', 'user.email=test@example.com') + args,
+                                        cwd=tmdir, stderr=subprocess.STDOUT)
+            try:
+                git('init', '-q')
+            except OSError:
+                raise unittest.SkipTest("git not available")
+            git('add', '.')
+            git('commit', '-q', '-m', 'course')
+            self.assertEqual(changed_problems(problems, git_changed_files('HEAD', cwd=tmdir)), [])
+            write(os.path.join(tmdir, 'callouts.sty'), '\\RequirePackage{tikz,xcolor}\n')
+            self.assertEqual(changed_problems(problems, git_changed_files('HEAD', cwd=tmdir)), problems[:1])
+            git('commit', '-q', '-a', '-m', 'sty')
+            write(os.path.join(tmdir, 'fig2.pdf'), 'new pdf')
+            self.assertEqual(changed_problems(problems, git_changed_files('HEAD~1', cwd=tmdir)), problems)
+            p3 = os.path.join(tmdir, 'p3.dndspec')
+            write(p3, 'MATCH_LABELS: a')
+            self.assertEqual(changed_problems(problems + [p3], git_changed_files('HEAD', cwd=tmdir)), problems + [p3])
+            odd = os.path.join(tmdir, 'fig "\u00e9"\n.png')
+            write(odd, 'png')
+            self.assertIn(odd, git_changed_files('HEAD', cwd=tmdir))
+            git('add', '.')
+            self.assertIn(odd, git_changed_files('HEAD', cwd=tmdir))
+            with self.assertRaises(Exception):
+                git_changed_files('nosuchrev', cwd=tmdir)
+
+    def test_recorded_dependencies(self):
+        with make_temp_directory() as tmdir:
+            (p1, p2) = make_course(tmdir)
+            write(os.path.join(tmdir, 'local.def'), 'def')
+            fls = os.path.join(tmdir, 'p2.fls')
+            write(fls, 'PWD %s\n' % tmdir +
+                  'INPUT /usr/share/texlive/texmf-dist/tex/latex/base/article.cls\n'
+                  'INPUT p2.tex\nOUTPUT p2.log\nINPUT ./p2.aux\nINPUT local.def\nINPUT p2.tex\n'
+                  'OUTPUT p2.aux\nOUTPUT p2.pdf\n')
+            (inputs, outputs) = parse_fls(fls)
+            self.assertEqual(len(inputs), 4)
+            self.assertIn(os.path.join(tmdir, 'p2.aux'), outputs)
+            deps = recorded_dependencies(fls)
+            self.assertEqual([os.path.basename(x) for x in deps], ['local.def', 'p2.tex'])
+            dmap = dependency_map([p1, p2], {p2: deps})
+            self.assertIn(os.path.join(tmdir, 'local.def'), dmap[p2])
+            self.assertIn(os.path.join(tmdir, 'common.tex'), dmap[p2])
+            self.assertEqual(changed_problems([p1, p2], [os.path.join(tmdir, 'local.def')], dmap), [p2])
+
+            hashes = dependency_hashes(deps + [os.path.join(tmdir, 'missing.tex')])
+            self.assertIsNone(hashes[os.path.join(tmdir, 'missing.tex')])
+            self.assertTrue(dependencies_unchanged(hashes))
+            write(os.path.join(tmdir, 'local.def'), 'new def')
+            self.assertFalse(dependencies_unchanged(hashes))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import os
+import contextlib
+import unittest
+import tempfile
+import shutil
+from collections import OrderedDict
+from latex2dnd.main import DpiSearch, LatexToDragDrop
+
+@contextlib.contextmanager
+def make_temp_directory():
+    temp_dir = tempfile.mkdtemp('l2dndtmp')
+    yield temp_dir
+    shutil.rmtree(temp_dir)
+
+def run_search(search, size_at):
+    '''
+    Run search to completion, with image bytes given by size_at(dpi); return list of dpis tried
+    '''
+    tried = []
+    dpi = search.next_dpi()
+    while dpi is not None:
+        tried.append(dpi)
+        search.record(dpi, size_at(dpi))
+        dpi = search.next_dpi()
+    return tried
+
+class FakeLabelCache(object):
+
+    def __init__(self):
+        self.puts = []
+
+    def put(self, tex, box_size, dpi, data):
+        self.puts.append(dpi)
+
+class TestDpiSearch(unittest.TestCase):
+
+    def test_converges(self):
+        size_at = lambda dpi: 10 * dpi ** 2 + 5000
+        search = DpiSearch(300, size_at(300), 200000)
+        tried = run_search(search, size_at)
+        self.assertTrue(len(tried) <= search.max_trials)
+        self.assertTrue(size_at(search.fit_dpi) <= 200000)
+        self.assertTrue(size_at(search.fit_dpi + 3) > 200000)	# within the bisection tolerance of the best
+        self.assertTrue(search.fail_dpi - search.fit_dpi <= 2 or len(tried) == search.max_trials)
+
+    def test_budget_cannot_be_met(self):
+        size_at = lambda dpi: 100000 + dpi
+        search = DpiSearch(300, size_at(300), 50000, min_dpi=20)
+        tried = run_search(search, size_at)
+        self.assertEqual(search.fit_dpi, None)
+        self.assertEqual(tried[-1], 20)
+        self.assertTrue(search.done)
+
+    def make_l2d(self, tmdir, max_bytes):
+        with open(os.path.join(tmdir, 'p.tex'), 'w') as fp:
+            fp.write('')
+        l2d = LatexToDragDrop('p.tex', workdir=tmdir, build=False, verbose=False, max_bytes=max_bytes, dpi='max200')
+        l2d.choose_dpi()
+        l2d.dndimfn = os.path.join(tmdir, 'p_dnd.png')
+        l2d.labels = OrderedDict((str(k), os.path.join(tmdir, 'p_dnd_label%d.png' % k)) for k in [1, 2])
+        return l2d
+
+    def write_images(self, l2d, dpi):
+        for fn, scale in [(l2d.dndimfn, 2), (l2d.labels['1'], 1), (l2d.labels['2'], 1)]:
+            with open(fn, 'wb') as fp:
+                fp.write(b'x' * (scale * dpi ** 2 // 10))
+
+    def test_per_image_budget(self):
+        with make_temp_directory() as tmdir:
+            l2d = self.make_l2d(tmdir, 'image:5000')
+            self.assertEqual(l2d.final_dpi, 200)
+            self.write_images(l2d, 200)
+            search = l2d.start_dpi_search()
+            self.assertTrue(l2d.budget_per_image)
+            self.assertEqual(search.nbytes, 8000)			# the largest image, not the total
+            self.write_images(l2d, 100)
+            self.assertEqual(l2d.start_dpi_search(), None)	# 2000 + 1000 + 1000 bytes, each within 5000
+
+    def test_fit_stores_only_final_labels(self):
+        with make_temp_directory() as tmdir:
+            l2d = self.make_l2d(tmdir, 10000)
+            l2d.label_cache = FakeLabelCache()
+            l2d.label_cache_entries = lambda: [(num, 'label %s' % num, (10, 10)) for num in l2d.labels]
+
+            def render_images(dpi):
+                l2d.final_dpi = dpi
+                self.write_images(l2d, dpi)
+                l2d.save_cached_label_images()		# as generate_label_images does
+            l2d.render_images = render_images
+
+            self.write_images(l2d, 200)
+            l2d.fit_images_to_byte_budget()
+            self.assertTrue(l2d.image_bytes() <= 10000)
+            self.assertEqual(l2d.label_cache.puts, [l2d.final_dpi] * 2)
+            self.assertTrue(l2d.cache_label_images)
+
+if __name__ == '__main__':
+    unittest.main()
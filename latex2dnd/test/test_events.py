@@ -0,0 +1,76 @@
+import os
+import json
+import contextlib
+import unittest
+import tempfile
+import shutil
+from latex2dnd.events import EventStream, EventRecorder, NullEvents, open_event_stream
+from latex2dnd.main import LatexToDragDrop
+
+@contextlib.contextmanager
+def make_temp_directory():
+    temp_dir = tempfile.mkdtemp('l2dndtmp')
+    yield temp_dir
+    shutil.rmtree(temp_dir)
+
+class TestEvents(unittest.TestCase):
+
+    def read_events(self, fn):
+        with open(fn) as fp:
+            return [json.loads(line) for line in fp]
+
+    def test_event_stream(self):
+        with make_temp_directory() as tmdir:
+            fn = os.path.join(tmdir, 'events.ndjson')
+            fd = os.open(fn, os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+            events = EventStream(fd).bind(job='p1')
+            events.emit('job_started')
+            events.bind(job='p2').emit('job_finished', status='ok', seconds=1.5)
+            os.close(fd)
+            evs = self.read_events(fn)
+            self.assertEqual([(e['event'], e['job']) for e in evs], [('job_started', 'p1'), ('job_finished', 'p2')])
+            self.assertEqual(evs[1]['seconds'], 1.5)
+            self.assertTrue('time' in evs[0])
+        NullEvents().bind(job='p').emit('job_started')
+        self.assertTrue(isinstance(open_event_stream(None), NullEvents))
+        with self.assertRaises(ValueError):
+            open_event_stream('xml')
+
+    def test_event_recorder(self):
+        # what a build in a spawned pool process does: record its events, for the parent to write
+        recorder = EventRecorder()
+        events = recorder.bind(job='p1')
+        events.emit('job_started')
+        events.bind(stage='latex').emit('stage_started')
+        self.assertEqual(len(recorder.lines), 2)
+        with make_temp_directory() as tmdir:
+            fn = os.path.join(tmdir, 'events.ndjson')
+            fd = os.open(fn, os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+            EventStream(fd).write_lines(recorder.lines)
+            os.close(fd)
+            evs = self.read_events(fn)
+            self.assertEqual([(e['event'], e['job']) for e in evs], [('job_started', 'p1'), ('stage_started', 'p1')])
+            self.assertEqual(evs[1]['stage'], 'latex')
+
+    def test_stage_events(self):
+        with make_temp_directory() as tmdir:
+            fn = os.path.join(tmdir, 'events.ndjson')
+            fd = os.open(fn, os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+            with open(os.path.join(tmdir, 'p.tex'), 'w') as fp:
+                fp.write('')
+            l2d = LatexToDragDrop('p.tex', workdir=tmdir, build=False, verbose=False, latex_log=True,
+                                  events=EventStream(fd, job='p'))
+            with l2d.timed('load'):
+                pass
+            with l2d.latex_output() as out:
+                out.write(b'pdflatex chatter')
+            os.close(fd)
+            evs = self.read_events(fn)
+            self.assertEqual([(e['event'], e['stage']) for e in evs], [('stage_started', 'load'),
+                                                                      ('stage_finished', 'load')])
+            self.assertEqual(l2d.stage_times['load'], evs[1]['seconds'])
+            with open(os.path.join(tmdir, 'p_pdflatex.log')) as fp:
+                self.assertEqual(fp.read(), 'pdflatex chatter')
+
+if __name__ == '__main__':
+    unittest.main()
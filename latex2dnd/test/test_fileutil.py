@@ -0,0 +1,187 @@
+import os
+import contextlib
+import unittest
+import tempfile
+import shutil
+import time
+import threading
+from latex2dnd.fileutil import write_if_changed, replace_if_changed, OutputSnapshot
+from latex2dnd.fileutil import OutputLock, LockTimeout, OwnedFiles
+from latex2dnd.main import LatexToDragDrop
+
+@contextlib.contextmanager
+def make_temp_directory():
+    temp_dir = tempfile.mkdtemp('l2dndtmp')
+    yield temp_dir
+    shutil.rmtree(temp_dir)
+
+class TestFileUtil(unittest.TestCase):
+
+    def test_write_if_changed(self):
+        with make_temp_directory() as tmdir:
+            fn = os.path.join(tmdir, 'x_dnd.xml')
+            self.assertTrue(write_if_changed(fn, '<span/>'))
+            os.utime(fn, (1000000, 1000000))
+            self.assertFalse(write_if_changed(fn, '<span/>'))
+            self.assertEqual(os.path.getmtime(fn), 1000000)
+            self.assertTrue(write_if_changed(fn, '<span></span>'))
+            self.assertEqual(open(fn).read(), '<span></span>')
+            self.assertEqual(os.listdir(tmdir), ['x_dnd.xml'])
+
+    def test_replace_if_changed(self):
+        with make_temp_directory() as tmdir:
+            fn = os.path.join(tmdir, 'x_dnd.png')
+            src = os.path.join(tmdir, 'new.png')
+            for data, expect in [(b'png1', True), (b'png1', False), (b'png2', True)]:
+                with open(src, 'wb') as fp:
+                    fp.write(data)
+                self.assertEqual(replace_if_changed(src, fn), expect)
+                self.assertFalse(os.path.exists(src))
+                self.assertEqual(open(fn, 'rb').read(), data)
+
+    def test_output_snapshot_rollback(self):
+        with make_temp_directory() as tmdir:
+            outdir = os.path.join(tmdir, 'out')
+            os.mkdir(outdir)
+            write_if_changed(os.path.join(tmdir, 'p_dnd.xml'), 'old xml')
+            write_if_changed(os.path.join(outdir, 'p_dnd_sol_a.png'), 'old sol')
+            write_if_changed(os.path.join(tmdir, 'p.tex'), 'source')
+            snapshot = OutputSnapshot([tmdir, outdir], ['p_dnd'])
+            write_if_changed(os.path.join(tmdir, 'p_dnd.xml'), 'new xml')
+            os.unlink(os.path.join(outdir, 'p_dnd_sol_a.png'))
+            write_if_changed(os.path.join(outdir, 'p_dnd_sol_b.png'), 'new sol')
+            write_if_changed(os.path.join(tmdir, 'p.aux'), 'aux')
+            snapshot.rollback()
+            self.assertEqual(sorted(os.listdir(tmdir)), ['out', 'p.aux', 'p.tex', 'p_dnd.xml'])
+            self.assertEqual(os.listdir(outdir), ['p_dnd_sol_a.png'])
+            self.assertEqual(open(os.path.join(tmdir, 'p_dnd.xml')).read(), 'old xml')
+            self.assertEqual(open(os.path.join(outdir, 'p_dnd_sol_a.png')).read(), 'old sol')
+
+    def test_output_snapshot_discard(self):
+        with make_temp_directory() as tmdir:
+            write_if_changed(os.path.join(tmdir, 'p_dnd.xml'), 'old xml')
+            snapshot = OutputSnapshot([tmdir], ['p_dnd'])
+            write_if_changed(os.path.join(tmdir, 'p_dnd.xml'), 'new xml')
+            snapshot.discard()
+            self.assertEqual(os.listdir(tmdir), ['p_dnd.xml'])
+            self.assertEqual(open(os.path.join(tmdir, 'p_dnd.xml')).read(), 'new xml')
+
+    def test_output_lock(self):
+        with make_temp_directory() as tmdir:
+            lockfn = os.path.join(tmdir, '.p.latex2dnd.lock')
+            with OutputLock(lockfn) as lock:
+                self.assertTrue(lock.locked)
+                with self.assertRaises(LockTimeout):
+                    OutputLock(lockfn, timeout=0.2, poll=0.05).acquire()
+                with OutputLock(os.path.join(tmdir, '.q.latex2dnd.lock'), timeout=0):
+                    pass			# other problems are not blocked
+            self.assertFalse(lock.locked)
+            with OutputLock(lockfn, timeout=0):
+                pass
+            self.assertFalse(os.path.exists(lockfn))		# removed on release
+
+    def test_output_lock_removed_while_waiting(self):
+        with make_temp_directory() as tmdir:
+            lockfn = os.path.join(tmdir, '.p.latex2dnd.lock')
+            holder = OutputLock(lockfn).acquire()
+            waiter = OutputLock(lockfn, timeout=0)
+            waiter.start_waiting()			# has the holder's lock file open
+            self.assertFalse(waiter.try_lock())
+            holder.release()
+            self.assertTrue(waiter.try_lock())		# locks a new lock file, not the removed one
+            self.assertTrue(waiter.is_current())
+            with self.assertRaises(LockTimeout):
+                OutputLock(lockfn, timeout=0.1, poll=0.05).acquire()
+            waiter.release()
+
+    def test_owned_files(self):
+        with make_temp_directory() as tmdir:
+            recfn = os.path.join(tmdir, '.p_dnd.owned.json')
+            fns = [os.path.join(tmdir, x) for x in ['p_dnd.xml', 'p_dnd_sol_AAAAAA.png']]
+            for fn in fns:
+                write_if_changed(fn, 'data')
+            owned = OwnedFiles(recfn)
+            owned.add(fns + [os.path.join(tmdir, 'missing.png')])
+            owned.save()
+            owned = OwnedFiles(recfn)
+            self.assertEqual(sorted(owned.files), ['p_dnd.xml', 'p_dnd_sol_AAAAAA.png'])
+            self.assertTrue(owned.owns(fns[1]))
+            owned.remove(fns[1])
+            self.assertFalse(os.path.exists(fns[1]))
+            self.assertFalse(owned.owns(fns[1]))
+
+    def test_cleanup_removes_only_owned_files(self):
+        with make_temp_directory() as tmdir:
+            write_if_changed(os.path.join(tmdir, 'p.tex'), '')
+            l2d = LatexToDragDrop('p.tex', workdir=tmdir, build=False, verbose=False)
+            mine, other = [os.path.join(tmdir, 'p_dnd_sol_%s.png' % x) for x in ['AAAAAA', 'BBBBBB']]
+            write_if_changed(mine, 'old sol')
+            write_if_changed(other, 'uploaded by hand')
+            owned = l2d.owned_files()
+            owned.add([mine])
+            owned.save()
+            with l2d.output_lock:
+                l2d.cleanup_old_solution_image_files()
+            self.assertFalse(os.path.exists(mine))
+            self.assertTrue(os.path.exists(other))
+
+    def test_cleanup_adopts_legacy_files_once(self):
+        with make_temp_directory() as tmdir:
+            write_if_changed(os.path.join(tmdir, 'p.tex'), '')
+            l2d = LatexToDragDrop('p.tex', workdir=tmdir, build=False, verbose=False)
+            legacy, other = [os.path.join(tmdir, 'p_dnd_sol_%s.png' % x) for x in ['AB12CD', 'my_fig']]
+            write_if_changed(legacy, 'written by an older latex2dnd')
+            write_if_changed(other, 'not named as latex2dnd names solutions')
+            with l2d.output_lock:
+                l2d.cleanup_old_solution_image_files()		# no record yet
+            self.assertFalse(os.path.exists(legacy))
+            self.assertTrue(os.path.exists(other))
+            self.assertTrue(os.path.exists(l2d.owned_files().fn))
+            write_if_changed(legacy, 'uploaded by hand, after the migration')
+            with l2d.output_lock:
+                l2d.cleanup_old_solution_image_files()
+            self.assertTrue(os.path.exists(legacy))
+
+    def test_old_images_removed_after_xml(self):
+        with make_temp_directory() as tmdir:
+            write_if_changed(os.path.join(tmdir, 'p.tex'), '')
+            l2d = LatexToDragDrop('p.tex', workdir=tmdir, build=False, verbose=False, do_cleanup=True)
+            fns = [os.path.join(tmdir, 'p_dnd_sol_%s.png' % x) for x in ['AAAAAA', 'BBBBBB']]
+            for fn in fns:
+                write_if_changed(fn, fn)
+            owned = l2d.owned_files()
+            owned.add(fns)
+            owned.save()
+            l2d.solimfn = fns[1]		# written by this build
+            with l2d.output_lock:
+                l2d.remove_old_images()
+            self.assertEqual([os.path.exists(fn) for fn in fns], [False, True])
+
+    def test_concurrent_builds_of_one_problem(self):
+        with make_temp_directory() as tmdir:
+            write_if_changed(os.path.join(tmdir, 'p.tex'), '')
+
+            def build(k):
+                # what a build does in the output directory: clean up, write images, then the XML
+                l2d = LatexToDragDrop('p.tex', workdir=tmdir, build=False, verbose=False)
+                with l2d.output_lock:
+                    l2d.cleanup_old_solution_image_files()
+                    solfn = os.path.join(tmdir, 'p_dnd_sol_%06d.png' % k)
+                    write_if_changed(solfn, 'sol %d' % k)
+                    owned = l2d.owned_files()
+                    owned.add([solfn])
+                    owned.save()
+                    time.sleep(0.01)
+                    write_if_changed(os.path.join(tmdir, 'p_dnd.xml'), os.path.basename(solfn))
+
+            threads = [threading.Thread(target=build, args=(k,)) for k in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            with open(os.path.join(tmdir, 'p_dnd.xml')) as fp:
+                solfn = fp.read()
+            self.assertEqual([x for x in os.listdir(tmdir) if x.startswith('p_dnd_sol')], [solfn])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import os
+import contextlib
+import unittest
+import tempfile
+import shutil
+from latex2dnd.history import BuildHistory, longest_first, Progress
+
+@contextlib.contextmanager
+def make_temp_directory():
+    temp_dir = tempfile.mkdtemp('l2dndtmp')
+    yield temp_dir
+    shutil.rmtree(temp_dir)
+
+class TestBuildHistory(unittest.TestCase):
+
+    def test_record_and_expect(self):
+        with make_temp_directory() as tmdir:
+            history = BuildHistory(os.path.join(tmdir, 'history.db'), nrecent=2)
+            history.record('course/a.tex', 'ok', 10.0, {'latex': 4.0, 'images': 6.0})
+            history.record('course/a.tex', 'ok', 20.0, {'latex': 8.0, 'images': 12.0})
+            history.record('course/a.tex', 'ok', 30.0, {'latex': 12.0, 'images': 18.0})
+            history.record('course/a.tex', 'failed', 1.0)
+            history.record('./course/b.tex', 'ok', 2.0)
+            history.close()
+            history = BuildHistory(os.path.join(tmdir, 'history.db'), nrecent=2)
+            self.assertEqual(history.expected_seconds('course/a.tex'), 25.0)
+            self.assertEqual(history.expected_seconds('course/b.tex'), 2.0)
+            self.assertEqual(history.expected_seconds('course/c.tex'), None)
+            self.assertEqual(dict(history.stage_seconds('course/a.tex')), {'images': 15.0, 'latex': 10.0})
+            self.assertEqual(history.costs(['course/a.tex', 'course/c.tex']), {'course/a.tex': 25.0})
+            history.close()
+
+    def test_longest_first(self):
+        problems = ['a.tex', 'b.tex', 'c.tex', 'd.tex']
+        self.assertEqual(longest_first(problems, {}), problems)
+        costs = {'a.tex': 1.0, 'b.tex': 9.0, 'c.tex': 4.0}
+        self.assertEqual(longest_first(problems, costs), ['b.tex', 'd.tex', 'c.tex', 'a.tex'])
+
+    def test_progress(self):
+        progress = Progress(['a.tex', 'b.tex', 'c.tex'], {'a.tex': 10.0}, jobs=2)
+        self.assertEqual(progress.seconds_left(), 15.0)
+        progress.finished('a.tex', 10.0)
+        self.assertEqual(progress.seconds_left(), 10.0)
+        self.assertTrue(progress.report().startswith('1/3 done, ETA '))
+        progress.finished('b.tex', 2.0)
+        progress.finished('c.tex', 2.0)
+        self.assertEqual(progress.report(), '3/3 done')
+
+if __name__ == '__main__':
+    unittest.main()
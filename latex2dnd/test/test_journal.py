@@ -0,0 +1,74 @@
+import os
+import contextlib
+import unittest
+import tempfile
+import shutil
+from collections import OrderedDict
+from latex2dnd.journal import BuildJournal, input_hash
+from latex2dnd.deps import dependency_hashes
+
+@contextlib.contextmanager
+def make_temp_directory():
+    temp_dir = tempfile.mkdtemp('l2dndtmp')
+    yield temp_dir
+    shutil.rmtree(temp_dir)
+
+def write(fn, data):
+    with open(fn, 'w') as fp:
+        fp.write(data)
+
+class TestBuildJournal(unittest.TestCase):
+
+    def test_input_hash(self):
+        with make_temp_directory() as tmdir:
+            fn = os.path.join(tmdir, 'p.dndspec')
+            write(fn, 'MATCH_LABELS: a')
+            ihash = input_hash(fn, {'dpi': 300, 'verbose': False})
+            self.assertEqual(ihash, input_hash(fn, {'dpi': 300, 'verbose': True}))
+            self.assertNotEqual(ihash, input_hash(fn, {'dpi': 200, 'verbose': False}))
+            write(fn, 'MATCH_LABELS: b')
+            self.assertNotEqual(ihash, input_hash(fn, {'dpi': 300, 'verbose': False}))
+
+    def test_resume(self):
+        with make_temp_directory() as tmdir:
+            jfn = os.path.join(tmdir, 'journal.jsonl')
+            xmlfn = os.path.join(tmdir, 'p_dnd.xml')
+            write(xmlfn, '<span/>')
+            journal = BuildJournal(jfn)
+            ok = OrderedDict([('name', 'p'), ('status', 'ok'), ('seconds', 1.0), ('artifacts', [xmlfn]),
+                              ('error', None), ('stages', {})])
+            journal.append('p.tex', 'hash1', ok)
+            journal.append('q.tex', 'hash2', dict(ok, status='failed', artifacts=[]))
+            with open(jfn, 'a') as fp:
+                fp.write('{"problem": "r.te')		# crash while writing
+            journal = BuildJournal(jfn, resume=True)
+            self.assertEqual(journal.completed('p.tex', 'hash1')['artifacts'], [xmlfn])
+            self.assertEqual(journal.completed('p.tex', 'changed'), None)
+            self.assertEqual(journal.completed('q.tex', 'hash2'), None)
+            self.assertEqual(journal.completed('r.tex', 'hash3'), None)
+            journal.append('r.tex', 'hash3', ok)
+            self.assertEqual(BuildJournal(jfn, resume=True).completed('r.tex', 'hash3')['name'], 'p')
+            os.unlink(xmlfn)
+            self.assertEqual(journal.completed('p.tex', 'hash1'), None)
+            journal = BuildJournal(jfn)		# the old journal is kept until the first build is recorded
+            self.assertEqual(len(BuildJournal(jfn, resume=True).entries), 3)
+            journal.append('q.tex', 'hash2', ok)
+            self.assertEqual(list(BuildJournal(jfn, resume=True).entries), ['q.tex'])
+
+    def test_changed_dependency(self):
+        with make_temp_directory() as tmdir:
+            jfn = os.path.join(tmdir, 'journal.jsonl')
+            xmlfn = os.path.join(tmdir, 'p_dnd.xml')
+            styfn = os.path.join(tmdir, 'macros.sty')
+            write(xmlfn, '<span/>')
+            write(styfn, '\\newcommand{\\x}{x}')
+            journal = BuildJournal(jfn)
+            journal.append('p.tex', 'hash1', OrderedDict([('name', 'p'), ('status', 'ok'), ('artifacts', [xmlfn]),
+                                                          ('dependencies', dependency_hashes([styfn]))]))
+            journal = BuildJournal(jfn, resume=True)
+            self.assertEqual(journal.completed('p.tex', 'hash1')['name'], 'p')
+            write(styfn, '\\newcommand{\\x}{y}')
+            self.assertEqual(journal.completed('p.tex', 'hash1'), None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import os
+import contextlib
+import unittest
+import tempfile
+import shutil
+from latex2dnd.manifest import BuildManifest, ManifestDiffCommandLine
+from latex2dnd.batch import find_problems, BatchBuilder
+from latex2dnd.main import make_option_parser
+
+@contextlib.contextmanager
+def make_temp_directory():
+    temp_dir = tempfile.mkdtemp('l2dndtmp')
+    yield temp_dir
+    shutil.rmtree(temp_dir)
+
+def write(fn, data):
+    with open(fn, 'w') as fp:
+        fp.write(data)
+
+class TestManifest(unittest.TestCase):
+
+    def test_manifest_save_load_diff(self):
+        with make_temp_directory() as tmdir:
+            for name in ['a_dnd.xml', 'a_dnd.png', 'b_dnd.png']:
+                write(os.path.join(tmdir, name), name)
+            mfn1 = os.path.join(tmdir, 'm1.json')
+            m1 = BuildManifest(mfn1)
+            m1.add_files([os.path.join(tmdir, 'a_dnd.xml'), os.path.join(tmdir, 'a_dnd.png')], 'a.tex', status='ok')
+            m1.add_files([os.path.join(tmdir, 'b_dnd.png')], 'b.tex', status='ok')
+            m1.save()
+            m1 = BuildManifest.load(mfn1)
+            self.assertEqual(m1.artifacts['a_dnd.xml']['size'], len('a_dnd.xml'))
+            self.assertEqual(m1.artifacts['b_dnd.png']['problem'], 'b.tex')
+            self.assertEqual(m1.problems['a.tex']['status'], 'ok')
+
+            write(os.path.join(tmdir, 'a_dnd.png'), 'changed')
+            write(os.path.join(tmdir, 'c_dnd.png'), 'new')
+            m2 = BuildManifest(os.path.join(tmdir, 'm2.json'))
+            m2.add_files([os.path.join(tmdir, x) for x in ['a_dnd.xml', 'a_dnd.png', 'c_dnd.png']], 'a.tex')
+            m2.save()
+            diff = m1.diff(m2)
+            self.assertEqual(diff['added'], ['c_dnd.png'])
+            self.assertEqual(diff['changed'], ['a_dnd.png'])
+            self.assertEqual(diff['removed'], ['b_dnd.png'])
+            self.assertEqual(ManifestDiffCommandLine([mfn1, m2.fn]), diff)
+
+    def test_partial_build_updates_manifest(self):
+        with make_temp_directory() as tmdir:
+            for name in ['a_dnd.xml', 'b_dnd.xml', 'b_dnd_sol_AAAAAA.png', 'b_dnd_sol_BBBBBB.png']:
+                write(os.path.join(tmdir, name), name)
+            mfn = os.path.join(tmdir, 'latex2dnd_manifest.json')
+            old = BuildManifest(mfn)
+            old.add_files([os.path.join(tmdir, 'a_dnd.xml')], 'a.tex', status='ok', dependencies={'a.tex': '1'})
+            old.add_files([os.path.join(tmdir, x) for x in ['b_dnd.xml', 'b_dnd_sol_AAAAAA.png']], 'b.tex', status='ok')
+            old.save()
+
+            # what batch --changed-since does when only b.tex changed
+            (opts, args) = make_option_parser().parse_args([])
+            bb = BatchBuilder(['b.tex'], opts, manifest_fn=mfn, update_manifest=True)
+            artifacts = [os.path.join(tmdir, x) for x in ['b_dnd.xml', 'b_dnd_sol_BBBBBB.png']]
+            bb.record('b.tex', {'name': 'b', 'status': 'ok', 'seconds': 1.0, 'artifacts': artifacts, 'error': None,
+                                'stages': {}})
+            bb.manifest.save()
+            new = BuildManifest.load(mfn)
+            self.assertEqual(sorted(new.artifacts), ['a_dnd.xml', 'b_dnd.xml', 'b_dnd_sol_BBBBBB.png'])
+            self.assertEqual(new.problems['a.tex']['dependencies'], {'a.tex': '1'})
+            self.assertEqual(old.diff(new), {'added': ['b_dnd_sol_BBBBBB.png'], 'changed': [],
+                                             'removed': ['b_dnd_sol_AAAAAA.png']})
+
+    def test_find_problems(self):
+        with make_temp_directory() as tmdir:
+            write(os.path.join(tmdir, 'p1.dndspec'), 'MATCH_LABELS: a')
+            write(os.path.join(tmdir, 'p1.tex'), '\\begin{document}\\DDlabel{a}{a}')
+            write(os.path.join(tmdir, 'p2.tex'), '\\begin{document}\\DDlabel{a}{a}')
+            write(os.path.join(tmdir, 'notes.tex'), '\\begin{document}hello')
+            problems = [os.path.basename(x) for x in find_problems([tmdir])]
+            self.assertEqual(problems, ['p1.dndspec', 'p2.tex'])
+
+if __name__ == '__main__':
+    unittest.main()
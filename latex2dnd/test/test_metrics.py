@@ -0,0 +1,80 @@
+import os
+import contextlib
+import unittest
+import tempfile
+import shutil
+from collections import OrderedDict
+from latex2dnd.metrics import BuildMetrics, Histogram, peak_child_rss
+
+@contextlib.contextmanager
+def make_temp_directory():
+    temp_dir = tempfile.mkdtemp('l2dndtmp')
+    yield temp_dir
+    shutil.rmtree(temp_dir)
+
+def result(status='ok', seconds=3.0, **info):
+    ret = OrderedDict([('name', 'p'), ('status', status), ('seconds', seconds), ('artifacts', []), ('error', None),
+                       ('stages', OrderedDict([('latex', 1.5), ('crop', 0.2), ('rasterize', 0.7), ('images', 1.0)])),
+                       ('bytes', 1000), ('label_cache', None), ('child_rss', 5000000)])
+    ret.update(info)
+    return ret
+
+class TestMetrics(unittest.TestCase):
+
+    def test_histogram(self):
+        hist = Histogram([1, 5])
+        for val in [0.5, 2, 7]:
+            hist.observe(val)
+        self.assertEqual(hist.samples('t_seconds', 'stage="x"'),
+                         ['t_seconds_bucket{stage="x",le="1.0"} 1',
+                          't_seconds_bucket{stage="x",le="5.0"} 2',
+                          't_seconds_bucket{stage="x",le="+Inf"} 3',
+                          't_seconds_sum{stage="x"} 9.5',
+                          't_seconds_count{stage="x"} 3'])
+        self.assertEqual(Histogram([1]).samples('t')[-1], 't_count 0')
+
+    def test_build_metrics(self):
+        with make_temp_directory() as tmdir:
+            fn = os.path.join(tmdir, 'latex2dnd.prom')
+            metrics = BuildMetrics(fn, nproblems=4)
+            metrics.write()
+            with open(fn) as fp:
+                self.assertIn('latex2dnd_batch_running 1\n', fp.read())
+            metrics.observe(result(label_cache={'hits': 3, 'misses': 1}))
+            metrics.observe(result(status='failed', seconds=0.5, bytes=0, child_rss=9000000))
+            metrics.observe(result(), resumed=True)
+            metrics.finish()
+            with open(fn) as fp:
+                text = fp.read()
+            lines = text.splitlines()
+            for line in ['latex2dnd_problems_built_total 1',
+                         'latex2dnd_problems_failed_total 1',
+                         'latex2dnd_cache_hits_total{cache="label"} 3',
+                         'latex2dnd_cache_hits_total{cache="journal"} 1',
+                         'latex2dnd_cache_misses_total{cache="label"} 1',
+                         'latex2dnd_stage_duration_seconds_bucket{stage="latex",le="1.0"} 0',
+                         'latex2dnd_stage_duration_seconds_bucket{stage="latex",le="2.5"} 2',
+                         'latex2dnd_stage_duration_seconds_count{stage="rasterize"} 2',
+                         'latex2dnd_stage_duration_seconds_count{stage="tests"} 0',
+                         'latex2dnd_build_duration_seconds_sum 3.5',
+                         'latex2dnd_written_bytes_total 1000',
+                         'latex2dnd_child_peak_rss_bytes 9000000',
+                         'latex2dnd_batch_problems{state="done"} 3',
+                         'latex2dnd_batch_running 0']:
+                self.assertIn(line, lines)
+            self.assertFalse([x for x in lines if 'stage="images"' in x])
+            for line in lines:			# each counter is named by its samples, as in text format 0.0.4
+                if line.startswith('# TYPE') and line.endswith(' counter'):
+                    name = line.split()[2]
+                    self.assertTrue(name.endswith('_total'))
+                    self.assertIn('# HELP %s ' % name, text)
+                    self.assertTrue([x for x in lines if x.split('{')[0].split()[0] == name])
+            self.assertEqual(lines[-1], '# EOF')
+            self.assertEqual(os.listdir(tmdir), ['latex2dnd.prom'])
+
+    def test_peak_child_rss(self):
+        rss = peak_child_rss()
+        self.assertTrue(rss is None or rss >= 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import os
+import contextlib
+import unittest
+import tempfile
+import tarfile
+import zipfile
+import shutil
+from latex2dnd.olx import CourseArchive, course_image_dir
+
+@contextlib.contextmanager
+def make_temp_directory():
+    temp_dir = tempfile.mkdtemp('l2dndtmp')
+    yield temp_dir
+    shutil.rmtree(temp_dir)
+
+class TestCourseArchive(unittest.TestCase):
+
+    def make_artifacts(self, tmdir):
+        xmlfn = os.path.join(tmdir, 'quad_dnd.xml')
+        with open(xmlfn, 'w') as fp:
+            fp.write('<span><customresponse/></span>')
+        pngfn = os.path.join(tmdir, 'quad_dnd_label1.png')
+        with open(pngfn, 'wb') as fp:
+            fp.write(b'png')
+        return [xmlfn, pngfn]
+
+    def test_course_image_dir(self):
+        self.assertEqual(course_image_dir('quad'), '/static/images/quad/')
+        self.assertEqual(course_image_dir('quad', '/assets/'), '/assets/quad/')
+
+    def test_tar_archive(self):
+        with make_temp_directory() as tmdir:
+            afn = os.path.join(tmdir, 'course.tar.gz')
+            with CourseArchive(afn) as archive:
+                archive.add_problem('quad', self.make_artifacts(tmdir))
+            with tarfile.open(afn) as tar:
+                self.assertEqual(sorted(tar.getnames()), ['course/problem/quad.xml',
+                                                          'course/static/images/quad/quad_dnd_label1.png'])
+                olx = tar.extractfile('course/problem/quad.xml').read().decode()
+            self.assertTrue(olx.startswith('<problem display_name="quad">'))
+            self.assertIn('<customresponse/>', olx)
+
+    def test_zip_archive_abort(self):
+        with make_temp_directory() as tmdir:
+            afn = os.path.join(tmdir, 'course.zip')
+            artifacts = self.make_artifacts(tmdir)
+            with CourseArchive(afn) as archive:
+                archive.add_problem('quad', artifacts)
+            with zipfile.ZipFile(afn) as zfp:
+                self.assertEqual(zfp.read('course/static/images/quad/quad_dnd_label1.png'), b'png')
+            os.unlink(afn)
+            with self.assertRaises(Exception):
+                with CourseArchive(afn) as archive:
+                    archive.add_problem('quad', artifacts)
+                    archive.add_problem('quad', artifacts)
+            self.assertEqual(sorted(os.listdir(tmdir)), ['quad_dnd.xml', 'quad_dnd_label1.png'])
+
+if __name__ == '__main__':
+    unittest.main()
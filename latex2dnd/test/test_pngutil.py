@@ -0,0 +1,31 @@
+import os
+import zlib
+import struct
+import unittest
+import tempfile
+from latex2dnd.pngutil import strip_png_metadata, PNG_SIGNATURE
+
+def png_chunk(ctype, data):
+    return struct.pack('>I', len(data)) + ctype + data + struct.pack('>I', zlib.crc32(ctype + data) & 0xffffffff)
+
+def make_png(text_chunks):
+    ihdr = png_chunk(b'IHDR', struct.pack('>IIBBBBB', 1, 1, 8, 0, 0, 0, 0))
+    idat = png_chunk(b'IDAT', zlib.compress(b'\x00\x00'))
+    return PNG_SIGNATURE + ihdr + b''.join(text_chunks) + idat + png_chunk(b'IEND', b'')
+
+class TestPngUtil(unittest.TestCase):
+
+    def test_strip_png_metadata(self):
+        (fd, fn) = tempfile.mkstemp(suffix='.png')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(make_png([png_chunk(b'tEXt', b'date:create\x002024-01-01T00:00:00'),
+                                   png_chunk(b'tIME', b'\x07\xe8\x01\x01\x00\x00\x00')]))
+            self.assertTrue(strip_png_metadata(fn))
+            self.assertEqual(open(fn, 'rb').read(), make_png([]))
+            self.assertFalse(strip_png_metadata(fn))
+        finally:
+            os.unlink(fn)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import os
+import contextlib
+import unittest
+import tempfile
+import shutil
+import threading
+from latex2dnd.store import ArtifactStore, LabelCache, sha256_bytes
+from latex2dnd.remote import CacheServer, HttpArtifactStore, TieredArtifactStore, open_store
+
+@contextlib.contextmanager
+def make_temp_directory():
+    temp_dir = tempfile.mkdtemp('l2dndtmp')
+    yield temp_dir
+    shutil.rmtree(temp_dir)
+
+@contextlib.contextmanager
+def cache_server(root):
+    server = CacheServer(root, port=0)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+class TestRemoteStore(unittest.TestCase):
+
+    def test_http_store(self):
+        with make_temp_directory() as tmdir, cache_server(os.path.join(tmdir, 'server')) as server:
+            remote = HttpArtifactStore(server.url())
+            keys = [sha256_bytes(str(k)) for k in range(5)]
+            self.assertEqual(remote.get(keys[0]), None)
+            self.assertFalse(remote.has(keys[0]))
+            for k, key in enumerate(keys[:4]):
+                self.assertEqual(remote.put(key, b'blob%d' % k), key)
+            self.assertTrue(remote.has(keys[0]))
+            self.assertEqual(remote.get(keys[1]), b'blob1')
+            self.assertEqual(remote.connections, 1)
+            self.assertEqual(remote.get_many(keys), [b'blob0', b'blob1', b'blob2', b'blob3', None])
+            self.assertEqual(server.stats['puts'], 4)
+
+            # the fetch threads, and their connections, are reused
+            nconn = remote.connections
+            self.assertTrue(nconn <= 1 + remote.fetch_jobs)
+            for k in range(3):
+                self.assertEqual(remote.get_many(keys)[:2], [b'blob0', b'blob1'])
+            self.assertTrue(remote.connections <= 1 + remote.fetch_jobs)	# the pool may start more threads
+            remote.close()
+            self.assertEqual(remote.get_many(keys[:2]), [b'blob0', b'blob1'])
+            remote.close()
+            with self.assertRaises(ValueError):
+                remote.get('../etc/passwd')
+
+    def test_tiered_store(self):
+        with make_temp_directory() as tmdir, cache_server(os.path.join(tmdir, 'server')) as server:
+            alice = open_store(os.path.join(tmdir, 'alice'), server.url())
+            bob = TieredArtifactStore(os.path.join(tmdir, 'bob'), HttpArtifactStore(server.url()))
+            self.assertIsInstance(alice, TieredArtifactStore)
+            lc = LabelCache(alice, 'preamble1')
+            lc.put('$m_1$', (100, 200), 300, b'png1')
+            lc.put('$m_2$', (100, 200), 300, b'png2')
+
+            # bob's build is warmed by alice's
+            lc = LabelCache(bob, 'preamble1')
+            entries = [('$m_1$', (100, 200), 300), ('$m_2$', (100, 200), 300), ('$m_3$', (100, 200), 300)]
+            self.assertEqual(lc.get_many(entries), [b'png1', b'png2', None])
+            self.assertEqual((lc.hits, lc.misses, bob.remote_hits), (2, 1, 2))
+            self.assertTrue(ArtifactStore.has(bob, lc.key('$m_1$', (100, 200), 300)))
+            self.assertEqual(lc.get_many(entries[:2]), [b'png1', b'png2'])
+            self.assertEqual(bob.remote_hits, 2)
+
+    def test_tiered_put_uploads_missing(self):
+        with make_temp_directory() as tmdir:
+            local = os.path.join(tmdir, 'local')
+            key = sha256_bytes('label')
+            ArtifactStore(local).put(key, b'png')		# rendered before the shared cache was used
+            with cache_server(os.path.join(tmdir, 'server')) as server:
+                store = open_store(local, server.url())
+                store.put(key, b'png')
+                self.assertEqual(server.stats['puts'], 1)
+                store.put(key, b'png')			# known to be there now
+                self.assertEqual(server.stats['puts'], 1)
+                self.assertEqual(HttpArtifactStore(server.url()).get(key), b'png')
+
+    def test_for_url(self):
+        url = 'http://127.0.0.1:9/'
+        store = HttpArtifactStore.for_url(url, timeout=3)
+        self.assertIs(HttpArtifactStore.for_url(url.rstrip('/'), timeout=3), store)
+        self.assertIsNot(HttpArtifactStore.for_url(url, timeout=4), store)
+        self.assertEqual(HttpArtifactStore.for_url(url, timeout=4).timeout, 4)
+
+    def test_server_unreachable(self):
+        with make_temp_directory() as tmdir:
+            with cache_server(os.path.join(tmdir, 'server')) as server:
+                url = server.url()
+            store = TieredArtifactStore(os.path.join(tmdir, 'local'), HttpArtifactStore(url, timeout=1))
+            key = sha256_bytes('label')
+            self.assertEqual(store.get(key), None)
+            self.assertEqual(store.put(key, b'png'), key)
+            self.assertEqual(store.get(key), b'png')
+            self.assertTrue(store.remote.errors > 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+import io
+import json
+import time
+import base64
+import zipfile
+import unittest
+import threading
+from collections import OrderedDict
+from urllib.request import urlopen, Request
+from urllib.error import HTTPError
+from latex2dnd.api import DragDropResult
+from latex2dnd.serve import JobQueue, BuildServer, QueueFull
+
+def fake_build(text, name="problem", fmt="tex", extra_files=None, **options):
+    '''
+    Stand-in for build_dnd, so the server can be tested without TeX
+    '''
+    time.sleep(0.05)
+    if "FAIL" in text:
+        raise Exception("bad source")
+    images = OrderedDict([(name + '_dnd.png', b'png'), (name + '_dnd_sol.png', b'sol')])
+    images.update((bn, data) for bn, data in (extra_files or {}).items())
+    return DragDropResult(name, '<span>%s</span>' % text, images, name + '_dnd.png', name + '_dnd_sol.png',
+                          OrderedDict(), None, '/static/images/%s/' % name)
+
+class TestBuildServer(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = JobQueue(workers=2, max_queued=10, build_func=fake_build)
+        self.server = BuildServer(self.queue, port=0)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = self.server.url()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.queue.shutdown()
+
+    def request(self, path, data=None):
+        if data is not None:
+            data = json.dumps(data).encode('utf8')
+        try:
+            resp = urlopen(Request(self.url + path, data=data), timeout=10)
+        except HTTPError as err:
+            return err.code, err.read()
+        return resp.getcode(), resp.read()
+
+    def wait_for(self, job_id):
+        for k in range(200):
+            code, body = self.request('/jobs/%s' % job_id)
+            info = json.loads(body.decode('utf8'))
+            if info['status'] in ['done', 'failed']:
+                return info
+            time.sleep(0.02)
+        raise Exception("job %s did not finish" % job_id)
+
+    def test_submit_poll_and_fetch(self):
+        code, body = self.request('/jobs', {'source': 'hello', 'name': 'p1',
+                                           'files': {'fig.png': base64.b64encode(b'fig').decode('ascii')}})
+        self.assertEqual(code, 202)
+        info = self.wait_for(json.loads(body.decode('utf8'))['id'])
+        self.assertEqual(info['status'], 'done')
+        code, body = self.request(info['artifacts'])
+        self.assertEqual(code, 200)
+        zfp = zipfile.ZipFile(io.BytesIO(body))
+        self.assertEqual(sorted(zfp.namelist()), ['fig.png', 'p1_dnd.png', 'p1_dnd.xml', 'p1_dnd_sol.png'])
+        self.assertEqual(zfp.read('p1_dnd.xml'), b'<span>hello</span>')
+
+    def test_identical_submission_reused(self):
+        code, body = self.request('/jobs', {'source': 'same', 'name': 'p2'})
+        job_id = json.loads(body.decode('utf8'))['id']
+        self.wait_for(job_id)
+        code, body = self.request('/jobs', {'source': 'same', 'name': 'p2'})
+        self.assertEqual(code, 200)
+        self.assertEqual(json.loads(body.decode('utf8'))['id'], job_id)
+        code, body = self.request('/jobs', {'source': 'different', 'name': 'p2'})
+        self.assertEqual(code, 202)
+        self.assertNotEqual(json.loads(body.decode('utf8'))['id'], job_id)
+        stats = json.loads(self.request('/stats')[1].decode('utf8'))
+        self.assertEqual(stats['submitted'], 3)
+        self.assertEqual(stats['reused'], 1)
+
+    def test_failed_build(self):
+        code, body = self.request('/jobs', {'source': 'FAIL'})
+        info = self.wait_for(json.loads(body.decode('utf8'))['id'])
+        self.assertEqual(info['status'], 'failed')
+        self.assertIn('bad source', info['error'])
+        code, body = self.request('/jobs/%s/artifacts.zip' % info['id'])
+        self.assertEqual(code, 409)
+
+    def test_bad_requests(self):
+        self.assertEqual(self.request('/jobs', {'name': 'nosource'})[0], 400)
+        self.assertEqual(self.request('/jobs', {'source': 'x', 'format': 'pdf'})[0], 400)
+        self.assertEqual(self.request('/jobs', {'source': 'x', 'files': {'../x': ''}})[0], 400)
+        self.assertEqual(self.request('/jobs', {'source': 'x', 'name': '../escaped'})[0], 400)
+        self.assertEqual(self.request('/jobs', {'source': 'x', 'name': 'a b'})[0], 400)
+        self.assertEqual(self.request('/jobs/nosuchjob')[0], 404)
+
+    def test_stats(self):
+        ids = [json.loads(self.request('/jobs', {'source': 's%d' % k})[1].decode('utf8'))['id'] for k in range(5)]
+        for job_id in ids:
+            self.wait_for(job_id)
+        stats = json.loads(self.request('/stats')[1].decode('utf8'))
+        self.assertEqual(stats['queue_depth'], 0)
+        self.assertEqual(stats['done'], 5)
+        self.assertEqual(stats['build_seconds']['count'], 5)
+        self.assertTrue(stats['build_seconds']['p50'] >= 0.05)
+
+class TestJobQueue(unittest.TestCase):
+
+    def test_queue_full(self):
+        gate = threading.Event()
+
+        def blocked_build(text, **kwargs):
+            gate.wait(10)
+            return fake_build(text, **kwargs)
+
+        queue = JobQueue(workers=1, max_queued=1, build_func=blocked_build)
+        try:
+            job, reused = queue.submit('a')
+            while job.status != "running":
+                time.sleep(0.01)
+            queue.submit('b')
+            with self.assertRaises(QueueFull):
+                queue.submit('c')
+            self.assertEqual(queue.stats()['queue_depth'], 1)
+        finally:
+            gate.set()
+            queue.shutdown()
+
+    def test_finished_jobs_expire(self):
+        queue = JobQueue(workers=1, build_func=fake_build, keep_finished=2)
+        try:
+            jobs = [queue.submit('s%d' % k)[0] for k in range(4)]
+            queue.shutdown()
+            self.assertEqual([queue.get(job.id) for job in jobs], [None, None, jobs[2], jobs[3]])
+            self.assertEqual(queue.stats()['expired'], 2)
+        finally:
+            queue.shutdown()
+
+if __name__ == '__main__':
+    unittest.main()
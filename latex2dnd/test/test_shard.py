@@ -0,0 +1,66 @@
+import os
+import contextlib
+import unittest
+import tempfile
+import shutil
+from latex2dnd.shard import parse_shard, partition, select_shard, load_costs
+from latex2dnd.manifest import BuildManifest, ManifestMergeCommandLine
+
+@contextlib.contextmanager
+def make_temp_directory():
+    temp_dir = tempfile.mkdtemp('l2dndtmp')
+    yield temp_dir
+    shutil.rmtree(temp_dir)
+
+PROBLEMS = ['course/p%02d.dndspec' % k for k in range(20)]
+
+class TestShard(unittest.TestCase):
+
+    def test_parse_shard(self):
+        self.assertEqual(parse_shard('2/4'), (2, 4))
+        for bad in ['0/4', '5/4', '1', 'a/b', '1/0']:
+            with self.assertRaises(ValueError):
+                parse_shard(bad)
+
+    def test_hash_partition(self):
+        shards = partition(PROBLEMS, 3)
+        self.assertEqual(sorted(sum(shards, [])), PROBLEMS)
+        self.assertEqual(shards, partition(PROBLEMS, 3))
+        self.assertEqual(select_shard(PROBLEMS, '2/3'), shards[1])
+        # adding a problem does not move the others
+        more = partition(PROBLEMS + ['course/new.dndspec'], 3)
+        for old, new in zip(shards, more):
+            self.assertEqual([x for x in new if x != 'course/new.dndspec'], old)
+
+    def test_cost_partition(self):
+        costs = dict(('course/p%02d.dndspec' % k, 1.0) for k in range(20))
+        costs['course/p00.dndspec'] = 10.0
+        costs['course/p01.dndspec'] = 10.0
+        del costs['course/p19.dndspec']		# no timing data: gets the mean cost
+        shards = partition(PROBLEMS, 2, costs)
+        self.assertEqual(sorted(sum(shards, [])), PROBLEMS)
+        self.assertEqual(len(shards[0]) + len(shards[1]), 20)
+        self.assertIn('course/p00.dndspec', shards[0])
+        self.assertIn('course/p01.dndspec', shards[1])
+        totals = [sum(costs.get(p, 1.9) for p in shard) for shard in shards]
+        self.assertTrue(abs(totals[0] - totals[1]) <= 1.9)
+
+    def test_costs_and_merge(self):
+        with make_temp_directory() as tmdir:
+            fns = []
+            for k in range(2):
+                afn = os.path.join(tmdir, 'a%d.png' % k)
+                with open(afn, 'w') as fp:
+                    fp.write('x' * k)
+                m = BuildManifest(os.path.join(tmdir, 'shard%d.json' % k))
+                m.add_files([afn], 'course/p%02d.dndspec' % k, status='ok', seconds=k + 1.5)
+                m.save()
+                fns.append(m.fn)
+            self.assertEqual(load_costs(fns), {'course/p00.dndspec': 1.5, 'course/p01.dndspec': 2.5})
+            mfn = os.path.join(tmdir, 'merged.json')
+            merged = ManifestMergeCommandLine(['-o', mfn] + fns)
+            self.assertEqual(sorted(merged.artifacts), ['a0.png', 'a1.png'])
+            self.assertEqual(sorted(BuildManifest.load(mfn).problems), ['course/p00.dndspec', 'course/p01.dndspec'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+import os
+import json
+import time
+import contextlib
+import unittest
+import tempfile
+import shutil
+import multiprocessing
+from collections import OrderedDict
+from latex2dnd.main import make_option_parser
+from latex2dnd.spool import Spool, SpoolWorker
+
+@contextlib.contextmanager
+def make_temp_directory():
+    temp_dir = tempfile.mkdtemp('l2dndtmp')
+    yield temp_dir
+    shutil.rmtree(temp_dir)
+
+def fake_build(problem, opts):
+    '''
+    Stand-in for build_problem, so workers can be tested without TeX
+    '''
+    print("building %s" % problem)
+    time.sleep(0.05)
+    status = 'failed' if 'bad' in problem else 'ok'
+    return OrderedDict([('name', os.path.basename(problem)), ('status', status), ('seconds', 0.05),
+                        ('artifacts', [problem + '.xml']), ('error', None)])
+
+def run_worker(spooldir, lease=600):
+    (opts, args) = make_option_parser().parse_args([])
+    worker = SpoolWorker(Spool(spooldir, lease=lease), opts, build_func=fake_build, poll=0.01)
+    worker.run(drain=True)
+
+class TestSpool(unittest.TestCase):
+
+    def make_problems(self, tmdir, names):
+        fns = []
+        for name in names:
+            fn = os.path.join(tmdir, name + '.dndspec')
+            with open(fn, 'w') as fp:
+                fp.write('')
+            fns.append(fn)
+        return fns
+
+    def test_several_workers(self):
+        with make_temp_directory() as tmdir:
+            spool = Spool(os.path.join(tmdir, 'spool'))
+            jids = [spool.submit(fn) for fn in self.make_problems(tmdir, ['p%d' % k for k in range(8)] + ['bad'])]
+            procs = [multiprocessing.Process(target=run_worker, args=(spool.dir,)) for k in range(3)]
+            for proc in procs:
+                proc.start()
+            for proc in procs:
+                proc.join(30)
+            self.assertEqual(spool.pending(), [])
+            self.assertEqual(spool.claimed(), [])
+            results = [spool.result(jid) for jid in jids]
+            self.assertEqual([r['status'] for r in results], ['ok'] * 8 + ['failed'])
+            self.assertTrue(all(r['attempts'] == 1 for r in results))
+            with open(results[0]['log']) as fp:
+                self.assertIn('building %s' % results[0]['problem'], fp.read())
+
+    def test_claim_is_exclusive(self):
+        with make_temp_directory() as tmdir:
+            spool = Spool(os.path.join(tmdir, 'spool'))
+            spool.submit(self.make_problems(tmdir, ['p1'])[0])
+            job = spool.claim()
+            self.assertEqual(job['attempts'], 1)
+            self.assertEqual(spool.claim(), None)
+            self.assertEqual(spool.requeue_stale(), [])
+
+    def test_stale_claim_requeued(self):
+        with make_temp_directory() as tmdir:
+            spool = Spool(os.path.join(tmdir, 'spool'), lease=60)
+            jid = spool.submit(self.make_problems(tmdir, ['p1'])[0])
+            spool.claim()
+            cfn = spool.path('claimed', jid + '.json')
+            os.utime(cfn, (time.time() - 120, time.time() - 120))
+            run_worker(spool.dir, lease=60)
+            result = spool.result(jid)
+            self.assertEqual(result['status'], 'ok')
+            self.assertEqual(result['attempts'], 2)
+            self.assertEqual(spool.claimed(), [])
+
+    def test_claim_of_old_job_is_not_stale(self):
+        with make_temp_directory() as tmdir:
+            spool = Spool(os.path.join(tmdir, 'spool'), lease=60)
+            jid = spool.submit(self.make_problems(tmdir, ['p1'])[0])
+            qfn = spool.path('queue', jid + '.json')
+            os.utime(qfn, (time.time() - 120, time.time() - 120))	# queued long ago
+            job = spool.claim('w1')
+            self.assertEqual(spool.requeue_stale(), [])
+            self.assertTrue(spool.touch(job))
+
+    def test_lost_claim(self):
+        with make_temp_directory() as tmdir:
+            spool = Spool(os.path.join(tmdir, 'spool'), lease=60)
+            jid = spool.submit(self.make_problems(tmdir, ['p1'])[0])
+            job1 = spool.claim('w1')
+            cfn = spool.path('claimed', jid + '.json')
+            os.utime(cfn, (time.time() - 120, time.time() - 120))	# w1 stopped renewing its claim
+            self.assertEqual(spool.requeue_stale(), [jid])
+            job2 = spool.claim('w2')
+            self.assertEqual((job2['worker'], job2['attempts']), ('w2', 2))
+
+            # w1 finishing late leaves w2's claim alone
+            self.assertFalse(spool.touch(job1))
+            self.assertFalse(spool.finish(job1, {'status': 'ok', 'worker': 'w1'}))
+            spool.release(job1)
+            self.assertEqual(spool.claimed(), [jid])
+            self.assertEqual(spool.result(jid), None)
+            self.assertTrue(spool.finish(job2, {'status': 'ok', 'worker': 'w2'}))
+            self.assertEqual(spool.claimed(), [])
+            self.assertEqual(spool.result(jid)['worker'], 'w2')
+
+    def test_claim_taken_aside(self):
+        with make_temp_directory() as tmdir:
+            spool = Spool(os.path.join(tmdir, 'spool'), lease=60)
+            jid = spool.submit(self.make_problems(tmdir, ['p1'])[0])
+            job1 = spool.claim('w1')
+            spool.release(job1)
+            self.assertEqual(spool.pending(), [jid])
+            self.assertEqual(os.listdir(spool.path('claimed')), [])
+            with open(spool.path('queue', jid + '.json')) as fp:
+                self.assertNotIn('token', fp.read())		# requeued claims do not keep their token
+
+            # a claim renamed aside while the job is claimed again is dropped, not put back
+            job2 = spool.claim('w2')
+            (private, claim) = spool.take_aside(jid, job1['token'], 'finish')
+            self.assertEqual(claim['token'], job2['token'])
+            job3 = dict(job2, token='other')
+            with open(spool.path('claimed', jid + '.json'), 'w') as fp:
+                fp.write(json.dumps(job3))
+            spool.put_back(private, jid)
+            self.assertEqual(os.listdir(spool.path('claimed')), [jid + '.json'])
+            self.assertFalse(spool.holds(job2))
+            self.assertTrue(spool.finish(job3, {'status': 'ok', 'worker': 'w3'}))
+            self.assertEqual(os.listdir(spool.path('claimed')), [])
+
+if __name__ == '__main__':
+    unittest.main()
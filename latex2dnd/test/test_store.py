@@ -0,0 +1,69 @@
+import os
+import contextlib
+import unittest
+import tempfile
+import shutil
+from latex2dnd.store import ArtifactStore, LabelCache, preamble_hash_for_tex, sha256_bytes
+
+@contextlib.contextmanager
+def make_temp_directory():
+    temp_dir = tempfile.mkdtemp('l2dndtmp')
+    yield temp_dir
+    shutil.rmtree(temp_dir)
+
+class TestStore(unittest.TestCase):
+
+    def test_artifact_store(self):
+        with make_temp_directory() as tmdir:
+            store = ArtifactStore(os.path.join(tmdir, 'store'))
+            key = sha256_bytes(b'hello')
+            self.assertFalse(store.has(key))
+            self.assertEqual(store.get(key), None)
+            self.assertEqual(store.put(key, b'hello'), key)
+            self.assertTrue(store.has(key))
+            self.assertEqual(store.get(key), b'hello')
+
+            fn = os.path.join(tmdir, 'x.png')
+            with open(fn, 'wb') as fp:
+                fp.write(b'hello')
+            self.assertEqual(store.put_file(fn), key)
+            ofn = os.path.join(tmdir, 'y.png')
+            self.assertTrue(store.get_file(key, ofn))
+            self.assertEqual(open(ofn, 'rb').read(), b'hello')
+
+    def test_link_file(self):
+        with make_temp_directory() as tmdir:
+            store = ArtifactStore(os.path.join(tmdir, 'store'))
+            fn1 = os.path.join(tmdir, 'foo_dnd_label3.png')
+            fn2 = os.path.join(tmdir, 'bar_dnd_label1.png')
+            for fn in [fn1, fn2]:
+                with open(fn, 'wb') as fp:
+                    fp.write(b'same label')
+            self.assertEqual(store.link_file(fn1), 0)
+            self.assertEqual(store.link_file(fn2), len(b'same label'))
+            self.assertTrue(os.path.samefile(fn1, fn2))
+            self.assertEqual(store.link_file(fn2), 0)
+            self.assertEqual(open(fn2, 'rb').read(), b'same label')
+
+    def test_label_cache(self):
+        with make_temp_directory() as tmdir:
+            lc = LabelCache(tmdir, 'preamble1')
+            self.assertEqual(lc.get('$m_1$', (100, 200), 300), None)
+            lc.put('$m_1$', (100, 200), 300, b'png1')
+            self.assertEqual(lc.get('$m_1$', (100, 200), 300), b'png1')
+            self.assertEqual(lc.get('$m_1$', (100, 200), 150), None)
+            self.assertEqual(LabelCache(tmdir, 'preamble2').get('$m_1$', (100, 200), 300), None)
+            self.assertEqual((lc.hits, lc.misses), (1, 2))
+
+    def test_preamble_hash_ignores_comments(self):
+        with make_temp_directory() as tmdir:
+            fn1 = os.path.join(tmdir, 'a.tex')
+            fn2 = os.path.join(tmdir, 'b.tex')
+            with open(fn1, 'w') as fp:
+                fp.write("% generated from a.dndspec\n\\documentclass{article}\n\\begin{document}\n$a$\n\\end{document}\n")
+            with open(fn2, 'w') as fp:
+                fp.write("% generated from b.dndspec\n\\documentclass{article}\n\n\\begin{document}\n$b$\n\\end{document}\n")
+            self.assertEqual(preamble_hash_for_tex(fn1), preamble_hash_for_tex(fn2))
+
+if __name__ == '__main__':
+    unittest.main()